@@ -0,0 +1,270 @@
+"""
+Local microbenchmarks for pipeline hot paths.
+Run from the lambda directory: python benchmarks.py
+
+Each benchmark builds synthetic data, times the current implementation against the
+implementation it replaced, and prints the speedup. No AWS or network access is needed.
+"""
+import os
+import sys
+import time
+import traceback
+from datetime import datetime, timedelta, timezone
+from zoneinfo import ZoneInfo
+
+os.chdir(os.path.dirname(os.path.abspath(__file__)))
+
+
+def timed(func, *args, repeat=3):
+    """Returns the best wall time in seconds over `repeat` runs and the last result."""
+    best = None
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func(*args)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def synthetic_posts(count, start=datetime(2026, 1, 15, tzinfo=timezone.utc)):
+    """Builds API-shaped posts whose `now` string is the Eastern-time rendering of `time`."""
+    from utils import api_timezone
+    eastern = ZoneInfo(api_timezone)
+    posts = []
+    for i in range(count):
+        posted = start + timedelta(seconds=37 * i)
+        local = posted.astimezone(eastern)
+        posts.append({
+            'no': 100000 + i,
+            'time': int(posted.timestamp()),
+            'now': local.strftime('%m/%d/%y(%a)%H:%M:%S'),
+            'com': f'post {i}',
+        })
+    return posts
+
+
+def bench_gather_timestamps(rows=100000):
+    """Timestamp derivation in gather: split-based `now` parsing vs epoch-based derive_timestamps."""
+    print(f"\n=== Gather timestamp derivation ({rows} posts) ===")
+    import pandas as pd
+    import gather
+
+    def legacy(data):
+        data = data.copy()
+        data[['date', 'now']] = data['now'].str.split('(', expand=True)
+        data[['now', 'time']] = data['now'].str.split(')', expand=True)
+        data['posted_date_time'] = pd.to_datetime(data['date'] + data['time'], format='%m/%d/%y%H:%M:%S')
+        data['time'] = pd.to_datetime(data['time'], format='%Y-%m-%d %H:%M:%S', errors='coerce', utc=True).dt.floor('min') \
+            .apply(lambda x: x.strftime("%H:%M:%S") if pd.notnull(x) else None)
+        return data
+
+    def vectorized(data):
+        return gather.derive_timestamps(data.copy())
+
+    data = pd.DataFrame(synthetic_posts(rows))
+    legacy_seconds, _ = timed(legacy, data)
+    vectorized_seconds, _ = timed(vectorized, data)
+    print(f"[INFO] legacy:     {legacy_seconds:.3f}s")
+    print(f"[INFO] vectorized: {vectorized_seconds:.3f}s")
+    print(f"[OK] speedup: {legacy_seconds / vectorized_seconds:.1f}x")
+    return True
+
+
+def synthetic_phrases(count, seed=7):
+    """Builds `count` one- to three-word phrases and 2,000 rows of text drawn from the same vocabulary."""
+    import random
+    rng = random.Random(seed)
+    vocab = [f'term{i}' for i in range(max(50, count // 2))]
+    common = ['the', 'price', 'is', 'going', 'up', 'down', 'today', 'anon', 'lol', 'buy']
+    phrases = [(' '.join(rng.choice(vocab) for _ in range(rng.randint(1, 3))), f'category{i % 10}')
+               for i in range(count)]
+    rows = [' '.join(rng.choice(common + vocab[:200]) for _ in range(rng.randint(5, 40))) for _ in range(2000)]
+    return phrases, rows
+
+
+def bench_phrase_matching(phrase_counts=(10, 100, 1000, 10000), legacy_rows=200):
+    """Key-phrase matching: per-row regex_partial_match vs PhraseMatcher as the phrase list grows."""
+    print("\n=== Key phrase matching ===")
+    import process
+
+    for count in phrase_counts:
+        phrases, rows = synthetic_phrases(count)
+        sample = rows[:legacy_rows]
+        legacy_seconds, _ = timed(lambda: [process.regex_partial_match(row, phrases) for row in sample], repeat=1)
+        build_seconds, matcher = timed(lambda: process.PhraseMatcher(phrases), repeat=1)
+        matcher_seconds, _ = timed(lambda: [matcher.match(row) for row in rows], repeat=1)
+        legacy_per_row = legacy_seconds / len(sample) * 1e6
+        matcher_per_row = matcher_seconds / len(rows) * 1e6
+        print(f"[INFO] {count:>6} phrases: legacy {legacy_per_row:10.1f} us/row, "
+              f"matcher {matcher_per_row:8.1f} us/row (build {build_seconds:.3f}s), "
+              f"speedup {legacy_per_row / matcher_per_row:.1f}x")
+    return True
+
+
+def synthetic_comments(count, seed=11):
+    """Builds `count` comments using the markup 4chan emits: quote links, greentext, line breaks and entities."""
+    import random
+    rng = random.Random(seed)
+    words = ['price', 'anon', 'buy', 'sell', 'moon', 'fed', 'rates', 'chart', 'kek', 'https://www.example.com/x']
+    fragments = ['<a href="#p{n}" class="quotelink">&gt;&gt;{n}</a>', '<span class="quote">&gt;{w}</span>',
+                 '<br>', '<wbr>', '&quot;{w}&quot;', 'isn&#039;t', '<b>{w}</b>', '{w}', '{w}', '{w}']
+    return [''.join(rng.choice(fragments).format(n=rng.randint(10**7, 10**8), w=rng.choice(words)) + ' '
+                    for _ in range(rng.randint(5, 60)))
+            for _ in range(count)]
+
+
+def bench_text_normalization(rows=20000):
+    """Comment cleaning: BeautifulSoup-based normalize_text vs normalize_text_fast."""
+    print(f"\n=== Text normalization ({rows} comments) ===")
+    import utils
+
+    comments = synthetic_comments(rows)
+    legacy_seconds, expected = timed(lambda: [utils.normalize_text(c) for c in comments], repeat=1)
+    fast_seconds, actual = timed(lambda: [utils.normalize_text_fast(c) for c in comments], repeat=1)
+    print(f"[INFO] legacy: {legacy_seconds:.3f}s ({rows / legacy_seconds:,.0f} rows/s)")
+    print(f"[INFO] fast:   {fast_seconds:.3f}s ({rows / fast_seconds:,.0f} rows/s)")
+    print(f"[OK] speedup: {legacy_seconds / fast_seconds:.1f}x")
+    return expected == actual
+
+
+def bench_text_stats(rows=20000):
+    """Supporting columns: per-row RegexpTokenizer and stopword list vs the fused text_stats paths."""
+    print(f"\n=== Text statistics ({rows} comments) ===")
+    import pandas as pd
+    from nltk.tokenize import RegexpTokenizer
+    import utils
+
+    try:
+        stop_list = utils.stop_words_()
+    except LookupError:
+        print("[INFO] NLTK stopwords not available, using a sample list")
+        stop_list = ['i', 'me', 'the', 'is', 'a', 'an', 'and', 'to', 'of', 'it', 'in', 'on', 'for', 'don', 't'] * 12
+    stop = frozenset(stop_list)
+
+    def legacy(data):
+        def count_stopwords(text):
+            tokenizer = RegexpTokenizer(r'\w+|\$[\d\.]+|\S+')
+            return len([w for w in tokenizer.tokenize(text) if w in list(stop_list)])
+        text = data['posted_comment'].astype(str)
+        return text.apply(lambda x: len(str(x).split(" "))), text.str.len(), text.apply(count_stopwords)
+
+    def fused(data):
+        return [utils.text_stats(text, stop) for text in data['posted_comment'].astype(str)]
+
+    def vectorized(data):
+        return utils.text_stats_vectorized(data['posted_comment'].astype(str), stop)
+
+    data = pd.DataFrame({'posted_comment': synthetic_comments(rows)})
+    legacy_seconds, expected = timed(legacy, data, repeat=1)
+    fused_seconds, actual = timed(fused, data)
+    vectorized_seconds, columns = timed(vectorized, data)
+    print(f"[INFO] legacy:     {legacy_seconds:.3f}s")
+    print(f"[INFO] fused:      {fused_seconds:.3f}s ({legacy_seconds / fused_seconds:.1f}x)")
+    print(f"[INFO] vectorized: {vectorized_seconds:.3f}s ({legacy_seconds / vectorized_seconds:.1f}x)")
+    expected = list(zip(*(column.tolist() for column in expected)))
+    return expected == actual == list(zip(*(column.tolist() for column in columns)))
+
+
+def bench_output_formats(rows=50000):
+    """Processed output: CSV vs Parquet file size, write time and load time."""
+    print(f"\n=== Output formats ({rows} rows) ===")
+    import io
+    import pandas as pd
+    import process
+
+    posts = synthetic_posts(rows)
+    comments = synthetic_comments(2000)
+    data = pd.DataFrame({
+        'thread_id': [post['no'] for post in posts],
+        'posted_date_time': pd.to_datetime([post['time'] for post in posts], unit='s'),
+        'posted_comment': [comments[i % len(comments)] for i in range(rows)],
+        'country': [['US', 'DE', 'GB', 'CA'][i % 4] for i in range(rows)],
+        'word_cnt': [i % 300 for i in range(rows)],
+    })
+
+    def write_csv():
+        return process.to_csv_text(data).encode('utf-8')
+
+    def write_parquet(compression):
+        buffer = io.BytesIO()
+        data.to_parquet(buffer, index=False, compression=compression)
+        return buffer.getvalue()
+
+    csv_write_seconds, csv_body = timed(write_csv)
+    csv_load_seconds, _ = timed(lambda: process.read_csv_compact(io.BytesIO(csv_body)))
+    print(f"[INFO] csv:          {len(csv_body) / 1e6:6.2f} MB, write {csv_write_seconds:.3f}s, load {csv_load_seconds:.3f}s")
+    for compression in ('zstd', 'snappy'):
+        write_seconds, body = timed(lambda: write_parquet(compression))
+        load_seconds, _ = timed(lambda: process.read_parquet_compact(io.BytesIO(body)))
+        print(f"[INFO] parquet/{compression:<6}: {len(body) / 1e6:6.2f} MB, write {write_seconds:.3f}s, load {load_seconds:.3f}s "
+              f"({len(csv_body) / len(body):.1f}x smaller, {csv_load_seconds / load_seconds:.1f}x faster load)")
+    return True
+
+
+# Cold-start budgets per phase, in milliseconds of import and init time in a fresh interpreter
+startup_budget_ms = {'main': 100, 'refresh': 500, 'gather': 1500, 'process': 1500}
+startup_phases = {
+    'main': 'import main',
+    'refresh': 'import main, refresh; refresh.refresh_destinations()',
+    'gather': 'import main, gather',
+    'process': 'import main, process; process.clean_text("<b>warm</b> up")',
+}
+heavy_modules = ('pandas', 'numpy', 'pyarrow', 'bs4', 'nltk', 'fuzzywuzzy', 'rapidfuzz', 'requests', 'boto3')
+
+
+def bench_startup(repeat=3):
+    """Cold start: import and init time of each phase in a fresh interpreter, checked against startup_budget_ms."""
+    print("\n=== Startup ===")
+    import json
+    import subprocess
+
+    within_budget = True
+    for phase, code in startup_phases.items():
+        probe = (f"import json, sys, time\nstart = time.perf_counter()\n{code}\n"
+                 f"print(json.dumps([time.perf_counter() - start, [m for m in {heavy_modules!r} if m in sys.modules]]))")
+        best = None
+        for _ in range(repeat):
+            output = subprocess.run([sys.executable, '-c', probe], capture_output=True, text=True, check=True).stdout
+            seconds, loaded = json.loads(output.strip().splitlines()[-1])
+            best = seconds if best is None else min(best, seconds)
+        budget = startup_budget_ms[phase]
+        ok = best * 1000 <= budget
+        within_budget = within_budget and ok
+        print(f"{'[OK]' if ok else '[FAIL]'} {phase:<8} {best * 1000:7.1f} ms (budget {budget} ms), loads {', '.join(loaded) or 'nothing heavy'}")
+    return within_budget
+
+
+def run_all_benchmarks():
+    print("=" * 60)
+    print("CHANSCOPE LAMBDA BENCHMARKS")
+    print("=" * 60)
+
+    benchmarks = {
+        "Gather Timestamps": bench_gather_timestamps,
+        "Phrase Matching": bench_phrase_matching,
+        "Text Normalization": bench_text_normalization,
+        "Text Statistics": bench_text_stats,
+        "Output Formats": bench_output_formats,
+        "Startup": bench_startup,
+    }
+    results = {}
+    for name, bench in benchmarks.items():
+        try:
+            results[name] = bench()
+        except Exception as e:
+            print(f"[FAIL] {name}: {e}")
+            traceback.print_exc()
+            results[name] = False
+
+    print("\n" + "=" * 60)
+    print("SUMMARY")
+    print("=" * 60)
+    for name, passed in results.items():
+        print(f"{'[PASS]' if passed else '[FAIL]'} {name}")
+    return all(results.values())
+
+
+if __name__ == "__main__":
+    success = run_all_benchmarks()
+    sys.exit(0 if success else 1)
@@ -7,10 +7,21 @@ import configparser
 import logging
 import datetime
 import warnings
+import threading
+import time
+import traceback
+import gzip
+from collections import deque
+from itertools import islice
+import numpy as np
 import pandas as pd
 
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+from requests.adapters import HTTPAdapter
 from botocore.exceptions import ClientError
-from utils import read_config, supportingcols, get_dateRange, remove_omit_ids
+from utils import read_config, supportingcols, get_dateRange, remove_omit_ids, string_to_bool, load_json_state, save_json_state, S3MultipartWriter, ParquetBatchWriter, api_timezone
+import metrics
 
 s3 = boto3.client('s3')
 
@@ -19,8 +30,26 @@ config_path = 'config.ini'
 general = read_config(section='general', config_path=config_path)
 threads = read_config(section='thread_info', config_path=config_path)
 s3_info = read_config(section='s3', config_path=config_path)
+board_specific = read_config(section='board_specific', config_path=config_path)
+renamed = read_config(section='renamed', config_path=config_path)
 
 url = general['url']
+weekday_names = np.array(['Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun'])
+concurrency = int(general.get('concurrency', 16))
+request_timeout = int(general.get('request_timeout', 30))
+incremental_gather = string_to_bool(general.get('incremental_gather', 'True'))
+conditional_requests = string_to_bool(general.get('conditional_requests', 'True'))
+stream_gather = string_to_bool(general.get('stream_gather', 'False'))
+multipart_chunk_mb = int(general.get('multipart_chunk_mb', 8))
+output_format = general.get('output_format', 'csv').strip().lower()
+parquet_compression = general.get('parquet_compression', 'zstd')
+board_concurrency = int(general.get('board_concurrency', 5))
+# Threads submitted ahead of the writer in fetch_threads
+fetch_window = 2 * concurrency
+rate_limit_rps = float(general.get('rate_limit_rps', 1))
+rate_limit_burst = int(general.get('rate_limit_burst', 5))
+# Gather stops requesting threads once less than this much of the invocation remains
+gather_time_reserve_ms = int(general.get('gather_time_reserve_seconds', 120)) * 1000
 thread_keys = threads['threads_key']
 thread_number = threads['thread_number_key']
 thread_cmt_number = threads['thread_cmt_number_key']
@@ -29,6 +58,8 @@ posted_dt = threads['posted_dt_key']
 date_ = threads['date_key']
 now_ = threads['now_key']
 time_ = threads['time_key']
+# Columns filled in by process rather than gather
+derived_columns = {threads['text_clean'], threads['matches'], 'category', 'similarity', 'word_cnt', 'char_cnt', 'stopwords_count'}
 
 omit_ids = threads['omit_ids'].split(',') if 'omit_ids' in threads else []
 boards = threads['boards'].split(',') if 'boards' in threads else []
@@ -36,55 +67,405 @@ boards = threads['boards'].split(',') if 'boards' in threads else []
 bucket_name = s3_info['bucket']
 raw_prefix = s3_info['raw_prefix']
 path_padding = s3_info['padding_data']
+state_prefix = s3_info.get('state_prefix', 'state')
 
-def safe_to_datetime(column, format='%Y-%m-%d %H:%M:%S', utc=False):
-    if utc:
-        return pd.to_datetime(column, format=format, errors='coerce', utc=True).dt.floor('min')
-    else:
-        return pd.to_datetime(column, format=format, errors='coerce').dt.floor('min')
+_sessions = {}
+_sessions_lock = threading.Lock()
 
-def handle_gather(event, context):
-    s3 = boto3.client('s3')
-    for _board_ in boards:
-        response = requests.get(f'{url}/{_board_}/catalog.json')
-        if response.status_code != 200:
-            print(f"Failed to fetch catalog for board {_board_}: {response.status_code}")
-            continue
-        try:
-            response_json_threads = response.json()
-        except ValueError as e:
-            print(f"JSON decoding failed for board {_board_}: {str(e)}")
-            continue
-        thread_no = [line.get(thread_number) for post_item in response_json_threads for line in post_item.get(thread_keys, []) if thread_number in line]
-        data_all = []
-        for item in thread_no:
-            response_json_items = requests.get(f'{url}/{_board_}/thread/{item}.json')
-            if response_json_items.status_code != 200:
-                print(f"Failed to fetch thread {item} for board {_board_}: {response_json_items.status_code}")
-                continue
-            try:
-                data_json = response_json_items.json()
-                data_all.extend(data_json.get(thread_cmt_number, []))
-            except ValueError as e:
-                print(f"JSON decoding failed for thread {item}: {str(e)}")
-                continue
-        data = pd.DataFrame(data_all)
-        current_date = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+def get_session(target_url):
+    """
+    Returns the keep-alive session for the host of target_url, creating it on first use.
+    Sessions are shared by all fetch threads and survive warm Lambda invocations. The pool holds
+    a connection for every fetch thread of every board gathered at once.
+    """
+    host = urlparse(target_url).netloc
+    with _sessions_lock:
+        session = _sessions.get(host)
+        if session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=concurrency * board_concurrency)
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            session.hooks['response'].append(metrics.count_http_response)
+            _sessions[host] = session
+    return session
+
+class TokenBucket:
+    """
+    Thread-safe token bucket shared by every request gather makes, across all boards.
+    Tokens refill at `rate` per second up to `burst`. acquire() blocks until a token is
+    available and returns the seconds spent waiting. A rate of 0 disables throttling.
+    """
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.capacity = max(burst, 1)
+        self.tokens = float(self.capacity)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        if self.rate <= 0:
+            return 0.0
+        waited = 0.0
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return waited
+                delay = (1 - self.tokens) / self.rate
+            time.sleep(delay)
+            waited += delay
+
+rate_limiter = TokenBucket(rate_limit_rps, rate_limit_burst)
+_stats_lock = threading.Lock()
+
+def add_stat(stats, key, value):
+    with _stats_lock:
+        stats[key] = stats.get(key, 0) + value
+
+NOT_MODIFIED = object()
+
+def conditional_get(target_url, validators, pending, stats):
+    """
+    GETs target_url with If-None-Match/If-Modified-Since from the validator cache, after
+    taking a token from the shared rate limiter. Validators from a 200 response are staged
+    in pending until the caller commits them.
+    """
+    add_stat(stats, 'throttle_wait_seconds', rate_limiter.acquire())
+    add_stat(stats, 'requests', 1)
+    headers = {}
+    cached = validators.get(target_url)
+    if cached:
+        if cached.get('etag'):
+            headers['If-None-Match'] = cached['etag']
+        if cached.get('last_modified'):
+            headers['If-Modified-Since'] = cached['last_modified']
+    with metrics.step('gather.fetch'):
+        response = get_session(target_url).get(target_url, headers=headers, timeout=request_timeout)
+    if response.status_code == 200 and conditional_requests:
+        fresh = {'etag': response.headers.get('ETag'), 'last_modified': response.headers.get('Last-Modified')}
+        if fresh['etag'] or fresh['last_modified']:
+            pending[target_url] = fresh
+    return response
+
+def fetch_thread(board, item, validators, pending, stats):
+    """
+    Fetches the posts of a single thread. Returns NOT_MODIFIED on a 304, and None when
+    the thread could not be fetched or decoded.
+    """
+    thread_url = f'{url}/{board}/thread/{item}.json'
+    try:
+        response = conditional_get(thread_url, validators, pending, stats)
+    except requests.RequestException as e:
+        print(f"Request failed for thread {item} on board {board}: {str(e)}")
+        return None
+    if response.status_code == 304:
+        return NOT_MODIFIED
+    if response.status_code != 200:
+        print(f"Failed to fetch thread {item} for board {board}: {response.status_code}")
+        return None
+    try:
+        return response.json().get(thread_cmt_number, [])
+    except ValueError as e:
+        print(f"JSON decoding failed for thread {item}: {str(e)}")
+        return None
+
+def fetch_threads(board, thread_no, validators, pending, stats, context=None):
+    """
+    Fetches threads with at most `concurrency` requests in flight.
+    Yields (thread number, posts or NOT_MODIFIED) in catalog order; failed threads are skipped.
+    At most fetch_window threads are submitted ahead of the consumer, so fetched posts waiting to be
+    written stay bounded however long the catalog is. Once the Lambda context has less than
+    gather_time_reserve_ms left, no more threads are submitted and `deadline_reached` is set in stats.
+    """
+    items = iter(thread_no)
+    window = deque()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        def submit(item):
+            if context is not None and context.get_remaining_time_in_millis() < gather_time_reserve_ms:
+                if not stats.get('deadline_reached'):
+                    print(f"Board {board}: stopping thread requests near the Lambda deadline")
+                    stats['deadline_reached'] = True
+                return
+            window.append((item, executor.submit(fetch_thread, board, item, validators, pending, stats)))
+
+        for item in islice(items, fetch_window):
+            submit(item)
+        while window:
+            item, future = window.popleft()
+            posts = future.result()
+            for next_item in islice(items, 1):
+                submit(next_item)
+            if posts is not None:
+                yield item, posts
+
+_validator_cache = {}
+
+def validators_key(board):
+    return f'{state_prefix}/{board}_http_validators.json'
+
+def load_validators(s3, board):
+    """
+    Returns the URL -> {etag, last_modified} cache for a board. Warm containers reuse
+    the in-memory copy; cold starts load it from S3.
+    """
+    if not conditional_requests:
+        return {}
+    if board not in _validator_cache:
+        _validator_cache[board] = load_json_state(s3, bucket_name, validators_key(board))
+    return _validator_cache[board]
+
+def commit_validators(s3, board, validators, pending, live_urls):
+    """Adds the validators staged during this run, drops those of dead URLs and saves the cache to S3."""
+    if not conditional_requests:
+        return
+    validators.update(pending)
+    # Drop validators of threads that fell off the catalog
+    for cached_url in [cached_url for cached_url in validators if cached_url not in live_urls]:
+        del validators[cached_url]
+    save_json_state(s3, bucket_name, validators_key(board), validators)
+
+def thread_state_key(board):
+    return f'{state_prefix}/{board}_thread_state.json'
+
+def changed_threads(catalog_threads, thread_state):
+    """
+    Returns the catalog threads that are new or whose last_modified/replies differ from the stored state.
+    """
+    changed = []
+    for line in catalog_threads:
+        previous = thread_state.get(str(line[thread_number]))
+        if previous is None or previous.get('last_modified') != line.get('last_modified') or previous.get('replies') != line.get('replies'):
+            changed.append(line)
+    return changed
+
+# Numeric raw columns. Other raw columns that are empty in the first batch of a streamed Parquet
+# file are written as strings
+raw_dtypes = {thread_number: 'uint32', 'replies': 'UInt32'}
+
+def raw_columns(board):
+    """
+    Returns the raw (pre-rename) columns process needs for a board, in a fixed order.
+    Streamed raw files are written with exactly these columns.
+    """
+    original_names = {new: old for old, new in renamed.items()}
+    columns = [original_names.get(col.strip(), col.strip()) for col in board_specific[f'{board}_keys'].split(',')]
+    return [col for col in columns if col not in derived_columns]
+
+def derive_timestamps(data):
+    """
+    Derives the date, now (weekday), time and posted_date_time columns from the API's epoch
+    `time` field. 4chan's locale `now` string is Eastern time, so posted_date_time is kept as
+    naive America/New_York wall-clock time to match it.
+    """
+    posted = pd.to_datetime(data[time_], unit='s', utc=True).dt.tz_convert(api_timezone).dt.tz_localize(None)
+    # Slice fixed-width 'YYYY-MM-DDTHH:MM:SS' strings instead of calling strftime per row
+    chars = np.datetime_as_string(posted.to_numpy(dtype='datetime64[s]'), unit='s').astype('U19').view('U1').reshape(-1, 19)
+    slash = np.full((len(chars), 1), '/')
+    dates = np.hstack([chars[:, 5:7], slash, chars[:, 8:10], slash, chars[:, 2:4]]).view('U8').ravel()
+    times = np.ascontiguousarray(chars[:, 11:19]).view('U8').ravel()
+    weekdays = weekday_names[posted.dt.dayofweek.fillna(0).astype(int).to_numpy()]
+    valid = posted.notna().to_numpy()
+    if not valid.all():
+        dates, times, weekdays = (np.where(valid, values.astype(object), None) for values in (dates, times, weekdays))
+    data[posted_dt] = posted
+    data[date_] = dates
+    data[now_] = weekdays
+    data[time_] = times
+    return data
+
+def normalize_posts(posts, current_date):
+    with metrics.step('gather.parse') as step:
+        data = pd.DataFrame(posts)
         data[collected_dt] = pd.to_datetime(current_date).floor('min')
-        data[[date_, now_]] = data[now_].str.split('(', expand=True)
-        data[[now_, time_]] = data[now_].str.split(')', expand=True)
-        data[posted_dt] = pd.to_datetime(data[date_] + data[time_], format='%m/%d/%y%H:%M:%S')
-        data[time_] = safe_to_datetime(data[time_], utc=True).apply(lambda x: x.strftime("%H:%M:%S") if pd.notnull(x) else None)
+        data = derive_timestamps(data)
         data = remove_omit_ids(data, 'no', omit_ids)
-        filename = f'{_board_}_{path_padding}_{current_date}.csv'
-        local_path = f'/tmp/{filename}'
-        # Use forward slashes explicitly for S3 keys (not os.path.join which uses backslashes on Windows)
-        s3_key = f'{raw_prefix}/{_board_}_{path_padding}_{current_date}.csv'
-        try:
-            data.to_csv(local_path, index=False)
+        step.add('rows_in', len(posts))
+        step.add('rows_out', len(data))
+    return data
+
+def write_raw_batch(s3, board, batches, current_date):
+    """
+    Collects every batch into one frame and uploads it as a single CSV, or Parquet when
+    output_format is parquet. The file has the board's raw_columns even when every post is a reply
+    without the OP-only fields. Returns the number of rows written, or None when the upload failed.
+    """
+    data_all = [post for batch in batches for post in batch]
+    if not data_all:
+        return 0
+    data = normalize_posts(data_all, current_date).reindex(columns=raw_columns(board))
+    extension = 'parquet' if output_format == 'parquet' else 'csv'
+    filename = f'{board}_{path_padding}_{current_date}.{extension}'
+    local_path = f'/tmp/{filename}'
+    # Use forward slashes explicitly for S3 keys (not os.path.join which uses backslashes on Windows)
+    s3_key = f'{raw_prefix}/{board}_{path_padding}_{current_date}.{extension}'
+    try:
+        with metrics.step('gather.upload') as step:
+            if output_format == 'parquet':
+                data.to_parquet(local_path, index=False, compression=parquet_compression)
+            else:
+                data.to_csv(local_path, index=False)
             with open(local_path, "rb") as f:
                 s3.upload_fileobj(f, bucket_name, s3_key)
-            print(f"File saved and uploaded for board {_board_}: local_path {local_path} : s3_key {s3_key}")
-        except ClientError as e:
-            print(f"Failed to upload file to S3 for board {_board_}: {str(e)}")
-    return "Gather completed"
\ No newline at end of file
+            step.add('rows_out', len(data))
+        print(f"File saved and uploaded for board {board}: local_path {local_path} : s3_key {s3_key}")
+    except ClientError as e:
+        print(f"Failed to upload file to S3 for board {board}: {str(e)}")
+        return None
+    return len(data)
+
+def write_raw_stream(s3, board, batches, current_date):
+    """
+    Normalizes each thread batch as it arrives and appends it to a gzip-compressed CSV, or to a
+    Parquet file with one row group per thread when output_format is parquet. The file is
+    uploaded part by part while fetching continues, so memory stays bounded by the part size.
+    Returns the number of rows written, or None when the upload failed.
+    """
+    extension = 'parquet' if output_format == 'parquet' else 'csv.gz'
+    s3_key = f'{raw_prefix}/{board}_{path_padding}_{current_date}.{extension}'
+    columns = raw_columns(board)
+    writer = None
+    rows = 0
+    try:
+        for batch in batches:
+            data = normalize_posts(batch, current_date).reindex(columns=columns)
+            if data.empty:
+                continue
+            if writer is None:
+                writer = S3MultipartWriter(s3, bucket_name, s3_key, part_size=multipart_chunk_mb * 1024 * 1024)
+                if output_format == 'parquet':
+                    compressed = ParquetBatchWriter(writer, compression=parquet_compression, dtypes=raw_dtypes)
+                else:
+                    compressed = gzip.GzipFile(fileobj=writer, mode='wb')
+            with metrics.step('gather.upload') as step:
+                if output_format == 'parquet':
+                    compressed.write(data)
+                else:
+                    compressed.write(data.to_csv(index=False, header=rows == 0).encode('utf-8'))
+                step.add('rows_out', len(data))
+            rows += len(data)
+        if writer is None:
+            return 0
+        with metrics.step('gather.upload'):
+            compressed.close()
+            writer.close()
+    except ClientError as e:
+        print(f"Failed to stream file to S3 for board {board}: {str(e)}")
+        if writer is not None:
+            writer.abort()
+        return None
+    except Exception:
+        if writer is not None:
+            writer.abort()
+        raise
+    print(f"Streamed {rows} rows for board {board} in {len(writer.parts)} parts: s3_key {s3_key}")
+    return rows
+
+def gather_board(s3, _board_, context=None):
+    """
+    Gathers one board and returns its stats: status, request and row counts, and the
+    seconds spent waiting on the shared rate limiter. Near the Lambda deadline the threads fetched
+    so far are written and their state committed; the rest stay changed for the next run.
+    """
+    stats = {'status': 'failed', 'requests': 0, 'throttle_wait_seconds': 0.0}
+    catalog_url = f'{url}/{_board_}/catalog.json'
+    validators = load_validators(s3, _board_)
+    pending = {}
+    try:
+        response = conditional_get(catalog_url, validators, pending, stats)
+    except requests.RequestException as e:
+        print(f"Request failed for catalog of board {_board_}: {str(e)}")
+        return stats
+    if response.status_code == 304:
+        print(f"Catalog for board {_board_} not modified since last run")
+        stats['status'] = 'not_modified'
+        return stats
+    if response.status_code != 200:
+        print(f"Failed to fetch catalog for board {_board_}: {response.status_code}")
+        return stats
+    try:
+        response_json_threads = response.json()
+    except ValueError as e:
+        print(f"JSON decoding failed for board {_board_}: {str(e)}")
+        return stats
+    catalog_threads = [line for post_item in response_json_threads for line in post_item.get(thread_keys, []) if thread_number in line]
+
+    thread_state = load_json_state(s3, bucket_name, thread_state_key(_board_)) if incremental_gather else {}
+    to_fetch = changed_threads(catalog_threads, thread_state)
+    print(f"Board {_board_}: {len(to_fetch)} of {len(catalog_threads)} catalog threads are new or changed")
+    stats.update({'catalog_threads': len(catalog_threads), 'changed_threads': len(to_fetch)})
+
+    # Threads that dropped off the catalog are pruned; unchanged and failed threads keep their previous state
+    new_state = {str(line[thread_number]): thread_state[str(line[thread_number])] for line in catalog_threads if str(line[thread_number]) in thread_state}
+    not_modified = []
+    fetched = set()
+
+    def new_posts():
+        for item, posts in fetch_threads(_board_, [line[thread_number] for line in to_fetch], validators, pending, stats, context):
+            fetched.add(str(item))
+            if posts is NOT_MODIFIED:
+                # Keep the previous state so the thread is checked again next run
+                not_modified.append(item)
+                continue
+            last_post = thread_state.get(str(item), {}).get('last_post', 0)
+            new_state[str(item)] = {'last_post': max([post.get(thread_number, 0) for post in posts] + [last_post])}
+            batch = [post for post in posts if post.get(thread_number, 0) > last_post]
+            if batch:
+                yield batch
+
+    current_date = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    write_raw = write_raw_stream if stream_gather else write_raw_batch
+    rows = write_raw(s3, _board_, new_posts(), current_date)
+    if not_modified:
+        print(f"Board {_board_}: {len(not_modified)} threads not modified (304)")
+    stats['not_modified_threads'] = len(not_modified)
+    if rows is None:
+        return stats
+    stats.update({'status': 'uploaded' if rows else 'no_new_posts', 'rows': rows})
+    if rows == 0:
+        print(f"No new posts for board {_board_}")
+
+    # Threads that failed or were not requested before the deadline keep their previous state
+    for line in to_fetch:
+        if str(line[thread_number]) in fetched and str(line[thread_number]) in new_state:
+            new_state[str(line[thread_number])].update({'last_modified': line.get('last_modified'), 'replies': line.get('replies')})
+    live_urls = {catalog_url} | {f'{url}/{_board_}/thread/{line[thread_number]}.json' for line in catalog_threads}
+    # Only advance the thread state and validators once the posts they cover are safely in S3
+    if incremental_gather:
+        save_json_state(s3, bucket_name, thread_state_key(_board_), new_state)
+    commit_validators(s3, _board_, validators, pending, live_urls)
+    return stats
+
+def timed_gather_board(s3, _board_, context=None):
+    start = time.perf_counter()
+    try:
+        stats = gather_board(s3, _board_, context)
+    except Exception as e:
+        print(f"Gather failed for board {_board_}: {str(e)}")
+        traceback.print_exc()
+        stats = {'status': 'failed', 'error': str(e)}
+    stats['seconds'] = round(time.perf_counter() - start, 3)
+    if 'throttle_wait_seconds' in stats:
+        stats['throttle_wait_seconds'] = round(stats['throttle_wait_seconds'], 3)
+    print(f"Board {_board_} finished in {stats['seconds']}s: {stats}")
+    return stats
+
+def handle_gather(event, context):
+    """
+    Gathers all boards at the same time. Each board runs independently so a slow board does not
+    stall the others, while the shared rate limiter keeps total request rate within budget.
+    """
+    s3 = boto3.client('s3')
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=max(1, min(board_concurrency, len(boards)))) as executor:
+        futures = {_board_: executor.submit(timed_gather_board, s3, _board_, context) for _board_ in boards}
+    board_results = {_board_: future.result() for _board_, future in futures.items()}
+    return {
+        'status': 'Gather completed',
+        'seconds': round(time.perf_counter() - start, 3),
+        'throttle_wait_seconds': round(sum(stats.get('throttle_wait_seconds', 0) for stats in board_results.values()), 3),
+        'boards': board_results,
+    }
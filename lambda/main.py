@@ -1,15 +1,23 @@
 import os
 import traceback
-import gather
-import process
-import refresh
+import metrics
 
 
 def lambda_handler(event, context):
     """
     Main Lambda handler that orchestrates gather, process, and refresh operations.
-    Each handler is executed independently to isolate failures.
+    Each handler is executed independently to isolate failures. An event `phases` list
+    (e.g. ["refresh"]) runs only the named phases. Phase modules are imported when their phase
+    first runs, so an invocation only loads the dependencies of the phases it runs.
+    A `dryRun` event runs only refresh, which prints its plan without writing; gather and
+    process always write, so they are skipped.
+    Per-phase metrics are printed as CloudWatch EMF lines and returned under `metrics`.
     """
+    phases = event.get('phases', ['gather', 'process', 'refresh'])
+    if event.get('dryRun', False):
+        phases = [phase for phase in phases if phase == 'refresh']
+    metrics.reset()
+    metrics.instrument_boto3()
     results = {
         'gather_result': None,
         'process_result': None,
@@ -18,39 +26,50 @@ def lambda_handler(event, context):
     }
     
     # Gather phase
-    try:
-        print("Starting gather phase...")
-        results['gather_result'] = gather.handle_gather(event, context)
-        print(f"Gather completed: {results['gather_result']}")
-    except Exception as e:
-        error_msg = f"Gather failed: {str(e)}"
-        print(error_msg)
-        traceback.print_exc()
-        results['errors'].append({'phase': 'gather', 'error': str(e)})
+    if 'gather' in phases:
+        try:
+            print("Starting gather phase...")
+            with metrics.step('gather'):
+                import gather
+                results['gather_result'] = gather.handle_gather(event, context)
+            print(f"Gather completed: {results['gather_result']}")
+        except Exception as e:
+            error_msg = f"Gather failed: {str(e)}"
+            print(error_msg)
+            traceback.print_exc()
+            results['errors'].append({'phase': 'gather', 'error': str(e)})
     
     # Process phase
-    try:
-        print("Starting process phase...")
-        results['process_result'] = process.handle_process(event, context)
-        print(f"Process completed: {results['process_result']}")
-    except Exception as e:
-        error_msg = f"Process failed: {str(e)}"
-        print(error_msg)
-        traceback.print_exc()
-        results['errors'].append({'phase': 'process', 'error': str(e)})
+    if 'process' in phases:
+        try:
+            print("Starting process phase...")
+            with metrics.step('process'):
+                import process
+                results['process_result'] = process.handle_process(event, context)
+            print(f"Process completed: {results['process_result']}")
+        except Exception as e:
+            error_msg = f"Process failed: {str(e)}"
+            print(error_msg)
+            traceback.print_exc()
+            results['errors'].append({'phase': 'process', 'error': str(e)})
     
     # Refresh phase
-    try:
-        print("Starting refresh phase...")
-        results['refresh_result'] = refresh.handle_refresh(event, context)
-        print(f"Refresh completed: {results['refresh_result']}")
-    except Exception as e:
-        error_msg = f"Refresh failed: {str(e)}"
-        print(error_msg)
-        traceback.print_exc()
-        results['errors'].append({'phase': 'refresh', 'error': str(e)})
+    if 'refresh' in phases:
+        try:
+            print("Starting refresh phase...")
+            with metrics.step('refresh'):
+                import refresh
+                results['refresh_result'] = refresh.handle_refresh(event, context)
+            print(f"Refresh completed: {results['refresh_result']}")
+        except Exception as e:
+            error_msg = f"Refresh failed: {str(e)}"
+            print(error_msg)
+            traceback.print_exc()
+            results['errors'].append({'phase': 'refresh', 'error': str(e)})
     
     # Summary
+    results['metrics'] = metrics.summary()
+    metrics.emit()
     if results['errors']:
         print(f"Lambda completed with {len(results['errors'])} error(s)")
     else:
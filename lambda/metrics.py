@@ -0,0 +1,188 @@
+"""
+Per-phase performance metrics. Each step (a phase such as `process`, or a sub-step such as
+`process.clean`) records wall time, CPU time and counters: rows in/out, bytes transferred and
+HTTP/S3 calls. Peak RSS is a process-lifetime high-water mark, so it is reported once per
+invocation under `invocation` rather than per step. Records are emitted as CloudWatch Embedded
+Metric Format (EMF) JSON lines on stdout and returned by summary(), so they work the same locally
+without AWS.
+"""
+import json
+import resource
+import threading
+import time
+from contextlib import contextmanager
+from utils import read_config, string_to_bool
+
+config_path = 'config.ini'
+
+general = read_config(section='general', config_path=config_path)
+metrics_enabled = string_to_bool(general.get('metrics', 'True'))
+metrics_namespace = general.get('metrics_namespace', 'Chanscope')
+
+# Record fields published as EMF metrics, with their CloudWatch units
+metric_units = {
+    'wall_ms': 'Milliseconds',
+    'cpu_ms': 'Milliseconds',
+    'peak_rss_mb': 'Megabytes',
+    'workers_peak_rss_mb': 'Megabytes',
+    'calls': 'Count',
+    'rows_in': 'Count',
+    'rows_out': 'Count',
+    'bytes_in': 'Bytes',
+    'bytes_out': 'Bytes',
+    'http_calls': 'Count',
+    's3_calls': 'Count',
+}
+
+_lock = threading.Lock()
+_records = {}
+# Step name -> number of open step() blocks. HTTP and S3 calls are counted against every open step,
+# which also covers calls made from worker threads while their step is open on the caller's thread.
+_active = {}
+_boto3_instrumented = False
+
+def reset():
+    """Clears recorded steps. Called at the start of each invocation, since warm containers keep module state."""
+    with _lock:
+        _records.clear()
+        _active.clear()
+
+def peak_rss_mb(who=resource.RUSAGE_SELF):
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(who).ru_maxrss / 1024
+
+def _add(name, key, value):
+    record = _records.setdefault(name, {})
+    record[key] = record.get(key, 0) + value
+
+def add(name, key, value):
+    if metrics_enabled:
+        with _lock:
+            _add(name, key, value)
+
+def add_active(key, value):
+    """Adds value to key on every open step."""
+    if metrics_enabled:
+        with _lock:
+            for name in _active:
+                _add(name, key, value)
+
+class Step:
+    def __init__(self, name):
+        self.name = name
+
+    def add(self, key, value):
+        add(self.name, key, value)
+
+@contextmanager
+def step(name):
+    """
+    Times a block under `name` (e.g. `process.clean`). Repeated or concurrent blocks with the same
+    name add up. On the main thread, CPU time is the process CPU time used while the block was open,
+    which includes any pool it fans out to. Blocks opened on other threads, such as one per request
+    in gather's fetch pool, count only their own thread's CPU time, since overlapping blocks would
+    otherwise each count every thread's.
+    """
+    if not metrics_enabled:
+        yield Step(name)
+        return
+    with _lock:
+        _active[name] = _active.get(name, 0) + 1
+    cpu_time = time.process_time if threading.current_thread() is threading.main_thread() else time.thread_time
+    wall_start = time.perf_counter()
+    cpu_start = cpu_time()
+    try:
+        yield Step(name)
+    finally:
+        wall_ms = (time.perf_counter() - wall_start) * 1000
+        cpu_ms = (cpu_time() - cpu_start) * 1000
+        with _lock:
+            _add(name, 'calls', 1)
+            _add(name, 'wall_ms', wall_ms)
+            _add(name, 'cpu_ms', cpu_ms)
+            _active[name] -= 1
+            if not _active[name]:
+                del _active[name]
+
+def records():
+    with _lock:
+        return {name: dict(record) for name, record in _records.items()}
+
+def merge(other):
+    """Adds records collected elsewhere, such as in a forked worker process, into this process's records."""
+    if not metrics_enabled:
+        return
+    with _lock:
+        for name, record in other.items():
+            for key, value in record.items():
+                _add(name, key, value)
+
+def invocation_record():
+    """
+    Peak RSS of this process and of its largest finished forked worker. These are high-water marks
+    for the process lifetime, so in a warm container they can come from an earlier invocation.
+    """
+    record = {'peak_rss_mb': peak_rss_mb()}
+    workers_rss = peak_rss_mb(resource.RUSAGE_CHILDREN)
+    if workers_rss:
+        record['workers_peak_rss_mb'] = workers_rss
+    return record
+
+def summary():
+    steps = records()
+    if metrics_enabled:
+        steps['invocation'] = invocation_record()
+    return {name: {key: round(value, 3) if isinstance(value, float) else value for key, value in sorted(record.items())}
+            for name, record in sorted(steps.items())}
+
+def emf_line(name, record, timestamp_ms):
+    phase, _, sub_step = name.partition('.')
+    fields = [key for key in metric_units if key in record]
+    line = {
+        '_aws': {
+            'Timestamp': timestamp_ms,
+            'CloudWatchMetrics': [{
+                'Namespace': metrics_namespace,
+                'Dimensions': [['Phase', 'Step']],
+                'Metrics': [{'Name': key, 'Unit': metric_units[key]} for key in fields],
+            }],
+        },
+        'Phase': phase,
+        'Step': sub_step or 'total',
+    }
+    line.update(record)
+    return json.dumps(line)
+
+def emit():
+    """Prints one EMF line per step, plus the invocation line. In Lambda, CloudWatch Logs turns these into metrics."""
+    timestamp_ms = int(time.time() * 1000)
+    for name, record in summary().items():
+        print(emf_line(name, record, timestamp_ms))
+
+def count_http_response(response, *args, **kwargs):
+    """requests response hook counting calls and response bytes against the open steps."""
+    add_active('http_calls', 1)
+    add_active('bytes_in', len(response.content or b''))
+    return response
+
+def _count_s3_request(request, **kwargs):
+    add_active('bytes_out', int(request.headers.get('Content-Length', 0) or 0))
+
+def _count_s3_response(http_response, **kwargs):
+    add_active('s3_calls', 1)
+    add_active('bytes_in', int(http_response.headers.get('content-length', 0) or 0))
+
+def instrument_boto3():
+    """
+    Registers S3 call and byte counters on boto3's default session. Clients created after this
+    call count their requests, so it runs before any phase creates a client.
+    """
+    global _boto3_instrumented
+    if _boto3_instrumented or not metrics_enabled:
+        return
+    import boto3
+    if boto3.DEFAULT_SESSION is None:
+        boto3.setup_default_session()
+    boto3.DEFAULT_SESSION.events.register('before-send.s3', _count_s3_request)
+    boto3.DEFAULT_SESSION.events.register('after-call.s3', _count_s3_response)
+    _boto3_instrumented = True
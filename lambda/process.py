@@ -2,19 +2,35 @@ import boto3
 import pandas as pd
 import numpy as np
 import io
+import time
+import hashlib
+import multiprocessing
+import sqlite3
+import tempfile
+import shutil
 
 import os
+import sys
 import json
 import glob
 from pathlib import Path
 import configparser
 import warnings
 from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
+from botocore.config import Config
+from botocore.exceptions import ClientError
 
-from utils import read_config, supportingcols, get_dateRange, remove_whitespace, pad_punctuation, normalize_text, remove_omit_ids, flatten_key_phrases
+from utils import read_config, supportingcols, stop_word_set, get_dateRange, clean_text, contraction_map, remove_omit_ids, flatten_key_phrases, string_to_bool, load_json_state, save_json_state, S3MultipartWriter, ParquetBatchWriter, is_parquet, api_timezone
+import metrics
 
 import re
 from fuzzywuzzy import fuzz
+try:
+    from rapidfuzz import fuzz as rapid_fuzz
+    from rapidfuzz.process import cpdist
+except ImportError:
+    cpdist = None
 
 config_path = 'config.ini'
 
@@ -31,6 +47,8 @@ s3_bucket = s3['bucket']
 data_prefix = s3['data_prefix']
 raw_prefix = s3['raw_prefix']
 padding_data = s3['padding_data']
+state_prefix = s3.get('state_prefix', 'state')
+download_workers = int(s3.get('download_workers', 16))
 date_format_ = general['date_format']
 time_format_ = general['time_format']
 time_ = threads['time_key']
@@ -43,97 +61,870 @@ thread_number_key = threads['thread_number_key']
 p_com = threads['p_com']
 matches = threads['matches']
 omit_ids = threads['omit_ids'].split(',') if 'omit_ids' in threads else []
+thread_id_col = renamed.get(thread_number_key, thread_number_key)
+incremental_process = string_to_bool(general.get('incremental_process', 'True'))
+lookback_days = int(general.get('lookback_days', 30))
+match_mode = general.get('match_mode', 'first')
+match_top_k = int(general.get('match_top_k', 3))
+match_threshold = int(general.get('match_threshold', 70))
+# rapidfuzz's partial_ratio is faster but does not always give fuzzywuzzy's score for the same pair
+fast_scorer = string_to_bool(general.get('fast_scorer', 'False')) and cpdist is not None
+scorer_name = 'rapidfuzz' if fast_scorer else 'fuzzywuzzy'
+# Threads rapidfuzz scores with; -1 uses every core, and forked chunk workers use one each
+scorer_workers = -1
+available_cpus = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else (os.cpu_count() or 1)
+process_workers = int(general.get('process_workers', 0)) or available_cpus
+parallel_min_rows = int(general.get('parallel_min_rows', 5000))
+text_cache_enabled = string_to_bool(general.get('text_cache', 'True'))
+text_cache_max_rows = int(general.get('text_cache_max_rows', 500000))
+chunked_process = string_to_bool(general.get('chunked_process', 'False'))
+chunk_memory_mb = int(general.get('chunk_memory_mb', 512))
+multipart_chunk_mb = int(general.get('multipart_chunk_mb', 8))
+output_format = general.get('output_format', 'csv').strip().lower()
+parquet_compression = general.get('parquet_compression', 'zstd')
+output_extension = 'parquet' if output_format == 'parquet' else 'csv'
+processed_layout = general.get('processed_layout', 'single').strip().lower()
+# Both write one file per day; `dated` puts the date first in the key so listings can be pruned by date
+partitioned_layouts = ('partitioned', 'dated')
+# Hive's name for the partition of rows whose partition value is missing
+null_partition = '__HIVE_DEFAULT_PARTITION__'
 
 with open('key_phrases.json', 'r') as f:
     key_phrases = json.load(f)
 
+# Compact dtypes for raw and processed columns, applied when files are read. Post numbers fit in
+# uint32, and columns with a few distinct values are stored as categoricals. Columns that are not
+# listed keep pandas' defaults.
+column_dtypes = {
+    thread_number_key: 'uint32',
+    thread_id_col: 'uint32',
+    'replies': 'UInt32',
+    'country': 'category',
+    'flag_name': 'category',
+    'board_flag': 'category',
+    'matches': 'category',
+    'category': 'category',
+    'word_cnt': 'uint32',
+    'char_cnt': 'uint32',
+    'stopwords_count': 'uint32',
+}
+if match_mode != 'topk':
+    column_dtypes['similarity'] = 'UInt8'
+datetime_columns = [posted_date_time, threads['collected_dt_key']]
+
+def raw_usecols(board):
+    """Raw (pre-rename) columns process loads for a board: its [board_specific] keys plus the dedup keys."""
+    original_names = {new: old for old, new in renamed.items()}
+    columns = {original_names.get(col.strip(), col.strip()) for col in board_specific[f'{board}_keys'].split(',')}
+    return columns | {thread_number_key, posted_date_time, date_}
+
+def read_csv_compact(source, usecols=None, **kwargs):
+    """read_csv with column_dtypes applied and, if usecols is given, only those columns loaded."""
+    return pd.read_csv(source, encoding='utf8', dtype=column_dtypes,
+                       usecols=(lambda column: column in usecols) if usecols else None, **kwargs)
+
+def read_parquet_compact(source, usecols=None):
+    """Reads a Parquet file, loading only the columns in usecols when it is given."""
+    import pyarrow.parquet as pq
+    parquet = pq.ParquetFile(source)
+    columns = [column for column in parquet.schema_arrow.names if not usecols or column in usecols]
+    return parquet.read(columns=columns).to_pandas()
+
+def iter_parquet_batches(source, sizer, usecols=None):
+    """Yields DataFrames of about sizer.rows rows from a Parquet file, read in 1,000-row record batches."""
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    parquet = pq.ParquetFile(source)
+    columns = [column for column in parquet.schema_arrow.names if not usecols or column in usecols]
+    pending = []
+    pending_rows = 0
+    for record_batch in parquet.iter_batches(batch_size=1000, columns=columns):
+        pending.append(record_batch)
+        pending_rows += record_batch.num_rows
+        if pending_rows >= sizer.rows:
+            yield pa.Table.from_batches(pending).to_pandas()
+            pending = []
+            pending_rows = 0
+    if pending:
+        yield pa.Table.from_batches(pending).to_pandas()
+
+def apply_schema(data):
+    """
+    Casts columns to column_dtypes and parses datetime_columns. Used after concat, where
+    categoricals with different categories fall back to object.
+    """
+    dtypes = {column: dtype for column, dtype in column_dtypes.items()
+              if column in data.columns and str(data[column].dtype) != dtype}
+    if 'similarity' in dtypes:
+        data = data.assign(similarity=pd.to_numeric(data['similarity']))
+    data = data.astype(dtypes)
+    for column in datetime_columns:
+        if column in data.columns and not pd.api.types.is_datetime64_any_dtype(data[column]):
+            data[column] = pd.to_datetime(data[column], format='ISO8601', errors='coerce')
+    return data
+
+def to_csv_text(data, header=True):
+    """
+    to_csv that keeps the time part of datetime_columns. pandas drops it when every value in a
+    column falls on midnight, which would change the format of a batch collected at 00:00.
+    """
+    midnight_only = {column: data[column].dt.strftime('%Y-%m-%d %H:%M:%S') for column in datetime_columns
+                     if column in data.columns and pd.api.types.is_datetime64_any_dtype(data[column])
+                     and (data[column].dt.normalize() == data[column]).all()}
+    return data.assign(**midnight_only).to_csv(index=False, header=header)
+
+def default_memory_usage(data):
+    """
+    Estimates the bytes data would take with pandas' default dtypes: 8-byte numbers and Python
+    strings for categorical and datetime columns.
+    """
+    total = 0
+    for column in data.columns:
+        series = data[column]
+        if isinstance(series.dtype, pd.CategoricalDtype):
+            # The trailing entry is picked by the -1 code of missing values
+            sizes = np.array([sys.getsizeof(value) for value in series.cat.categories] + [sys.getsizeof(np.nan)])
+            total += 8 * len(series) + int(sizes[series.cat.codes.to_numpy()].sum())
+        elif pd.api.types.is_datetime64_any_dtype(series):
+            total += len(series) * (8 + sys.getsizeof('2026-01-15 10:00:00'))
+        elif pd.api.types.is_numeric_dtype(series):
+            total += 8 * len(series)
+        else:
+            total += int(series.memory_usage(deep=True, index=False))
+    return total
+
+def manifest_key(board):
+    return f"{state_prefix}/{board}_process_manifest.json"
+
+_s3_client = None
+
+def get_s3_client():
+    """
+    Returns the S3 client shared by all loader threads. Its connection pool is sized to the
+    worker count so concurrent downloads reuse connections instead of queueing for one.
+    """
+    global _s3_client
+    if _s3_client is None:
+        _s3_client = boto3.client('s3', config=Config(max_pool_connections=download_workers,
+                                                      retries={'max_attempts': 5, 'mode': 'adaptive'}))
+    return _s3_client
+
+def read_raw_object(s3_client, key, usecols=None):
+    body = s3_client.get_object(Bucket=s3_bucket, Key=key)['Body'].read()
+    if is_parquet(key, body):
+        return apply_schema(read_parquet_compact(io.BytesIO(body), usecols)), len(body)
+    compression = 'gzip' if key.endswith('.gz') else None
+    return apply_schema(read_csv_compact(io.BytesIO(body), usecols, compression=compression)), len(body)
+
+def load_raw_objects(keys, usecols=None):
+    """
+    Downloads and parses raw files concurrently on a bounded thread pool. Frames are returned in
+    the order of keys; files that fail to load are logged and skipped.
+    Returns (frames, rows per key, load stats).
+    """
+    s3_client = get_s3_client()
+
+    def load(key):
+        try:
+            return read_raw_object(s3_client, key, usecols)
+        except Exception as e:
+            print(f"  ERROR reading {key}: {str(e)}")
+            return None
+
+    start = time.perf_counter()
+    with metrics.step('process.download') as step:
+        with ThreadPoolExecutor(max_workers=download_workers) as executor:
+            results = list(executor.map(load, keys))
+        step.add('rows_out', sum(len(result[0]) for result in results if result is not None))
+    elapsed = max(time.perf_counter() - start, 1e-9)
+
+    object_lists = []
+    rows_by_key = {}
+    total_bytes = 0
+    for key, result in zip(keys, results):
+        if result is None:
+            continue
+        data, size = result
+        print(f"  Loaded {len(data)} rows from {key}")
+        object_lists.append(data)
+        rows_by_key[key] = len(data)
+        total_bytes += size
+    load_stats = {
+        'files_loaded': len(object_lists),
+        'bytes_loaded': total_bytes,
+        'load_seconds': round(elapsed, 3),
+        'files_per_sec': round(len(object_lists) / elapsed, 2),
+        'bytes_per_sec': round(total_bytes / elapsed, 2),
+    }
+    print(f"Loaded {len(object_lists)} files ({total_bytes} bytes) in {elapsed:.2f}s: "
+          f"{load_stats['files_per_sec']} files/sec, {load_stats['bytes_per_sec']} bytes/sec")
+    return object_lists, rows_by_key, load_stats
+
+def within_retention(data):
+    """
+    Drops rows posted more than lookback_days ago. Rows without a posted_date_time are kept.
+    """
+    cutoff = pd.Timestamp.now(tz=api_timezone).tz_localize(None) - pd.Timedelta(days=lookback_days)
+    return data[~(data[posted_date_time] < cutoff)]
+
+def merge_processed(s3_resource, existing_key, data):
+    """
+    Merges newly processed rows into the board's existing processed file.
+    New rows win when a (thread_id, posted_date_time) pair appears in both, and existing rows
+    older than lookback_days are dropped so the file does not grow without bound.
+    """
+    try:
+        body = s3_resource.Object(s3_bucket, existing_key).get()['Body'].read()
+    except s3_resource.meta.client.exceptions.NoSuchKey:
+        print(f"Previous processed file {existing_key} not found, writing new rows only")
+        return data
+    if is_parquet(existing_key, body):
+        existing = apply_schema(read_parquet_compact(io.BytesIO(body)))
+    else:
+        existing = apply_schema(read_csv_compact(io.BytesIO(body)))
+    retained = within_retention(existing)
+    if len(retained) < len(existing):
+        print(f"Dropping {len(existing) - len(retained)} rows posted more than {lookback_days} days ago from {existing_key}")
+    existing = retained
+    print(f"Merging {len(data)} new rows into {len(existing)} existing rows from {existing_key}")
+    # Processed files store ISO dates while fresh rows still carry the raw date format
+    existing[date_] = pd.to_datetime(existing[date_])
+    data = data.assign(**{date_: pd.to_datetime(data[date_])})
+    merged = apply_schema(pd.concat([existing, data], ignore_index=True))
+    return merged.drop_duplicates(subset=[thread_id_col, posted_date_time], keep='last')
+
+def partition_manifest_key(board):
+    return f"{state_prefix}/{board}_partitions.json"
+
+def partition_key(board, day):
+    if processed_layout == 'dated':
+        return f"{data_prefix}/date={day}/board={board}/part-0000.{output_extension}"
+    return f"{data_prefix}/board={board}/date={day}/part-0000.{output_extension}"
+
+def partition_days(data):
+    """The date partition of each row, taken from posted_date_time."""
+    return data[posted_date_time].dt.strftime('%Y-%m-%d').fillna(null_partition)
+
+def read_processed(s3_client, key):
+    body = s3_client.get_object(Bucket=s3_bucket, Key=key)['Body'].read()
+    if is_parquet(key, body):
+        return apply_schema(read_parquet_compact(io.BytesIO(body)))
+    return apply_schema(read_csv_compact(io.BytesIO(body)))
+
+def write_processed(s3_client, key, data):
+    if output_format == 'parquet':
+        body = io.BytesIO()
+        data.to_parquet(body, index=False, compression=parquet_compression)
+        s3_client.put_object(Bucket=s3_bucket, Key=key, Body=body.getvalue())
+    else:
+        s3_client.put_object(Bucket=s3_bucket, Key=key, Body=to_csv_text(data))
+
+def write_partition(s3_client, board, day, rows, partitions):
+    """
+    Merges rows into one date partition, with new rows winning on (thread_id, posted_date_time),
+    writes it and updates its entry in the partition manifest. Returns the partition's row count.
+    """
+    rows = rows.assign(**{date_: pd.to_datetime(rows[date_])})
+    entry = partitions.get(day)
+    if entry:
+        try:
+            existing = read_processed(s3_client, entry['key'])
+            existing[date_] = pd.to_datetime(existing[date_])
+            rows = apply_schema(pd.concat([existing, rows], ignore_index=True))
+            rows = rows.drop_duplicates(subset=[thread_id_col, posted_date_time], keep='last')
+        except s3_client.exceptions.NoSuchKey:
+            print(f"Partition file {entry['key']} not found, writing new rows only")
+    key = partition_key(board, day)
+    write_processed(s3_client, key, rows)
+    if entry and entry['key'] != key:
+        s3_client.delete_object(Bucket=s3_bucket, Key=entry['key'])
+    posted = rows[posted_date_time].dropna()
+    partitions[day] = {
+        'key': key,
+        'rows': len(rows),
+        'min_posted': str(posted.min()) if len(posted) else None,
+        'max_posted': str(posted.max()) if len(posted) else None,
+    }
+    return len(rows)
+
+def write_partitions(s3_client, board, day_frames):
+    """
+    Writes each (day, rows) pair from day_frames into the board's date partitions. Only those
+    partitions are read and rewritten. Saves the partition manifest and returns the write stats.
+    """
+    partitions = load_json_state(s3_client, s3_bucket, partition_manifest_key(board))
+    written = []
+    for day, rows in day_frames:
+        partition_rows = write_partition(s3_client, board, day, rows, partitions)
+        print(f"  Wrote partition {partitions[day]['key']} ({partition_rows} rows)")
+        written.append(day)
+    for day, entry in partitions.items():
+        key = partition_key(board, day)
+        if entry['key'] != key and entry['key'].endswith(f'.{output_extension}'):
+            # Partitions written under the other layout move once, server-side
+            print(f"  Moving partition {entry['key']} to {key}")
+            s3_client.copy_object(Bucket=s3_bucket, CopySource={'Bucket': s3_bucket, 'Key': entry['key']}, Key=key)
+            s3_client.delete_object(Bucket=s3_bucket, Key=entry['key'])
+            entry['key'] = key
+    save_json_state(s3_client, s3_bucket, partition_manifest_key(board), partitions)
+    print(f"Wrote {len(written)} of {len(partitions)} partitions for board {board}")
+    return {'partitions_written': len(written), 'partitions': len(partitions),
+            'rows': sum(entry['rows'] for entry in partitions.values())}
+
+class PartitionSpool:
+    """
+    Per-day temporary CSV files that collect rows in chunked mode, so each partition is merged
+    and written once at the end instead of once per batch.
+    """
+    def __init__(self):
+        self.directory = tempfile.mkdtemp(prefix='partitions-')
+        self.paths = {}
+
+    def add(self, data):
+        for day, rows in data.groupby(partition_days(data), sort=False):
+            path = self.paths.setdefault(day, os.path.join(self.directory, f'{day}.csv'))
+            header = not os.path.exists(path)
+            with open(path, 'a', encoding='utf8') as f:
+                f.write(to_csv_text(rows, header=header))
+
+    def items(self):
+        for day in sorted(self.paths):
+            yield day, apply_schema(read_csv_compact(self.paths[day]))
+
+    def close(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+def text_cache_key(board):
+    return f"{state_prefix}/{board}_text_cache.parquet"
+
+def text_cache_fingerprint(key_phrases):
+    """
+    Hash of every setting that changes cleaned text or match results. A cache written under a
+    different fingerprint is discarded.
+    """
+    normalization = {flag: string_to_bool(general.get(flag, default))
+                     for flag, default in (('padding', 'False'), ('contraction_mapping', 'False'),
+                                           ('non_alpha_numeric', 'False'), ('fast_normalizer', 'True'))}
+    settings = {
+        'key_phrases': key_phrases,
+        'normalization': normalization,
+        'contractions': contraction_map() if normalization['contraction_mapping'] else None,
+        'matching': [match_mode, match_top_k, match_threshold, scorer_name],
+    }
+    return hashlib.sha256(json.dumps(settings, sort_keys=True).encode('utf-8')).hexdigest()
+
+class TextCache:
+    """
+    Cleaned text and key-phrase matches for posts transformed in earlier runs, keyed by post id
+    and a hash of the raw comment. Posts that cleaned to empty text are kept with an empty
+    text_clean so they are dropped again without being re-cleaned.
+    """
+    value_columns = [text_clean, 'matches', 'category', 'similarity']
+
+    def __init__(self, fingerprint, entries=None, etag=None):
+        self.fingerprint = fingerprint
+        if entries is None:
+            entries = pd.DataFrame(columns=['post_id', 'content_hash'] + self.value_columns + ['last_seen'])
+            entries = entries.astype({'content_hash': 'uint64', 'last_seen': 'int64'})
+        self.entries = entries.set_index(['post_id', 'content_hash']) if 'post_id' in entries.columns else entries
+        self.etag = etag
+        self.hits = 0
+        self.misses = 0
+
+    def keys(self, data):
+        content_hash = pd.util.hash_pandas_object(data[p_com], index=False).to_numpy()
+        return pd.MultiIndex.from_arrays([data[thread_id_col].to_numpy(dtype='int64'), content_hash], names=['post_id', 'content_hash'])
+
+    def lookup(self, data):
+        """
+        Splits data into rows with cached results, which get the cached columns filled in and
+        empty texts dropped as process_data would, and rows that still need to be transformed.
+        """
+        positions = self.entries.index.get_indexer(self.keys(data)) if len(self.entries) else np.full(len(data), -1)
+        found = positions >= 0
+        self.hits += int(found.sum())
+        self.misses += int((~found).sum())
+        self.entries.iloc[positions[found], self.entries.columns.get_loc('last_seen')] = int(time.time())
+
+        hits = data[found].copy()
+        cached = self.entries.iloc[positions[found]]
+        for column in self.value_columns:
+            values = cached[column].astype(object)
+            hits[column] = values.where(values.notna(), None).to_numpy()
+        hits = hits[hits[text_clean].str.strip().astype(bool)]
+        return hits, data[~found]
+
+    def add(self, misses, transformed):
+        """Records the results for rows that were just transformed, including rows that were dropped."""
+        values = transformed[self.value_columns].reindex(misses.index)
+        values[text_clean] = values[text_clean].fillna('')
+        if match_mode == 'topk':
+            values['similarity'] = values['similarity'].astype(object)
+        else:
+            values['similarity'] = pd.to_numeric(values['similarity']).astype('Int64')
+        values.index = self.keys(misses)
+        values['last_seen'] = int(time.time())
+        entries = pd.concat([self.entries, values]) if len(self.entries) else values
+        self.entries = entries[~entries.index.duplicated(keep='last')]
+
+    def report(self):
+        lookups = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses, 'entries': len(self.entries),
+                'hit_ratio': round(self.hits / lookups, 4) if lookups else 0.0}
+
+_text_caches = {}
+
+def load_text_cache(s3_client, board, fingerprint):
+    """
+    Returns the board's text cache. A warm container keeps the cache from its last run and only
+    re-downloads it when the object in S3 has changed since.
+    """
+    key = text_cache_key(board)
+    warm = _text_caches.get(board)
+    kwargs = {}
+    if warm is not None and warm.fingerprint == fingerprint and warm.etag:
+        kwargs['IfNoneMatch'] = warm.etag
+    try:
+        response = s3_client.get_object(Bucket=s3_bucket, Key=key, **kwargs)
+    except s3_client.exceptions.NoSuchKey:
+        print(f"No text cache found at {key}, starting empty")
+        cache = TextCache(fingerprint)
+    except ClientError as e:
+        if e.response.get('Error', {}).get('Code') not in ('304', 'NotModified'):
+            raise
+        print(f"Using warm text cache for {board} ({len(warm.entries)} entries)")
+        warm.hits = warm.misses = 0
+        return warm
+    else:
+        if response.get('Metadata', {}).get('fingerprint') != fingerprint:
+            print(f"Text cache at {key} was built with different key phrases or settings, starting empty")
+            cache = TextCache(fingerprint)
+        else:
+            entries = pd.read_parquet(io.BytesIO(response['Body'].read()))
+            cache = TextCache(fingerprint, entries, etag=response.get('ETag'))
+            print(f"Loaded text cache for {board} ({len(cache.entries)} entries)")
+    _text_caches[board] = cache
+    return cache
+
+def save_text_cache(s3_client, board, cache):
+    """Writes the cache as zstd-compressed Parquet, keeping the text_cache_max_rows most recently seen posts."""
+    entries = cache.entries
+    if len(entries) > text_cache_max_rows:
+        entries = entries.sort_values('last_seen', kind='stable').iloc[-text_cache_max_rows:]
+        cache.entries = entries
+    buffer = io.BytesIO()
+    entries.reset_index().to_parquet(buffer, index=False, compression='zstd')
+    response = s3_client.put_object(Bucket=s3_bucket, Key=text_cache_key(board), Body=buffer.getvalue(),
+                                    Metadata={'fingerprint': cache.fingerprint})
+    cache.etag = response.get('ETag')
+    print(f"Saved text cache for {board} ({len(entries)} entries, {buffer.tell()} bytes)")
+
+def process_board(s3_resource, _board_):
+    """
+    Processes the raw files of one board. In incremental mode only raw files that are not yet in
+    the board's manifest (or whose ETag changed) are read and transformed, and the result is merged
+    into the existing processed file.
+    """
+    print(f"Processing board: {_board_}")
+    filter_prefix = f"{raw_prefix}/{_board_}_{padding_data}"
+    print(f"Filtering S3 bucket '{s3_bucket}' with prefix: '{filter_prefix}'")
+
+    bucket_objects = list(s3_resource.Bucket(s3_bucket).objects.filter(Prefix=filter_prefix))
+    for file_count, obj in enumerate(bucket_objects, start=1):
+        print(f"Found file [{file_count}]: {obj.key}")
+    print(f"Total files found for {_board_}: {len(bucket_objects)}")
+
+    s3_client = s3_resource.meta.client
+    manifest = load_json_state(s3_client, s3_bucket, manifest_key(_board_)) if incremental_process else {}
+    processed_files = manifest.get('files', {})
+    new_objects = [obj for obj in bucket_objects if processed_files.get(obj.key, {}).get('etag') != obj.e_tag]
+    stats = {'raw_files': len(bucket_objects), 'new_files': len(new_objects)}
+    if incremental_process:
+        print(f"{len(new_objects)} of {len(bucket_objects)} raw files are new since the last run")
+
+    if not new_objects:
+        print(f"No new raw data for board {_board_}. Skipping...")
+        stats['status'] = 'up_to_date'
+        return stats
+
+    object_lists, rows_by_key, load_stats = load_raw_objects([obj.key for obj in new_objects], raw_usecols(_board_))
+    stats.update(load_stats)
+    if not object_lists:
+        print(f"No data available for board {_board_}. Skipping...")
+        stats['status'] = 'no_data'
+        return stats
+
+    print(f"Concatenating {len(object_lists)} dataframes...")
+    data = apply_schema(pd.concat(object_lists, ignore_index=True))
+    print(f"Combined data shape: {data.shape}")
+    memory_bytes = int(data.memory_usage(deep=True, index=False).sum())
+    memory_saved = max(default_memory_usage(data) - memory_bytes, 0)
+    stats.update({'memory_mb': round(memory_bytes / (1024 * 1024), 2), 'memory_saved_mb': round(memory_saved / (1024 * 1024), 2)})
+    print(f"Raw data uses {stats['memory_mb']} MB, about {stats['memory_saved_mb']} MB less than with default dtypes")
+    print(f"Columns available: {list(data.columns)}")
+
+    print(f"Sorting by {posted_date_time}...")
+    data = data.sort_values(by=posted_date_time, ascending=False)
+
+    print(f"Deduplicating by [{thread_number_key}, {posted_date_time}]...")
+    before_dedup = len(data)
+    with metrics.step('process.dedup') as step:
+        data = data.drop_duplicates(subset=[thread_number_key, posted_date_time], keep='last')
+        step.add('rows_in', before_dedup)
+        step.add('rows_out', len(data))
+    print(f"Deduplicated: {before_dedup} -> {len(data)} rows")
+
+    print(f"Renaming columns: {renamed}")
+    data = data.rename(columns=renamed)
+
+    print(f"Dropping rows with NA in '{p_com}'...")
+    before_dropna = len(data)
+    data = data.dropna(subset=[p_com])
+    print(f"After dropna: {before_dropna} -> {len(data)} rows")
+
+    if len(data) == 0:
+        print(f"No valid data after dropna for board {_board_}. Skipping...")
+        stats['status'] = 'no_data'
+        return stats
+
+    print("Processing text, matching key phrases and adding supporting columns...")
+    cache = None
+    if text_cache_enabled:
+        cache = load_text_cache(s3_client, _board_, text_cache_fingerprint(key_phrases))
+        data = transform_text_cached(data, key_phrases, cache)
+        stats['text_cache'] = cache.report()
+        print(f"Text cache: {cache.hits} hits, {cache.misses} misses (hit ratio {stats['text_cache']['hit_ratio']:.1%})")
+    else:
+        data = transform_text(data, key_phrases)
+
+    columns_names = board_specific.get(f"{_board_}_keys").split(',')
+    columns_names = [col.strip() for col in columns_names]
+    print(f"Selecting columns for {_board_}: {columns_names}")
+
+    missing_cols = [col for col in columns_names if col not in data.columns]
+    if missing_cols:
+        print(f"WARNING: Missing columns: {missing_cols}")
+        print(f"Available columns: {list(data.columns)}")
+
+    data = apply_schema(data.reindex(columns=columns_names))
+    data = remove_omit_ids(data, 'thread_id', omit_ids)
+    stats['new_rows'] = len(data)
+
+    previous_key = manifest.get('output_key')
+    if previous_key:
+        data = merge_processed(s3_resource, previous_key, data)
+    print(f"Final data shape: {data.shape}")
+
+    if processed_layout in partitioned_layouts:
+        with metrics.step('process.upload') as step:
+            stats.update(write_partitions(s3_client, _board_, data.groupby(partition_days(data), sort=True)))
+            step.add('rows_out', len(data))
+        if previous_key:
+            # The single file's rows were merged in above and now live in the partitions
+            print(f"Removing processed file {previous_key} after moving it to partitions")
+            s3_client.delete_object(Bucket=s3_bucket, Key=previous_key)
+        if cache is not None:
+            save_text_cache(s3_client, _board_, cache)
+        if incremental_process:
+            save_json_state(s3_client, s3_bucket, manifest_key(_board_),
+                            {'files': updated_manifest_files(bucket_objects, processed_files, new_objects, rows_by_key), 'output_key': None})
+        stats['status'] = 'processed'
+        return stats
+
+    # Save processed data
+    date_range = get_dateRange(data)
+    save_path = f'{data_prefix}/chanscope_{_board_}_{date_range}_processed.{output_extension}'
+    print(f"Saving to S3: {s3_bucket}/{save_path}")
+    with metrics.step('process.upload') as step:
+        if output_format == 'parquet':
+            body = io.BytesIO()
+            data.to_parquet(body, index=False, compression=parquet_compression)
+            s3_resource.Object(s3_bucket, save_path).put(Body=body.getvalue())
+        else:
+            s3_resource.Object(s3_bucket, save_path).put(Body=to_csv_text(data))
+        step.add('rows_out', len(data))
+    print(f"Successfully saved {len(data)} rows for board {_board_}")
+    if previous_key and previous_key != save_path:
+        print(f"Removing superseded processed file {previous_key}")
+        s3_resource.Object(s3_bucket, previous_key).delete()
+    if cache is not None:
+        save_text_cache(s3_client, _board_, cache)
+
+    if incremental_process:
+        save_json_state(s3_client, s3_bucket, manifest_key(_board_),
+                        {'files': updated_manifest_files(bucket_objects, processed_files, new_objects, rows_by_key), 'output_key': save_path})
+    stats.update({'status': 'processed', 'rows': len(data), 'output_key': save_path})
+    return stats
+
+def updated_manifest_files(bucket_objects, processed_files, new_objects, rows_by_key):
+    """Manifest entries after a run: raw files that aged out of the bucket are dropped and newly read files are added."""
+    live_keys = {obj.key for obj in bucket_objects}
+    files = {key: entry for key, entry in processed_files.items() if key in live_keys}
+    for obj in new_objects:
+        if obj.key in rows_by_key:
+            files[obj.key] = {'etag': obj.e_tag, 'rows': rows_by_key[obj.key]}
+    return files
+
+class SeenIndex:
+    """
+    On-disk set of (thread_id, posted_date_time) keys in a temporary SQLite database, used to
+    dedup rows across batches without holding every key in memory.
+    """
+    def __init__(self, directory=None):
+        handle, self.path = tempfile.mkstemp(suffix='.sqlite', dir=directory)
+        os.close(handle)
+        self.connection = sqlite3.connect(self.path)
+        self.connection.execute('PRAGMA journal_mode=OFF')
+        self.connection.execute('PRAGMA synchronous=OFF')
+        self.connection.execute('CREATE TABLE seen (thread_id TEXT, posted TEXT, position INTEGER, PRIMARY KEY (thread_id, posted)) WITHOUT ROWID')
+        # INSERT OR IGNORE only fires the trigger for keys that were not in the index yet
+        self.connection.execute('CREATE TABLE fresh (position INTEGER)')
+        self.connection.execute('CREATE TRIGGER record_fresh AFTER INSERT ON seen BEGIN INSERT INTO fresh VALUES (NEW.position); END')
+
+    def add_new(self, thread_ids, posted):
+        """
+        Adds the keys and returns a boolean array that is True where a key was not seen before.
+        The whole batch is inserted with one executemany in a single transaction.
+        """
+        rows = zip(np.asarray(thread_ids).tolist(), np.asarray(posted).tolist(), range(len(thread_ids)))
+        with self.connection:
+            self.connection.executemany('INSERT OR IGNORE INTO seen VALUES (?, ?, ?)', rows)
+            new_positions = [row[0] for row in self.connection.execute('SELECT position FROM fresh')]
+            self.connection.execute('DELETE FROM fresh')
+        is_new = np.zeros(len(thread_ids), dtype=bool)
+        is_new[new_positions] = True
+        return is_new
+
+    def close(self):
+        self.connection.close()
+        os.remove(self.path)
+
+class BatchSizer:
+    """
+    Picks the number of rows to read per batch so that a transformed batch stays within
+    chunk_memory_mb. Starts with a small probe batch and adapts to the largest bytes-per-row seen.
+    A batch is assumed to need about twice its final size while it is being transformed.
+    """
+    overhead = 2
+
+    def __init__(self, memory_mb=chunk_memory_mb, probe_rows=1000):
+        self.budget = memory_mb * 1024 * 1024
+        self.rows = probe_rows
+        self.bytes_per_row = 0
+        self.peak_batch_bytes = 0
+
+    def observe(self, batch):
+        if len(batch):
+            batch_bytes = int(batch.memory_usage(deep=True).sum())
+            self.peak_batch_bytes = max(self.peak_batch_bytes, batch_bytes)
+            self.bytes_per_row = max(self.bytes_per_row, batch_bytes / len(batch))
+            self.rows = max(100, int(self.budget / (self.bytes_per_row * self.overhead)))
+
+def read_raw_batches(s3_client, key, sizer, usecols=None):
+    """
+    Streams a raw file from S3 and yields DataFrames of sizer.rows rows with the compact schema
+    applied. Parquet files need random access, so they are spooled to a temporary file first.
+    """
+    if is_parquet(key):
+        with tempfile.TemporaryFile() as spool:
+            s3_client.download_fileobj(s3_bucket, key, spool)
+            spool.seek(0)
+            for batch in iter_parquet_batches(spool, sizer, usecols):
+                yield apply_schema(batch)
+        return
+    body = s3_client.get_object(Bucket=s3_bucket, Key=key)['Body']
+    compression = 'gzip' if key.endswith('.gz') else None
+    with read_csv_compact(body, usecols, compression=compression, iterator=True) as reader:
+        while True:
+            try:
+                yield apply_schema(reader.get_chunk(sizer.rows))
+            except StopIteration:
+                return
+
+def process_board_chunked(s3_resource, _board_):
+    """
+    Bounded-memory variant of process_board. Raw files are streamed newest first in batches sized
+    by chunk_memory_mb, deduped against an on-disk index instead of a global sort, transformed and
+    appended to a multipart upload under state_prefix. The previous processed file is streamed
+    after the new rows, keeping only rows within lookback_days that the new data did not replace.
+    The upload is copied to the final date-range key at the end, since the range is only known
+    once every row is written. Rows are ordered by raw file, newest first, rather than sorted by
+    posted_date_time.
+    """
+    from pyarrow import ArrowInvalid
+    print(f"Processing board in chunked mode: {_board_}")
+    filter_prefix = f"{raw_prefix}/{_board_}_{padding_data}"
+    bucket_objects = list(s3_resource.Bucket(s3_bucket).objects.filter(Prefix=filter_prefix))
+    print(f"Total files found for {_board_}: {len(bucket_objects)}")
+
+    s3_client = s3_resource.meta.client
+    manifest = load_json_state(s3_client, s3_bucket, manifest_key(_board_)) if incremental_process else {}
+    processed_files = manifest.get('files', {})
+    new_objects = [obj for obj in bucket_objects if processed_files.get(obj.key, {}).get('etag') != obj.e_tag]
+    new_objects.sort(key=lambda obj: obj.key, reverse=True)
+    stats = {'raw_files': len(bucket_objects), 'new_files': len(new_objects)}
+    if not new_objects:
+        print(f"No new raw data for board {_board_}. Skipping...")
+        stats['status'] = 'up_to_date'
+        return stats
+
+    columns_names = [col.strip() for col in board_specific.get(f"{_board_}_keys").split(',')]
+    cache = load_text_cache(s3_client, _board_, text_cache_fingerprint(key_phrases)) if text_cache_enabled else None
+    previous_key = manifest.get('output_key')
+    partial_key = f"{state_prefix}/{_board_}_processed.partial.{output_extension}"
+    sizer = BatchSizer()
+    seen = SeenIndex()
+    spool = PartitionSpool() if processed_layout in partitioned_layouts else None
+    writer = None
+    parquet_writer = None
+    if spool is None:
+        writer = S3MultipartWriter(s3_client, s3_bucket, partial_key, part_size=multipart_chunk_mb * 1024 * 1024)
+        if output_format == 'parquet':
+            parquet_writer = ParquetBatchWriter(writer, compression=parquet_compression, dtypes=column_dtypes)
+    rows_by_key = {}
+    counts = {'batches': 0, 'raw_rows': 0, 'new_rows': 0, 'rows': 0}
+    date_bounds = []
+    memory_saved = 0
+
+    def write_batch(batch):
+        batch = batch.assign(**{date_: pd.to_datetime(batch[date_])})
+        dates = batch[date_].dropna()
+        if len(dates):
+            date_bounds.extend([dates.min(), dates.max()])
+        with metrics.step('process.upload') as step:
+            if spool is not None:
+                spool.add(batch)
+            elif parquet_writer is not None:
+                parquet_writer.write(apply_schema(batch))
+            else:
+                writer.write(to_csv_text(batch, header=counts['rows'] == 0).encode('utf-8'))
+            step.add('rows_out', len(batch))
+        counts['rows'] += len(batch)
+
+    try:
+        for obj in new_objects:
+            file_rows = 0
+            batches = read_raw_batches(s3_client, obj.key, sizer, raw_usecols(_board_))
+            while True:
+                # Only download and parse failures skip a file; transform and write errors propagate
+                try:
+                    batch = next(batches)
+                except StopIteration:
+                    rows_by_key[obj.key] = file_rows
+                    print(f"  Processed {file_rows} rows from {obj.key} (batch size now {sizer.rows} rows)")
+                    break
+                except (ClientError, pd.errors.ParserError, ArrowInvalid) as e:
+                    print(f"  ERROR reading {obj.key}: {str(e)}")
+                    break
+                file_rows += len(batch)
+                counts['raw_rows'] += len(batch)
+                memory_bytes = int(batch.memory_usage(deep=True, index=False).sum())
+                memory_saved += max(default_memory_usage(batch) - memory_bytes, 0)
+                with metrics.step('process.dedup') as step:
+                    step.add('rows_in', len(batch))
+                    batch = batch[seen.add_new(batch[thread_number_key].astype(str).to_numpy(),
+                                               batch[posted_date_time].astype(str).to_numpy())]
+                    step.add('rows_out', len(batch))
+                batch = batch.rename(columns=renamed).dropna(subset=[p_com])
+                if not len(batch):
+                    continue
+                if cache is not None:
+                    batch = transform_text_cached(batch, key_phrases, cache)
+                else:
+                    batch = transform_text(batch, key_phrases)
+                sizer.observe(batch)
+                batch = remove_omit_ids(batch.reindex(columns=columns_names), 'thread_id', omit_ids)
+                counts['batches'] += 1
+                counts['new_rows'] += len(batch)
+                write_batch(batch)
+
+        if previous_key and counts['rows']:
+            try:
+                print(f"Merging existing rows from {previous_key}")
+                for batch in read_raw_batches(s3_client, previous_key, sizer):
+                    batch = within_retention(batch)
+                    batch = batch[seen.add_new(batch[thread_id_col].astype(str).to_numpy(),
+                                               batch[posted_date_time].astype(str).to_numpy())]
+                    if len(batch):
+                        write_batch(batch.reindex(columns=columns_names))
+            except s3_client.exceptions.NoSuchKey:
+                print(f"Previous processed file {previous_key} not found, writing new rows only")
+
+        if not counts['rows']:
+            if writer is not None:
+                writer.abort()
+            print(f"No valid data for board {_board_}. Skipping...")
+            stats['status'] = 'no_data'
+            return stats
+        with metrics.step('process.upload'):
+            if spool is not None:
+                partition_stats = write_partitions(s3_client, _board_, spool.items())
+            else:
+                if parquet_writer is not None:
+                    parquet_writer.close()
+                writer.close()
+    except Exception:
+        if writer is not None:
+            writer.abort()
+        raise
+    finally:
+        seen.close()
+        if spool is not None:
+            spool.close()
+
+    if spool is not None:
+        save_path = None
+        if previous_key:
+            print(f"Removing processed file {previous_key} after moving it to partitions")
+            s3_client.delete_object(Bucket=s3_bucket, Key=previous_key)
+    else:
+        with metrics.step('process.upload'):
+            save_path = write_chunked_output(s3_client, _board_, partial_key, date_bounds, counts['rows'], previous_key)
+    if cache is not None:
+        save_text_cache(s3_client, _board_, cache)
+        stats['text_cache'] = cache.report()
+
+    if incremental_process:
+        save_json_state(s3_client, s3_bucket, manifest_key(_board_),
+                        {'files': updated_manifest_files(bucket_objects, processed_files, new_objects, rows_by_key), 'output_key': save_path})
+    stats.update(counts)
+    if spool is not None:
+        stats.update(partition_stats)
+    stats.update({'status': 'processed', 'output_key': save_path, 'batch_rows': sizer.rows,
+                  'peak_batch_mb': round(sizer.peak_batch_bytes / (1024 * 1024), 2),
+                  'memory_saved_mb': round(memory_saved / (1024 * 1024), 2)})
+    return stats
+
+def write_chunked_output(s3_client, _board_, partial_key, date_bounds, rows, previous_key):
+    """Copies the finished partial upload to the board's date-range key and returns that key."""
+    date_range = pd.Timestamp(min(date_bounds)).strftime("%Y-%m-%d") + '_' + pd.Timestamp(max(date_bounds)).strftime("%Y-%m-%d")
+    save_path = f'{data_prefix}/chanscope_{_board_}_{date_range}_processed.{output_extension}'
+    print(f"Saving {rows} rows to S3: {s3_bucket}/{save_path}")
+    s3_client.copy({'Bucket': s3_bucket, 'Key': partial_key}, s3_bucket, save_path)
+    s3_client.delete_object(Bucket=s3_bucket, Key=partial_key)
+    if previous_key and previous_key != save_path:
+        print(f"Removing superseded processed file {previous_key}")
+        s3_client.delete_object(Bucket=s3_bucket, Key=previous_key)
+    return save_path
+
 def handle_process(event, context):
     s3_resource = boto3.resource('s3')
+    board_results = {}
     for _board_ in boards:
-        print(f"Processing board: {_board_}")
-        filter_prefix = f"{raw_prefix}/{_board_}_{padding_data}"
-        print(f"Filtering S3 bucket '{s3_bucket}' with prefix: '{filter_prefix}'")
-        
-        bucket_objects = s3_resource.Bucket(s3_bucket).objects.filter(Prefix=filter_prefix)
-        object_lists = []
-        file_count = 0
-        
-        for obj in bucket_objects:
-            file_count += 1
-            print(f"Found file [{file_count}]: {obj.key}")
-            try:
-                body = obj.get()['Body'].read()
-                data = pd.read_csv(io.BytesIO(body), encoding='utf8')
-                print(f"  Loaded {len(data)} rows from {obj.key}")
-                object_lists.append(data)
-            except Exception as e:
-                print(f"  ERROR reading {obj.key}: {str(e)}")
-                continue
-        
-        print(f"Total files found for {_board_}: {file_count}")
-        
-        if not object_lists:
-            print(f"No data available for board {_board_}. Skipping...")
-            continue
-        
-        print(f"Concatenating {len(object_lists)} dataframes...")
-        data = pd.concat(object_lists, ignore_index=True)
-        print(f"Combined data shape: {data.shape}")
-        print(f"Columns available: {list(data.columns)}")
-        
-        print(f"Sorting by {posted_date_time}...")
-        data = data.sort_values(by=posted_date_time, ascending=False)
-        
-        print(f"Deduplicating by [{thread_number_key}, {posted_date_time}]...")
-        before_dedup = len(data)
-        data = data.drop_duplicates(subset=[thread_number_key, posted_date_time], keep='last')
-        print(f"Deduplicated: {before_dedup} -> {len(data)} rows")
-        
-        print(f"Renaming columns: {renamed}")
-        data = data.rename(columns=renamed)
-        
-        print(f"Dropping rows with NA in '{p_com}'...")
-        before_dropna = len(data)
-        data = data.dropna(subset=[p_com])
-        print(f"After dropna: {before_dropna} -> {len(data)} rows")
-        
-        if len(data) == 0:
-            print(f"No valid data after dropna for board {_board_}. Skipping...")
-            continue
-        
-        print("Processing text and matching key phrases...")
-        data = process_data_with_regex_and_partial_match(data, 'posted_comment', text_clean, key_phrases)
-        
-        print("Adding supporting columns...")
-        data = supportingcols(data, p_com)
-        
-        columns_names = board_specific.get(f"{_board_}_keys").split(',')
-        columns_names = [col.strip() for col in columns_names]
-        print(f"Selecting columns for {_board_}: {columns_names}")
-        
-        missing_cols = [col for col in columns_names if col not in data.columns]
-        if missing_cols:
-            print(f"WARNING: Missing columns: {missing_cols}")
-            print(f"Available columns: {list(data.columns)}")
-        
-        data = data[columns_names]
-        data = remove_omit_ids(data, 'thread_id', omit_ids)
-        print(f"Final data shape: {data.shape}")
-        
-        # Save processed data
-        date_range = get_dateRange(data)
-        save_path = f'{data_prefix}/chanscope_{_board_}_{date_range}_processed.csv'
-        print(f"Saving to S3: {s3_bucket}/{save_path}")
-        csv_buffer = io.StringIO()
-        data.to_csv(csv_buffer, index=False)
-        s3_resource.Object(s3_bucket, save_path).put(Body=csv_buffer.getvalue())
-        print(f"Successfully saved {len(data)} rows for board {_board_}")
-    return "Process completed"
+        if chunked_process:
+            board_results[_board_] = process_board_chunked(s3_resource, _board_)
+        else:
+            board_results[_board_] = process_board(s3_resource, _board_)
+    return {'status': 'Process completed', 'boards': board_results}
 
 def process_data(data, input_col, clean_col):
-    data[input_col] = data[input_col].astype(str)
-    data[clean_col] = data[input_col].apply(normalize_text).apply(remove_whitespace).apply(pad_punctuation)
-    return data[data[clean_col].notnull() & data[clean_col].str.strip().astype(bool)]
+    with metrics.step('process.clean') as step:
+        data[input_col] = data[input_col].astype(str)
+        data[clean_col] = data[input_col].apply(clean_text)
+        cleaned = data[data[clean_col].notnull() & data[clean_col].str.strip().astype(bool)]
+        step.add('rows_in', len(data))
+        step.add('rows_out', len(cleaned))
+    return cleaned
 
 def regex_partial_match(row_text, phrases_with_category, threshold=70):
     """
@@ -148,7 +939,107 @@ def regex_partial_match(row_text, phrases_with_category, threshold=70):
                 return phrase, category, similarity  # Return the first match
     return None, None, None
     
-def process_data_with_regex_and_partial_match(data, input_col, clean_col, key_phrases):
+word_regex = re.compile(r'\w+')
+
+def score_pairs(texts, phrases, fast=None):
+    """
+    Scores partial_ratio(text, phrase) for aligned lists of pairs. With fast_scorer the pairs are
+    scored in one call to rapidfuzz's C implementation on scorer_workers threads, otherwise with
+    fuzzywuzzy pair by pair.
+    """
+    if fast is None:
+        fast = fast_scorer
+    if not texts:
+        return []
+    if fast:
+        return np.rint(cpdist(texts, phrases, scorer=rapid_fuzz.partial_ratio, workers=scorer_workers)).astype(int).tolist()
+    return [fuzz.partial_ratio(text, phrase) for text, phrase in zip(texts, phrases)]
+
+def fold_word(word):
+    """
+    Case-folds a word for index lookups. Dotted/dotless i are folded to 'i' because
+    re.IGNORECASE matches them against 'i', which casefold() alone does not.
+    """
+    word = word.casefold()
+    return word if word.isascii() else word.translate({0x131: 'i', 0x307: None})
+
+class PhraseMatcher:
+    """
+    Precompiled key-phrase matcher with the same first-match semantics and output as
+    regex_partial_match. Each phrase's word-boundary pattern is compiled once, and phrases are
+    indexed by their leading word, so a row is only checked against phrases whose first word
+    occurs in it. Phrases that do not start with a word character are checked on every row.
+    match and match_many both score with batch_scorer, so they agree for any scorer.
+    """
+    def __init__(self, phrases_with_category, threshold=70, batch_scorer=score_pairs):
+        self.phrases_with_category = list(phrases_with_category)
+        self.threshold = threshold
+        self.batch_scorer = batch_scorer
+        self.patterns = [re.compile(r'\b' + re.escape(phrase) + r'\b', re.IGNORECASE)
+                         for phrase, _ in self.phrases_with_category]
+        self.by_first_word = {}
+        self.always_check = []
+        for index, (phrase, _) in enumerate(self.phrases_with_category):
+            first_word = word_regex.match(phrase)
+            if first_word:
+                self.by_first_word.setdefault(fold_word(first_word.group(0)), []).append(index)
+            else:
+                self.always_check.append(index)
+
+    def candidates(self, row_text):
+        """Returns the indices of phrases that can match row_text, in phrase order."""
+        indices = set(self.always_check)
+        for word in {fold_word(word) for word in word_regex.findall(row_text)}:
+            indices.update(self.by_first_word.get(word, ()))
+        return sorted(indices)
+
+    def match(self, row_text):
+        for index in self.candidates(row_text):
+            if self.patterns[index].search(row_text):
+                phrase, category = self.phrases_with_category[index]
+                similarity = self.batch_scorer([row_text], [phrase])[0]
+                if similarity >= self.threshold:
+                    return phrase, category, similarity
+        return None, None, None
+
+    def match_many(self, texts, top_k=None):
+        """
+        Matches a batch of rows. Regex hits for every row are collected first and all
+        (row, phrase) pairs are scored with a single batch_scorer call.
+        With top_k=None each row gets its first match in phrase order, as in match(). Otherwise
+        each row gets up to top_k matches by descending score, with matches, categories and
+        scores each joined by '|'.
+        """
+        pair_rows = []
+        pair_phrases = []
+        for row, text in enumerate(texts):
+            if not isinstance(text, str):
+                continue
+            for index in self.candidates(text):
+                if self.patterns[index].search(text):
+                    pair_rows.append(row)
+                    pair_phrases.append(index)
+        scores = self.batch_scorer([texts[row] for row in pair_rows],
+                                   [self.phrases_with_category[index][0] for index in pair_phrases])
+
+        hits = {}
+        for row, index, similarity in zip(pair_rows, pair_phrases, scores):
+            if similarity >= self.threshold:
+                hits.setdefault(row, []).append((index, similarity))
+        results = [(None, None, None)] * len(texts)
+        for row, row_hits in hits.items():
+            if top_k is None:
+                index, similarity = row_hits[0]
+                phrase, category = self.phrases_with_category[index]
+                results[row] = (phrase, category, similarity)
+            else:
+                best = sorted(row_hits, key=lambda hit: -hit[1])[:top_k]
+                results[row] = ('|'.join(self.phrases_with_category[index][0] for index, _ in best),
+                                '|'.join(self.phrases_with_category[index][1] for index, _ in best),
+                                '|'.join(str(similarity) for _, similarity in best))
+        return results
+
+def process_data_with_regex_and_partial_match(data, input_col, clean_col, key_phrases, matcher=None):
     data = process_data(data, input_col, clean_col)
     if clean_col not in data.columns:
         raise KeyError(f"The column '{clean_col}' does not exist in the DataFrame.")
@@ -159,7 +1050,103 @@ def process_data_with_regex_and_partial_match(data, input_col, clean_col, key_ph
         data['category'] = None
         data['similarity'] = None
         return data
-    match_results = data[clean_col].apply(
-        lambda x: regex_partial_match(x, phrases_with_category) if pd.notna(x) else (None, None, None))
-    data.loc[:, 'matches'], data.loc[:, 'category'], data.loc[:, 'similarity'] = zip(*match_results)
-    return data
\ No newline at end of file
+    if matcher is None:
+        matcher = PhraseMatcher(phrases_with_category, threshold=match_threshold)
+    with metrics.step('process.match') as step:
+        match_results = matcher.match_many(data[clean_col].tolist(), top_k=match_top_k if match_mode == 'topk' else None)
+        data.loc[:, 'matches'], data.loc[:, 'category'], data.loc[:, 'similarity'] = zip(*match_results)
+        step.add('rows_in', len(data))
+        step.add('rows_out', sum(1 for result in match_results if result[0] is not None))
+    return data
+
+def transform_rows(data, key_phrases, matcher=None):
+    """Cleans text, matches key phrases and adds the supporting columns for a frame of rows."""
+    data = process_data_with_regex_and_partial_match(data, 'posted_comment', text_clean, key_phrases, matcher=matcher)
+    return supportingcols(data, p_com)
+
+def _chunk_worker(func, chunk, conn):
+    # The worker's metrics start empty and are sent back with its result, so the parent can merge them
+    metrics.reset()
+    # Every worker already has a core of its own
+    global scorer_workers
+    scorer_workers = 1
+    try:
+        result = func(chunk)
+        conn.send((True, (result, metrics.records())))
+    except Exception as e:
+        conn.send((False, f"{type(e).__name__}: {e}"))
+    finally:
+        conn.close()
+
+def map_chunks(func, data, workers=process_workers):
+    """
+    Splits data into one contiguous row chunk per worker, runs func on each chunk in a forked
+    process and returns the results in chunk order. Workers are plain Process objects connected
+    by pipes because Lambda has no /dev/shm for the semaphores multiprocessing.Pool and
+    ProcessPoolExecutor need. Anything built before the call is inherited by the workers through
+    fork, so it is set up once rather than pickled per chunk.
+    """
+    workers = min(workers, len(data))
+    if workers <= 1 or 'fork' not in multiprocessing.get_all_start_methods():
+        return [func(data)]
+    context = multiprocessing.get_context('fork')
+    bounds = np.linspace(0, len(data), workers + 1, dtype=int)
+    jobs = []
+    try:
+        for start, end in zip(bounds[:-1], bounds[1:]):
+            receiver, sender = context.Pipe(duplex=False)
+            worker = context.Process(target=_chunk_worker, args=(func, data.iloc[start:end], sender), daemon=True)
+            worker.start()
+            sender.close()
+            jobs.append((worker, receiver))
+        results = []
+        for worker, receiver in jobs:
+            ok, result = receiver.recv()
+            worker.join()
+            if not ok:
+                raise RuntimeError(f"Chunk worker failed: {result}")
+            result, worker_metrics = result
+            metrics.merge(worker_metrics)
+            results.append(result)
+        return results
+    finally:
+        for worker, receiver in jobs:
+            receiver.close()
+            if worker.is_alive():
+                worker.terminate()
+                worker.join()
+
+def transform_text(data, key_phrases, workers=process_workers):
+    """
+    Runs transform_rows over data, split across `workers` processes when the frame has at least
+    parallel_min_rows rows. The phrase matcher and stopword set are built once up front and shared
+    with every worker. Chunks are reassembled in their original row order.
+    """
+    if workers <= 1 or len(data) < parallel_min_rows:
+        return transform_rows(data, key_phrases)
+    phrases_with_category = flatten_key_phrases(key_phrases)
+    matcher = PhraseMatcher(phrases_with_category, threshold=match_threshold) if phrases_with_category else None
+    stop_word_set()
+    start_time = time.time()
+    chunks = map_chunks(lambda chunk: transform_rows(chunk, key_phrases, matcher), data, workers)
+    print(f"Transformed {len(data)} rows in {len(chunks)} worker processes in {time.time() - start_time:.2f}s")
+    return pd.concat(chunks)
+
+def transform_text_cached(data, key_phrases, cache):
+    """
+    transform_text with the text cache in front of it. Only rows missing from the cache are
+    cleaned and matched; cached rows just get the supporting columns. Row order is kept.
+    """
+    data = data.assign(**{p_com: data[p_com].astype(str)})
+    hits, misses = cache.lookup(data)
+    if len(misses):
+        transformed = transform_text(misses, key_phrases)
+        cache.add(misses, transformed)
+    else:
+        transformed = misses
+    hits = supportingcols(hits, p_com)
+    frames = [frame for frame in (hits, transformed) if len(frame)]
+    if not frames:
+        return hits
+    combined = pd.concat(frames)
+    return combined.loc[data.index[data.index.isin(combined.index)]]
@@ -1,91 +1,539 @@
 import boto3
+import bisect
 import configparser
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from datetime import datetime, timedelta, timezone
-from utils import read_config, supportingcols, get_dateRange
+from zoneinfo import ZoneInfo
+from botocore.config import Config
+from botocore.exceptions import ClientError
+from utils import read_config, string_to_bool, load_json_state, save_json_state, api_timezone
+import metrics
 
 config_path = 'config.ini'
 
 s3_info = read_config(section='s3', config_path=config_path)
 general = read_config(section='general', config_path=config_path)
 s3_destinations = read_config(section='s3_refresh_destinations', config_path=config_path)
+copy_workers = int(s3_destinations.get('copy_workers', 16))
+# DeleteObjects accepts at most 1000 keys per request
+delete_batch_size = min(int(s3_destinations.get('delete_batch_size', 1000)), 1000)
 
-def handle_refresh(event, context):
-    s3 = boto3.client('s3')
+# Compare source and destination listings and copy only objects that are missing or changed
+diff_refresh = string_to_bool(s3_destinations.get('diff_refresh', 'True'))
+# List date-first keys only for dates inside the window; other keys fall back to a full scan
+prune_listing = string_to_bool(s3_destinations.get('prune_listing', 'True'))
+# Stop and hand back a continuation token when less than this much Lambda time is left
+time_cutoff_ms = 10000
+# Diff refresh progress is checkpointed so the next invocation resumes instead of replanning
+state_prefix = s3_info.get('state_prefix', 'state')
+checkpoint_store = s3_destinations.get('checkpoint_store', 's3').lower()
+checkpoint_path = s3_destinations.get('checkpoint_path', '/tmp/refresh_checkpoint.json')
+checkpoint_every = int(s3_destinations.get('checkpoint_every', 1000))
+# How often the function is scheduled. Without self_invoke an interrupted refresh resumes at the next
+# scheduled run, so by default a checkpoint stays usable for two schedule intervals.
+schedule_minutes = int(s3_destinations.get('schedule_minutes', 60))
+checkpoint_max_age_minutes = int(s3_destinations.get('checkpoint_max_age_minutes') or 2 * schedule_minutes)
+resume_refresh = string_to_bool(s3_destinations.get('resume_refresh', 'True'))
+self_invoke = string_to_bool(s3_destinations.get('self_invoke', 'False'))
+max_self_invocations = int(s3_destinations.get('max_self_invocations', 10))
 
-    def refresh_bucket(source_bucket, source_prefix, destination_bucket, lookback_days, source_token, dest_token):
-        time_threshold = datetime.utcnow() - timedelta(days=lookback_days)
-        time_threshold = time_threshold.replace(tzinfo=timezone.utc)
+def refresh_destinations():
+    """
+    Returns (bucket, lookback_days) pairs from `destinations = bucket:days,...`, falling back to the
+    roling_bucket and daily_bucket_rolling pairs when the list is not configured.
+    """
+    configured = s3_destinations.get('destinations', '').strip()
+    if not configured:
+        return [(s3_destinations['roling_bucket'], int(s3_destinations['lookback_days'])),
+                (s3_destinations['daily_bucket_rolling'], int(s3_destinations['daily_lookback_days']))]
+    destinations = []
+    for entry in configured.split(','):
+        bucket, _, days = entry.strip().rpartition(':')
+        if not bucket:
+            raise ValueError(f"Refresh destination '{entry.strip()}' must be written as bucket:lookback_days")
+        destinations.append((bucket, int(days)))
+    return destinations
 
-        # Initialize S3 paginator for source bucket
-        source_paginator = s3.get_paginator('list_objects_v2')
-        operation_parameters = {
-            'Bucket': source_bucket,
-            'Prefix': source_prefix,
-        }
+def throughput(count, size, seconds):
+    seconds = max(seconds, 1e-9)
+    return {'per_sec': round(count / seconds, 2), 'bytes_per_sec': round(size / seconds, 2)}
 
-        if source_token:
-            operation_parameters['ContinuationToken'] = source_token
-
-        # Processing new files
-        for page in source_paginator.paginate(**operation_parameters):
-            objects = sorted(page.get('Contents', []), key=lambda x: x['LastModified'], reverse=True)
-            for obj in objects:
-                last_modified = obj['LastModified']
-                key = obj['Key']
-                if last_modified >= time_threshold:
-                    print(f'Copying {key}, last modified: {last_modified}')
-                    s3.copy_object(Bucket=destination_bucket, CopySource={'Bucket': source_bucket, 'Key': key}, Key=key)
-                
-                if context.get_remaining_time_in_millis() < 10000:
-                    next_token = page.get('NextContinuationToken', None)
-                    return {
-                        'ContinuationToken': next_token,
-                        'status': 'incomplete'
-                    }
-
-        # Initialize S3 paginator for destination bucket
-        dest_paginator = s3.get_paginator('list_objects_v2')
-        dest_operation_parameters = {
-            'Bucket': destination_bucket,
-            'Prefix': source_prefix,
-        }
+def copy_page(s3, context, source_bucket, destination_bucket, objects, stats, done=None):
+    """
+    Copies objects server-side on a bounded thread pool. Returns False when the remaining-time
+    cutoff was hit before every copy finished; copies that had not started are cancelled.
+    Finished objects are appended to `done` when a list is passed.
+    """
+    start = time.perf_counter()
+
+    def copy(obj):
+        print(f"Copying {obj['Key']}, last modified: {obj['LastModified']}")
+        try:
+            s3.copy_object(Bucket=destination_bucket, CopySource={'Bucket': source_bucket, 'Key': obj['Key']}, Key=obj['Key'])
+        except ClientError as e:
+            # A source object removed since it was planned (e.g. a resumed checkpoint) has nothing left to copy
+            if e.response.get('Error', {}).get('Code') not in ('NoSuchKey', '404'):
+                raise
+            print(f"Skipping {obj['Key']}, no longer in the source bucket")
+            return obj, False
+        return obj, True
+
+    def record(futures):
+        for future in futures:
+            obj, copied = future.result()
+            if copied:
+                stats['copied'] += 1
+                stats['copied_bytes'] += obj.get('Size', 0)
+            if done is not None:
+                done.append(obj)
+
+    copied_before = stats['copied']
+    with metrics.step('refresh.copy') as step:
+        executor = ThreadPoolExecutor(max_workers=copy_workers)
+        pending = {executor.submit(copy, obj) for obj in objects}
+        completed = True
+        try:
+            while pending:
+                finished, pending = wait(pending, timeout=1, return_when=FIRST_COMPLETED)
+                record(finished)
+                if pending and context.get_remaining_time_in_millis() < time_cutoff_ms:
+                    completed = False
+                    break
+        finally:
+            executor.shutdown(wait=True, cancel_futures=True)
+            stats['copy_seconds'] += time.perf_counter() - start
+        # Copies already in flight at the cutoff still finish during shutdown
+        record(future for future in pending if not future.cancelled())
+        step.add('rows_in', len(objects))
+        step.add('rows_out', stats['copied'] - copied_before)
+    return completed
+
+def delete_keys(s3, context, destination_bucket, keys, stats):
+    """
+    Deletes keys with DeleteObjects in batches of delete_batch_size. Returns False when the
+    remaining-time cutoff was hit before every batch was sent.
+    """
+    start = time.perf_counter()
+    deleted_before = stats['deleted']
+    with metrics.step('refresh.delete') as step:
+        try:
+            for offset in range(0, len(keys), delete_batch_size):
+                batch = keys[offset:offset + delete_batch_size]
+                response = s3.delete_objects(Bucket=destination_bucket,
+                                             Delete={'Objects': [{'Key': key} for key in batch], 'Quiet': True})
+                errors = response.get('Errors', [])
+                for error in errors:
+                    print(f"Failed to delete {error.get('Key')}: {error.get('Code')} {error.get('Message')}")
+                stats['deleted'] += len(batch) - len(errors)
+                if offset + delete_batch_size < len(keys) and context.get_remaining_time_in_millis() < time_cutoff_ms:
+                    return False
+            return True
+        finally:
+            stats['delete_seconds'] += time.perf_counter() - start
+            step.add('rows_in', len(keys))
+            step.add('rows_out', stats['deleted'] - deleted_before)
+
+def refresh_bucket(s3, context, source_bucket, source_prefix, destination_bucket, lookback_days, source_token, dest_token):
+    """
+    Copies source objects modified within the lookback window to the destination bucket, then
+    deletes destination objects older than the window. When the Lambda runs short on time it
+    returns the continuation token of the page in progress, so the next invocation redoes that
+    page instead of skipping its remaining keys.
+    """
+    time_threshold = datetime.utcnow() - timedelta(days=lookback_days)
+    time_threshold = time_threshold.replace(tzinfo=timezone.utc)
+    stats = {'copied': 0, 'copied_bytes': 0, 'copy_seconds': 0.0, 'deleted': 0, 'delete_seconds': 0.0}
+
+    def result(status, token=None, phase=None):
+        result = {'status': status}
+        if status == 'incomplete':
+            result['ContinuationToken'] = token
+            result['phase'] = phase
+        result.update(stats)
+        result['copy_seconds'] = round(stats['copy_seconds'], 3)
+        result['delete_seconds'] = round(stats['delete_seconds'], 3)
+        copy_rate = throughput(stats['copied'], stats['copied_bytes'], stats['copy_seconds'])
+        result['copies_per_sec'] = copy_rate['per_sec']
+        result['copy_bytes_per_sec'] = copy_rate['bytes_per_sec']
+        result['deletes_per_sec'] = throughput(stats['deleted'], 0, stats['delete_seconds'])['per_sec']
+        print(f"Refresh of {destination_bucket}: copied {stats['copied']} objects ({result['copies_per_sec']}/s, "
+              f"{result['copy_bytes_per_sec']} bytes/s), deleted {stats['deleted']} objects ({result['deletes_per_sec']}/s)")
+        return result
+
+    # Initialize S3 paginator for source bucket
+    source_paginator = s3.get_paginator('list_objects_v2')
+    operation_parameters = {
+        'Bucket': source_bucket,
+        'Prefix': source_prefix,
+    }
+
+    if source_token:
+        operation_parameters['ContinuationToken'] = source_token
 
-        if dest_token:
-            dest_operation_parameters['ContinuationToken'] = dest_token
+    # Processing new files
+    page_token = source_token
+    for page in source_paginator.paginate(**operation_parameters):
+        objects = sorted(page.get('Contents', []), key=lambda x: x['LastModified'], reverse=True)
+        to_copy = [obj for obj in objects if obj['LastModified'] >= time_threshold]
+        if not copy_page(s3, context, source_bucket, destination_bucket, to_copy, stats):
+            return result('incomplete', page_token, 'copy')
+        page_token = page.get('NextContinuationToken')
+        if page_token and context.get_remaining_time_in_millis() < time_cutoff_ms:
+            return result('incomplete', page_token, 'copy')
 
-        # Deleting old files from destination bucket
-        for page in dest_paginator.paginate(**dest_operation_parameters):
+    # Initialize S3 paginator for destination bucket
+    dest_paginator = s3.get_paginator('list_objects_v2')
+    dest_operation_parameters = {
+        'Bucket': destination_bucket,
+        'Prefix': source_prefix,
+    }
+
+    if dest_token:
+        dest_operation_parameters['ContinuationToken'] = dest_token
+
+    # Deleting old files from destination bucket
+    page_token = dest_token
+    for page in dest_paginator.paginate(**dest_operation_parameters):
+        to_delete = []
+        for obj in page.get('Contents', []):
+            if obj['LastModified'] < time_threshold:
+                print(f"Deleting {obj['Key']} from destination, last modified: {obj['LastModified']}")
+                to_delete.append(obj['Key'])
+        if not delete_keys(s3, context, destination_bucket, to_delete, stats):
+            return result('incomplete', page_token, 'delete')
+        page_token = page.get('NextContinuationToken')
+        if page_token and context.get_remaining_time_in_millis() < time_cutoff_ms:
+            return result('incomplete', page_token, 'delete')
+
+    return result('complete')
+
+def list_objects(s3, bucket, prefix):
+    """Lists every object under the prefix once and returns them keyed by object key."""
+    objects = {}
+    with metrics.step('refresh.list') as step:
+        for page in s3.get_paginator('list_objects_v2').paginate(Bucket=bucket, Prefix=prefix):
+            for obj in page.get('Contents', []):
+                objects[obj['Key']] = obj
+        step.add('rows_out', len(objects))
+    return objects
+
+def list_source(s3, bucket, prefix, lookback_days):
+    """
+    Lists the source objects a refresh with this lookback can need. Date-first partitions
+    (`{prefix}/date=YYYY-MM-DD/...`) are listed from the window's first day onwards with StartAfter,
+    so older days are never paginated. That day is taken in api_timezone, like the partition dates
+    themselves. Partitions are selected by the date in their key, so an older day rewritten recently
+    is not listed. Everything else under the prefix, such as single processed files and board-first
+    partitions, is found with a delimiter listing and scanned in full; the date prefixes only
+    appear there as rolled-up CommonPrefixes.
+    """
+    if not prune_listing:
+        return list_objects(s3, bucket, prefix)
+    first_day = (datetime.now(ZoneInfo(api_timezone)) - timedelta(days=lookback_days)).strftime('%Y-%m-%d')
+    dated_prefix = f"{prefix}/date="
+    paginator = s3.get_paginator('list_objects_v2')
+    objects = {}
+    fallback_prefixes = []
+    with metrics.step('refresh.list') as step:
+        for page in paginator.paginate(Bucket=bucket, Prefix=dated_prefix, StartAfter=dated_prefix + first_day):
             for obj in page.get('Contents', []):
-                last_modified = obj['LastModified']
-                key = obj['Key']
-                if last_modified < time_threshold:
-                    print(f'Deleting {key} from destination, last modified: {last_modified}')
-                    s3.delete_object(Bucket=destination_bucket, Key=key)
-
-                if context.get_remaining_time_in_millis() < 10000:
-                    next_token = page.get('NextContinuationToken', None)
-                    return {
-                        'ContinuationToken': next_token,
-                        'status': 'incomplete'
-                    }
-
-        return "Refresh completed"
-
-    # Primary refresh
-    primary_result = refresh_bucket(
-        s3_info['bucket'], s3_info['data_prefix'], 
-        s3_destinations['roling_bucket'], int(s3_destinations['lookback_days']),
-        event.get('sourceContinuationToken'), event.get('destContinuationToken')
-    )
-
-    if primary_result != "Refresh completed":
-        return primary_result
-
-    # Alternate refresh
-    alt_result = refresh_bucket(
-        s3_info['bucket'], s3_info['data_prefix'], 
-        s3_destinations['daily_bucket_rolling'], int(s3_destinations['daily_lookback_days']),
-        event.get('altSourceContinuationToken'), event.get('altDestContinuationToken')
-    )
-
-    return alt_result if alt_result != "Refresh completed" else "Both refresh processes completed"
\ No newline at end of file
+                objects[obj['Key']] = obj
+        for page in paginator.paginate(Bucket=bucket, Prefix=f"{prefix}/", Delimiter='/'):
+            for obj in page.get('Contents', []):
+                objects[obj['Key']] = obj
+            fallback_prefixes.extend(common['Prefix'] for common in page.get('CommonPrefixes', [])
+                                     if not common['Prefix'].startswith(dated_prefix))
+        step.add('rows_out', len(objects))
+    for fallback_prefix in fallback_prefixes:
+        objects.update(list_objects(s3, bucket, fallback_prefix))
+    return objects
+
+class SourceIndex(dict):
+    """
+    A source listing keyed by object key that also keeps its objects sorted by LastModified, so each
+    destination's window is a bisect instead of a scan over the whole listing.
+    """
+    def __init__(self, objects):
+        super().__init__(objects)
+        self.by_time = sorted(self.values(), key=lambda x: x['LastModified'])
+        self.times = [obj['LastModified'] for obj in self.by_time]
+
+    def since(self, time_threshold):
+        """Returns objects modified at or after the threshold, newest first."""
+        return self.by_time[bisect.bisect_left(self.times, time_threshold):][::-1]
+
+def in_sync(source, destination):
+    """
+    An object is in sync when the sizes match and either the ETags match or the destination copy
+    is at least as new as the source. The second check covers multipart uploads, whose ETag
+    changes when copy_object rewrites them as a single part.
+    """
+    if destination is None or source['Size'] != destination['Size']:
+        return False
+    return source.get('ETag') == destination.get('ETag') or destination['LastModified'] >= source['LastModified']
+
+def plan_refresh(source_objects, destination_objects, time_threshold):
+    """
+    Diffs two listings. Source objects inside the window are copied when missing from or changed in
+    the destination; destination objects last modified before the window are deleted, unless their
+    source object is inside the window, since an in-sync copy keeps its older LastModified.
+    """
+    if not isinstance(source_objects, SourceIndex):
+        source_objects = SourceIndex(source_objects)
+    plan = {'copy': [], 'delete': [], 'in_sync': 0}
+    in_window = set()
+    for obj in source_objects.since(time_threshold):
+        in_window.add(obj['Key'])
+        destination = destination_objects.get(obj['Key'])
+        if in_sync(obj, destination):
+            plan['in_sync'] += 1
+        else:
+            plan['copy'].append(dict(obj, Reason='missing' if destination is None else 'changed'))
+    plan['delete'] = sorted(key for key, obj in destination_objects.items()
+                            if obj['LastModified'] < time_threshold and key not in in_window)
+    return plan
+
+class CheckpointStore:
+    """
+    Keeps the refresh checkpoint as JSON, either in S3 under state_prefix (`s3`) or in a local file
+    (`local`), which stands in for S3 when running outside Lambda. An empty dict means no checkpoint.
+    """
+    def __init__(self, s3, backend=checkpoint_store, path=checkpoint_path):
+        self.s3 = s3
+        self.backend = backend
+        self.path = path
+        self.key = f"{state_prefix}/refresh_checkpoint.json"
+
+    def load(self):
+        if self.backend == 'local':
+            if not os.path.exists(self.path):
+                return {}
+            with open(self.path, 'r') as f:
+                return json.load(f)
+        return load_json_state(self.s3, s3_info['bucket'], self.key)
+
+    def save(self, checkpoint):
+        if self.backend == 'local':
+            with open(self.path, 'w') as f:
+                json.dump(checkpoint, f)
+            return
+        save_json_state(self.s3, s3_info['bucket'], self.key, checkpoint)
+
+    def clear(self):
+        self.save({})
+
+def plan_destination(s3, source_bucket, source_prefix, destination_bucket, lookback_days, source_index=None):
+    """
+    Lists the destination (and the source, unless a shared source_index is passed) and returns the
+    destination's progress record: the diff summary, the planned copies and deletes, and cursors
+    counting how many of each are done. The record is JSON-serializable so it can be checkpointed.
+    """
+    time_threshold = datetime.utcnow() - timedelta(days=lookback_days)
+    time_threshold = time_threshold.replace(tzinfo=timezone.utc)
+    start = time.perf_counter()
+    source_objects = source_index
+    if source_objects is None:
+        source_objects = SourceIndex(list_source(s3, source_bucket, source_prefix, lookback_days))
+    destination_objects = list_objects(s3, destination_bucket, source_prefix)
+    plan = plan_refresh(source_objects, destination_objects, time_threshold)
+    summary = {
+        'source_objects': len(source_objects),
+        'destination_objects': len(destination_objects),
+        'in_sync': plan['in_sync'],
+        'planned_copies': len(plan['copy']),
+        'planned_deletes': len(plan['delete']),
+        'list_seconds': round(time.perf_counter() - start, 3),
+    }
+    print(f"Refresh plan for {destination_bucket}: {summary['planned_copies']} to copy, "
+          f"{summary['planned_deletes']} to delete, {summary['in_sync']} already in sync")
+    return {
+        'lookback_days': lookback_days,
+        'status': 'planned',
+        'summary': summary,
+        'copy': [{'Key': obj['Key'], 'Size': obj['Size'], 'LastModified': obj['LastModified'].isoformat(),
+                  'Reason': obj['Reason']} for obj in plan['copy']],
+        'delete': [{'Key': key, 'LastModified': destination_objects[key]['LastModified'].isoformat()}
+                   for key in plan['delete']],
+        'copy_cursor': 0,
+        'delete_cursor': 0,
+    }
+
+def print_plan(progress):
+    for obj in progress['copy']:
+        print(f"Would copy {obj['Key']} ({obj['Reason']}), last modified: {obj['LastModified']}")
+    for obj in progress['delete']:
+        print(f"Would delete {obj['Key']} from destination, last modified: {obj['LastModified']}")
+
+def run_destination(s3, context, source_bucket, destination_bucket, progress, save=None):
+    """
+    Works through a destination's remaining planned copies, checkpoint_every objects at a time, then
+    its remaining deletes one batch at a time. Finished work is removed from the progress record and
+    counted in its cursors, and `save` is called after every step, so an invocation that stops at the
+    time cutoff leaves behind exactly the work still to do.
+    """
+    stats = {'copied': 0, 'copied_bytes': 0, 'copy_seconds': 0.0, 'deleted': 0, 'delete_seconds': 0.0}
+
+    def checkpoint():
+        if save is not None:
+            save()
+
+    def result(status, phase=None):
+        progress['status'] = status
+        checkpoint()
+        result = dict(progress['summary'], status=status, **stats)
+        if phase:
+            result['phase'] = phase
+        result['copy_cursor'] = progress['copy_cursor']
+        result['delete_cursor'] = progress['delete_cursor']
+        result['copy_seconds'] = round(stats['copy_seconds'], 3)
+        result['delete_seconds'] = round(stats['delete_seconds'], 3)
+        result['copies_per_sec'] = throughput(stats['copied'], stats['copied_bytes'], stats['copy_seconds'])['per_sec']
+        result['deletes_per_sec'] = throughput(stats['deleted'], 0, stats['delete_seconds'])['per_sec']
+        print(f"Refresh of {destination_bucket}: copied {stats['copied']} objects ({result['copies_per_sec']}/s), "
+              f"deleted {stats['deleted']} objects ({result['deletes_per_sec']}/s), "
+              f"{len(progress['copy'])} copies and {len(progress['delete'])} deletes left")
+        return result
+
+    while progress['copy']:
+        if context.get_remaining_time_in_millis() < time_cutoff_ms:
+            return result('incomplete', 'copy')
+        chunk = progress['copy'][:checkpoint_every]
+        done = []
+        completed = copy_page(s3, context, source_bucket, destination_bucket, chunk, stats, done)
+        done_keys = {obj['Key'] for obj in done}
+        progress['copy'] = [obj for obj in chunk if obj['Key'] not in done_keys] + progress['copy'][len(chunk):]
+        progress['copy_cursor'] += len(done)
+        if not completed:
+            return result('incomplete', 'copy')
+        checkpoint()
+
+    while progress['delete']:
+        if context.get_remaining_time_in_millis() < time_cutoff_ms:
+            return result('incomplete', 'delete')
+        batch = progress['delete'][:delete_batch_size]
+        for obj in batch:
+            print(f"Deleting {obj['Key']} from destination, last modified: {obj['LastModified']}")
+        delete_keys(s3, context, destination_bucket, [obj['Key'] for obj in batch], stats)
+        progress['delete'] = progress['delete'][len(batch):]
+        progress['delete_cursor'] += len(batch)
+        checkpoint()
+    return result('complete')
+
+def checkpoint_usable(checkpoint, destinations):
+    """A checkpoint is resumed only if it covers the same destinations and is recent enough to trust."""
+    if not checkpoint.get('progress') or checkpoint.get('destinations') != [list(d) for d in destinations]:
+        return False
+    age = datetime.now(timezone.utc) - datetime.fromisoformat(checkpoint['planned_at'])
+    if age > timedelta(minutes=checkpoint_max_age_minutes):
+        print(f"Refresh checkpoint is {age} old, replanning")
+        return False
+    return True
+
+def refresh_fanout(s3, context, source_bucket, source_prefix, destinations, dry_run=False, checkpoints=None, resume=True):
+    """
+    Lists the source once into a SourceIndex and plans each (bucket, lookback_days) destination from
+    it, then works through the plans in order. With a CheckpointStore the plans and their cursors
+    are saved as work completes; a later invocation with resume picks up the remaining work instead
+    of listing and diffing again. Stops at the first destination that does not finish in time.
+    """
+    checkpoint = checkpoints.load() if checkpoints is not None and resume and not dry_run else {}
+    resumed = checkpoint_usable(checkpoint, destinations)
+    if resumed:
+        remaining = sum(len(p['copy']) + len(p['delete']) for p in checkpoint['progress'].values())
+        print(f"Resuming refresh planned at {checkpoint['planned_at']} with {remaining} operations left")
+    else:
+        start = time.perf_counter()
+        source_index = SourceIndex(list_source(s3, source_bucket, source_prefix, max(days for _, days in destinations)))
+        print(f"Listed {len(source_index)} source objects in {time.perf_counter() - start:.2f}s "
+              f"for {len(destinations)} destinations")
+        checkpoint = {
+            'planned_at': datetime.now(timezone.utc).isoformat(),
+            'destinations': [list(d) for d in destinations],
+            'progress': {bucket: plan_destination(s3, source_bucket, source_prefix, bucket, days, source_index)
+                         for bucket, days in destinations},
+        }
+        if dry_run:
+            for progress in checkpoint['progress'].values():
+                print_plan(progress)
+            return {'status': 'Dry run planned',
+                    'destinations': {bucket: dict(p['summary'], status='dry_run') for bucket, p in checkpoint['progress'].items()}}
+
+    save = (lambda: checkpoints.save(checkpoint)) if checkpoints is not None else None
+    results = {}
+    for destination_bucket, _ in destinations:
+        progress = checkpoint['progress'][destination_bucket]
+        if progress['status'] == 'complete':
+            results[destination_bucket] = dict(progress['summary'], status='complete')
+            continue
+        result = run_destination(s3, context, source_bucket, destination_bucket, progress, save)
+        results[destination_bucket] = result
+        if result['status'] != 'complete':
+            return {'status': 'incomplete', 'destination': destination_bucket, 'resumed': resumed,
+                    'destinations': results}
+    if checkpoints is not None:
+        checkpoints.clear()
+    return {'status': 'All refresh destinations completed', 'resumed': resumed, 'destinations': results}
+
+def invoke_continuation(context, event):
+    """
+    Re-invokes this function asynchronously so an incomplete refresh drains from its checkpoint
+    without waiting for the next schedule. Only the refresh phase runs in the continuation.
+    """
+    invocation = int(event.get('selfInvocation', 0)) + 1
+    if invocation > max_self_invocations:
+        print(f"Refresh still incomplete after {max_self_invocations} continuations, leaving the rest to the next run")
+        return None
+    payload = {'phases': ['refresh'], 'resume': True, 'selfInvocation': invocation}
+    boto3.client('lambda').invoke(FunctionName=context.invoked_function_arn, InvocationType='Event',
+                                  Payload=json.dumps(payload).encode('utf-8'))
+    print(f"Invoked refresh continuation {invocation} of {max_self_invocations}")
+    return invocation
+
+def legacy_tokens(event, position, destination_bucket):
+    """
+    Continuation tokens for the page-by-page refresh. The first two destinations keep their original
+    event keys; later ones read event['continuationTokens'][bucket] = {'source': ..., 'dest': ...}.
+    """
+    names = [('sourceContinuationToken', 'destContinuationToken'),
+             ('altSourceContinuationToken', 'altDestContinuationToken')]
+    if position < len(names):
+        return event.get(names[position][0]), event.get(names[position][1])
+    tokens = event.get('continuationTokens', {}).get(destination_bucket, {})
+    return tokens.get('source'), tokens.get('dest')
+
+def handle_refresh(event, context):
+    """
+    Keeps every destination in sync with the source. With diff_refresh, or for a `dryRun` event,
+    the listings are diffed and only missing or changed objects are copied; a dry run prints the
+    plan without writing. An event `resume` overrides resume_refresh for one run. Otherwise the
+    legacy page-by-page copy runs, driven by the continuation tokens in the event.
+    """
+    s3 = boto3.client('s3', config=Config(max_pool_connections=copy_workers))
+    dry_run = bool(event.get('dryRun', False))
+    destinations = refresh_destinations()
+
+    # A dry run always plans with the diff engine, which is the only path that can report without writing
+    if diff_refresh or dry_run:
+        checkpoints = CheckpointStore(s3) if checkpoint_store != 'off' else None
+        resume = bool(event.get('resume', resume_refresh))
+        result = refresh_fanout(s3, context, s3_info['bucket'], s3_info['data_prefix'], destinations, dry_run,
+                                checkpoints, resume)
+        if result['status'] == 'incomplete' and checkpoints is not None:
+            if self_invoke:
+                result['continuation'] = invoke_continuation(context, event)
+            else:
+                print("Refresh incomplete; the rest resumes from the checkpoint at the next scheduled run")
+        return result
+
+    results = {}
+    for position, (destination_bucket, lookback_days) in enumerate(destinations):
+        source_token, dest_token = legacy_tokens(event, position, destination_bucket)
+        result = refresh_bucket(s3, context, s3_info['bucket'], s3_info['data_prefix'],
+                                destination_bucket, lookback_days, source_token, dest_token)
+        results[destination_bucket] = result
+        if result['status'] != 'complete':
+            return dict(result, destination=destination_bucket)
+    return {'status': 'All refresh destinations completed', 'destinations': results}
@@ -8,7 +8,9 @@ Skips network-dependent tests when run locally.
 import os
 import sys
 import json
+import threading
 import traceback
+from contextlib import contextmanager
 
 os.chdir(os.path.dirname(os.path.abspath(__file__)))
 
@@ -20,11 +22,139 @@ class MockContext:
     memory_limit_in_mb = 512
     invoked_function_arn = "arn:aws:lambda:us-east-1:123456789:function:test"
     aws_request_id = "test-request-id"
-    
+
     def get_remaining_time_in_millis(self):
         return 300000  # 5 minutes
 
 
+class FakeS3:
+    """
+    In-memory stand-in for the S3 client and resource calls gather and process make. Objects are keyed
+    by key alone; the bucket is ignored.
+    """
+    class exceptions:
+        class NoSuchKey(Exception):
+            pass
+
+    def __init__(self):
+        from types import SimpleNamespace
+        self.objects = {}
+        self.uploads = {}
+        self.completed_uploads = []
+        self.meta = SimpleNamespace(client=self)
+
+    def _put(self, key, body, metadata=None):
+        import hashlib
+        body = body.encode('utf-8') if isinstance(body, str) else bytes(body)
+        etag = f'"{hashlib.md5(body).hexdigest()}"'
+        self.objects[key] = {'Body': body, 'ETag': etag, 'Metadata': metadata or {}}
+        return {'ETag': etag}
+
+    def get_object(self, Bucket, Key, IfNoneMatch=None):
+        import io
+        from botocore.exceptions import ClientError
+        if Key not in self.objects:
+            raise self.exceptions.NoSuchKey(Key)
+        obj = self.objects[Key]
+        if IfNoneMatch == obj['ETag']:
+            raise ClientError({'Error': {'Code': '304'}}, 'GetObject')
+        return {'Body': io.BytesIO(obj['Body']), 'ETag': obj['ETag'], 'Metadata': obj['Metadata']}
+
+    def put_object(self, Bucket, Key, Body, Metadata=None, **kwargs):
+        return self._put(Key, Body, Metadata)
+
+    def upload_fileobj(self, fileobj, bucket, key):
+        self._put(key, fileobj.read())
+
+    def download_fileobj(self, bucket, key, fileobj):
+        fileobj.write(self.get_object(Bucket=bucket, Key=key)['Body'].read())
+
+    def copy_object(self, Bucket, CopySource, Key):
+        self._put(Key, self.objects[CopySource['Key']]['Body'])
+
+    def copy(self, CopySource, Bucket, Key):
+        self.copy_object(Bucket, CopySource, Key)
+
+    def delete_object(self, Bucket, Key):
+        self.objects.pop(Key, None)
+
+    def create_multipart_upload(self, Bucket, Key):
+        upload_id = str(len(self.uploads) + 1)
+        self.uploads[upload_id] = {}
+        return {'UploadId': upload_id}
+
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body):
+        self.uploads[UploadId][PartNumber] = Body
+        return {'ETag': f'"part{PartNumber}"'}
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload):
+        parts = self.uploads.pop(UploadId)
+        self.completed_uploads.append([len(parts[part['PartNumber']]) for part in MultipartUpload['Parts']])
+        self._put(Key, b''.join(parts[part['PartNumber']] for part in MultipartUpload['Parts']))
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId):
+        self.uploads.pop(UploadId, None)
+
+    def Bucket(self, name):
+        from types import SimpleNamespace
+        def listing(Prefix=''):
+            return [SimpleNamespace(key=key, e_tag=obj['ETag']) for key, obj in sorted(self.objects.items())
+                    if key.startswith(Prefix)]
+        return SimpleNamespace(objects=SimpleNamespace(filter=listing))
+
+    def Object(self, bucket, key):
+        from types import SimpleNamespace
+        return SimpleNamespace(get=lambda: self.get_object(Bucket=bucket, Key=key),
+                               put=lambda Body: self.put_object(Bucket=bucket, Key=key, Body=Body),
+                               delete=lambda: self.delete_object(Bucket=bucket, Key=key))
+
+
+@contextmanager
+def local_api(respond):
+    """
+    Serves respond(path, headers) -> (status, headers, body) on localhost over HTTP/1.1 keep-alive and
+    points gather at it with throttling off. Yields the server, which records each client connection
+    in `connections` and each request path in `requests`.
+    """
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+    import gather
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def do_GET(self):
+            with server.lock:
+                server.connections.add(self.client_address)
+                server.requests.append(self.path)
+            status, headers, body = respond(self.path, self.headers)
+            self.send_response(status)
+            for name, value in headers.items():
+                self.send_header(name, value)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    server.daemon_threads = True
+    server.lock = threading.Lock()
+    server.connections = set()
+    server.requests = []
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    saved = gather.url, gather.rate_limiter
+    gather.url = f'http://127.0.0.1:{server.server_address[1]}'
+    gather.rate_limiter = gather.TokenBucket(0, 1)
+    try:
+        yield server
+    finally:
+        gather.url, gather.rate_limiter = saved
+        server.shutdown()
+        server.server_close()
+
+
 def test_config_loading():
     """Test configuration file loading."""
     print("\n=== Testing Config Loading ===")
@@ -137,6 +267,1054 @@ def test_nltk_data():
         return False
 
 
+def test_concurrent_fetch():
+    """Test that threads are fetched concurrently over reused connections and yielded in catalog order."""
+    print("\n=== Testing Concurrent Fetch ===")
+    try:
+        import time
+        from gather import fetch_threads, concurrency
+
+        def respond(path, headers):
+            time.sleep(0.1)
+            thread = int(path.rsplit('/', 1)[1].split('.')[0])
+            if thread == 7:
+                return 404, {}, b''
+            return 200, {'Content-Type': 'application/json'}, json.dumps({'posts': [{'no': thread}]}).encode('utf-8')
+
+        thread_no = list(range(1, 4 * concurrency + 1))
+        with local_api(respond) as server:
+            start = time.perf_counter()
+            fetched = list(fetch_threads('pol', thread_no, {}, {}, {}))
+            elapsed = time.perf_counter() - start
+        expected = [item for item in thread_no if item != 7]
+        if [item for item, _ in fetched] != expected or any(posts != [{'no': item}] for item, posts in fetched):
+            print(f"[FAIL] Unexpected threads or order: {[item for item, _ in fetched][:10]}...")
+            return False
+        if elapsed > len(thread_no) * 0.1 / 4:
+            print(f"[FAIL] {len(thread_no)} fetches took {elapsed:.2f}s, not concurrent")
+            return False
+        if len(server.connections) > concurrency:
+            print(f"[FAIL] {len(server.connections)} connections opened for {concurrency} fetch threads")
+            return False
+        print(f"[OK] Fetched {len(fetched)} threads in {elapsed:.2f}s over {len(server.connections)} connections")
+        return True
+    except Exception as e:
+        print(f"[FAIL] Error: {e}")
+        traceback.print_exc()
+        return False
+
+
+def test_incremental_gather_process():
+    """Test that an incremental gather of reply-only posts feeds an incremental process run."""
+    print("\n=== Testing Incremental Gather and Process ===")
+    try:
+        import io
+        import time
+        import pandas as pd
+        import gather
+        import process
+
+        posted = int(time.time()) - 3600
+        op = {'no': 1001, 'resto': 0, 'time': posted, 'sub': 'Markets', 'com': 'btc to the moon', 'filename': 'chart',
+              'replies': 0, 'country': 'US', 'flag_name': 'United States'}
+        reply = {'no': 1002, 'resto': 1001, 'time': posted + 60, 'com': 'fed rate cut soon'}
+        api = {'catalog': [{'threads': [{'no': 1001, 'last_modified': posted, 'replies': 0}]}], 'posts': [op]}
+
+        def respond(path, headers):
+            body = api['catalog'] if path.endswith('catalog.json') else {'posts': api['posts']}
+            return 200, {'Content-Type': 'application/json'}, json.dumps(body).encode('utf-8')
+
+        s3 = FakeS3()
+        saved_client = process._s3_client
+        process._s3_client = s3
+        try:
+            with local_api(respond):
+                first = gather.gather_board(s3, 'pol'), process.process_board(s3, 'pol')
+                # Raw keys are timestamped to the second
+                time.sleep(1.1)
+                api['catalog'] = [{'threads': [{'no': 1001, 'last_modified': posted + 60, 'replies': 1}]}]
+                api['posts'] = [dict(op, replies=1), reply]
+                second = gather.gather_board(s3, 'pol'), process.process_board(s3, 'pol')
+                unchanged = gather.gather_board(s3, 'pol')
+        finally:
+            process._s3_client = saved_client
+
+        if [stats['status'] for stats in first + second] != ['uploaded', 'processed', 'uploaded', 'processed']:
+            print(f"[FAIL] Unexpected statuses: {first}, {second}")
+            return False
+        if second[0]['changed_threads'] != 1 or second[0]['rows'] != 1 or unchanged['changed_threads'] != 0:
+            print(f"[FAIL] Thread-state index did not limit fetches to new posts: {second[0]}, {unchanged}")
+            return False
+        raw_keys = sorted(key for key in s3.objects if key.startswith(f'{gather.raw_prefix}/pol_'))
+        latest_raw = pd.read_csv(io.BytesIO(s3.objects[raw_keys[-1]]['Body']))
+        if list(latest_raw.columns) != gather.raw_columns('pol'):
+            print(f"[FAIL] Reply-only raw file has columns {list(latest_raw.columns)}")
+            return False
+        output = pd.read_csv(io.BytesIO(s3.objects[second[1]['output_key']]['Body']))
+        if sorted(output['thread_id']) != [1001, 1002] or second[1]['new_files'] != 1:
+            print(f"[FAIL] Processed output has threads {sorted(output['thread_id'])}: {second[1]}")
+            return False
+        print(f"[OK] Second run gathered {second[0]['rows']} reply and merged it into {len(output)} processed rows")
+        return True
+    except Exception as e:
+        print(f"[FAIL] Error: {e}")
+        traceback.print_exc()
+        return False
+
+
+def test_gather_deadline():
+    """Test that gather stops near the Lambda deadline, keeps what it fetched and fetches the rest next run."""
+    print("\n=== Testing Gather Deadline ===")
+    try:
+        import time
+        import gather
+        from utils import load_json_state
+
+        posted = int(time.time()) - 3600
+        numbers = list(range(3001, 3007))
+        catalog = [{'threads': [{'no': no, 'last_modified': posted, 'replies': 0} for no in numbers]}]
+
+        def respond(path, headers):
+            if path.endswith('catalog.json'):
+                body = catalog
+            else:
+                no = int(path.rsplit('/', 1)[1].split('.')[0])
+                body = {'posts': [{'no': no, 'resto': 0, 'time': posted, 'sub': 'Markets', 'com': f'thread {no}'}]}
+            return 200, {'Content-Type': 'application/json'}, json.dumps(body).encode('utf-8')
+
+        class ExpiringContext(MockContext):
+            """Reports plenty of time for the first three thread submissions, then none."""
+            checks = 0
+
+            def get_remaining_time_in_millis(self):
+                self.checks += 1
+                return 300000 if self.checks <= 3 else 0
+
+        s3 = FakeS3()
+        with local_api(respond) as server:
+            first = gather.gather_board(s3, 'pol', ExpiringContext())
+            state = load_json_state(s3, gather.bucket_name, gather.thread_state_key('pol'))
+            first_requests = len(server.requests)
+            time.sleep(1.1)
+            second = gather.gather_board(s3, 'pol', MockContext())
+            second_threads = sorted(int(path.rsplit('/', 1)[1].split('.')[0]) for path in server.requests[first_requests:]
+                                    if '/thread/' in path)
+        if not first.get('deadline_reached') or first['rows'] != 3 or sorted(state) != [str(no) for no in numbers[:3]]:
+            print(f"[FAIL] Unexpected first run {first} with state for {sorted(state)}")
+            return False
+        if second.get('deadline_reached') or second['changed_threads'] != 3 or second_threads != numbers[3:]:
+            print(f"[FAIL] Second run {second} fetched threads {second_threads}")
+            return False
+        print(f"[OK] Stopped after {first['rows']} threads at the deadline and fetched {second_threads} next run")
+        return True
+    except Exception as e:
+        print(f"[FAIL] Error: {e}")
+        traceback.print_exc()
+        return False
+
+
+def test_conditional_requests():
+    """Test that cached validators are sent back and a 304 is reported as not modified."""
+    print("\n=== Testing Conditional Requests ===")
+    try:
+        from gather import fetch_thread, NOT_MODIFIED
+
+        etag = '"v1"'
+
+        def respond(path, headers):
+            if headers.get('If-None-Match') == etag:
+                return 304, {'ETag': etag}, b''
+            return 200, {'ETag': etag, 'Content-Type': 'application/json'}, json.dumps({'posts': [{'no': 5}]}).encode('utf-8')
+
+        validators, pending, stats = {}, {}, {}
+        with local_api(respond):
+            first = fetch_thread('pol', 5, validators, pending, stats)
+            validators.update(pending)
+            second = fetch_thread('pol', 5, validators, {}, stats)
+        if first != [{'no': 5}] or second is not NOT_MODIFIED:
+            print(f"[FAIL] Expected posts then NOT_MODIFIED, got {first} and {second}")
+            return False
+        if [entry.get('etag') for entry in validators.values()] != [etag] or stats.get('requests') != 2:
+            print(f"[FAIL] Unexpected validators {validators} or stats {stats}")
+            return False
+        print(f"[OK] Second request for the thread returned 304 using validator {etag}")
+        return True
+    except Exception as e:
+        print(f"[FAIL] Error: {e}")
+        traceback.print_exc()
+        return False
+
+
+def test_stream_gather():
+    """Test bounded read-ahead in fetch_threads, the streamed raw file and multipart part splitting."""
+    print("\n=== Testing Stream Gather ===")
+    try:
+        import gzip
+        import io
+        import time
+        import pandas as pd
+        from gather import fetch_threads, fetch_window, write_raw_stream, raw_columns
+        from utils import S3MultipartWriter
+
+        def respond(path, headers):
+            thread = int(path.rsplit('/', 1)[1].split('.')[0])
+            return 200, {'Content-Type': 'application/json'}, json.dumps({'posts': [{'no': thread}]}).encode('utf-8')
+
+        with local_api(respond) as server:
+            fetched = fetch_threads('pol', list(range(1, 4 * fetch_window)), {}, {}, {})
+            next(fetched)
+            time.sleep(0.3)
+            requested = len(server.requests)
+            fetched.close()
+        if requested > fetch_window + 1:
+            print(f"[FAIL] {requested} threads requested while the consumer held the first one")
+            return False
+
+        s3 = FakeS3()
+        posted = int(time.time())
+        batches = [[{'no': 1, 'time': posted, 'sub': 'OP', 'com': 'first', 'filename': 'a', 'replies': 1}],
+                   [{'no': 2, 'time': posted + 1, 'com': 'reply'}]]
+        rows = write_raw_stream(s3, 'pol', iter(batches), '2026-01-15 00:00:00')
+        key, = s3.objects
+        data = pd.read_csv(io.BytesIO(gzip.decompress(s3.objects[key]['Body'])))
+        if rows != 2 or list(data.columns) != raw_columns('pol') or data['no'].tolist() != [1, 2]:
+            print(f"[FAIL] Streamed {rows} rows with columns {list(data.columns)}")
+            return False
+
+        writer = S3MultipartWriter(s3, 'bucket', 'big.bin', part_size=S3MultipartWriter.min_part_size)
+        chunk = b'x' * (1024 * 1024)
+        for _ in range(12):
+            writer.write(chunk)
+        writer.close()
+        part_mb = [size // (1024 * 1024) for size in s3.completed_uploads[-1]]
+        if part_mb != [5, 5, 2] or len(s3.objects['big.bin']['Body']) != 12 * len(chunk):
+            print(f"[FAIL] Unexpected multipart parts: {part_mb} MB")
+            return False
+        print(f"[OK] {requested} threads read ahead of the consumer, streamed {rows} rows, parts of {part_mb} MB")
+        return True
+    except Exception as e:
+        print(f"[FAIL] Error: {e}")
+        traceback.print_exc()
+        return False
+
+
+def test_token_bucket():
+    """Test that the shared token bucket holds concurrent callers to its rate after the burst."""
+    print("\n=== Testing Token Bucket ===")
+    try:
+        import time
+        from concurrent.futures import ThreadPoolExecutor
+        from gather import TokenBucket, get_session, concurrency, board_concurrency
+
+        bucket = TokenBucket(rate=50, burst=5)
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=6) as executor:
+            list(executor.map(lambda _: bucket.acquire(), range(30)))
+        elapsed = time.perf_counter() - start
+        # 5 tokens are available at once and the other 25 refill at 50 per second
+        if not 0.45 <= elapsed < 1.0:
+            print(f"[FAIL] 30 acquires took {elapsed:.2f}s, expected about 0.5s")
+            return False
+        if TokenBucket(rate=0, burst=1).acquire() != 0.0:
+            print("[FAIL] A rate of 0 should not throttle")
+            return False
+        pool_size = get_session('http://127.0.0.1/').get_adapter('http://127.0.0.1/')._pool_maxsize
+        if pool_size != concurrency * board_concurrency:
+            print(f"[FAIL] Session pool holds {pool_size} connections for {board_concurrency} boards of {concurrency} threads")
+            return False
+        print(f"[OK] 30 acquires at 50/s with a burst of 5 took {elapsed:.2f}s; session pool holds {pool_size}")
+        return True
+    except Exception as e:
+        print(f"[FAIL] Error: {e}")
+        traceback.print_exc()
+        return False
+
+
+def test_incremental_merge():
+    """Test that merging replaces changed rows, adds new ones and drops rows older than lookback_days."""
+    print("\n=== Testing Incremental Merge ===")
+    try:
+        import pandas as pd
+        from process import merge_processed, lookback_days
+
+        now = pd.Timestamp.now().floor('s')
+        def rows(thread_ids, ages, comments):
+            posted = [now - pd.Timedelta(days=age) for age in ages]
+            return pd.DataFrame({'thread_id': thread_ids, 'posted_date_time': posted,
+                                 'date': [p.strftime('%m/%d/%y') for p in posted], 'posted_comment': comments})
+
+        s3 = FakeS3()
+        s3.put_object(Bucket='bucket', Key='data/existing.csv',
+                      Body=rows([1, 2, 3], [lookback_days + 10, 1, 1], ['expired', 'kept', 'old']).to_csv(index=False))
+        merged = merge_processed(s3, 'data/existing.csv', rows([3, 4], [1, 0], ['edited', 'new']))
+        comments = dict(zip(merged['thread_id'], merged['posted_comment']))
+        if comments != {2: 'kept', 3: 'edited', 4: 'new'}:
+            print(f"[FAIL] Unexpected merged rows: {comments}")
+            return False
+        print(f"[OK] Merged rows {comments}")
+        return True
+    except Exception as e:
+        print(f"[FAIL] Error: {e}")
+        traceback.print_exc()
+        return False
+
+
+def test_parallel_loading():
+    """Test that raw files load concurrently, in key order, with unreadable files skipped."""
+    print("\n=== Testing Parallel Loading ===")
+    try:
+        import gzip
+        import io
+        import time
+        import pandas as pd
+        import process
+
+        class SlowS3(FakeS3):
+            def get_object(self, Bucket, Key, IfNoneMatch=None):
+                time.sleep(0.2)
+                return super().get_object(Bucket, Key, IfNoneMatch)
+
+        s3 = SlowS3()
+        frames = {f'raw/pol_{i}.csv': pd.DataFrame({'no': [i, i + 100], 'com': ['a', 'b']}) for i in range(8)}
+        for key, frame in frames.items():
+            s3.put_object(Bucket='bucket', Key=key, Body=frame.to_csv(index=False))
+        s3.put_object(Bucket='bucket', Key='raw/pol_8.csv.gz', Body=gzip.compress(b'no,com\n8,c\n'))
+        parquet = io.BytesIO()
+        pd.DataFrame({'no': [9], 'com': ['d']}).to_parquet(parquet, index=False)
+        s3.put_object(Bucket='bucket', Key='raw/pol_9.parquet', Body=parquet.getvalue())
+        keys = sorted(s3.objects) + ['raw/pol_missing.csv']
+
+        saved_client = process._s3_client
+        process._s3_client = s3
+        try:
+            start = time.perf_counter()
+            loaded, rows_by_key, load_stats = process.load_raw_objects(keys)
+            elapsed = time.perf_counter() - start
+        finally:
+            process._s3_client = saved_client
+        if [frame['no'].iloc[0] for frame in loaded] != list(range(10)) or 'raw/pol_missing.csv' in rows_by_key:
+            print(f"[FAIL] Unexpected frames or rows: {rows_by_key}")
+            return False
+        if elapsed > 0.2 * len(keys) / 2:
+            print(f"[FAIL] Loading {len(keys)} files took {elapsed:.2f}s, not concurrent")
+            return False
+        print(f"[OK] Loaded {load_stats['files_loaded']} of {len(keys)} files in {elapsed:.2f}s")
+        return True
+    except Exception as e:
+        print(f"[FAIL] Error: {e}")
+        traceback.print_exc()
+        return False
+
+
+def test_gather_timestamps():
+    """Test epoch-based timestamp columns against the API's locale `now` string."""
+    print("\n=== Testing Gather Timestamps ===")
+    try:
+        import pandas as pd
+        import gather
+        from benchmarks import synthetic_posts
+
+        data = pd.DataFrame(synthetic_posts(2000))
+        expected = data['now'].str.extract(r'^(?P<date>[^(]+)\((?P<now>[^)]+)\)(?P<time>.+)$')
+        derived = gather.derive_timestamps(data.copy())
+
+        for column in ['date', 'now', 'time']:
+            if not (derived[column] == expected[column]).all():
+                print(f"[FAIL] Column '{column}' does not match the `now` string")
+                return False
+        posted = pd.to_datetime(expected['date'] + expected['time'], format='%m/%d/%y%H:%M:%S')
+        if not (derived['posted_date_time'] == posted).all():
+            print("[FAIL] posted_date_time does not match the `now` string")
+            return False
+        print(f"[OK] Timestamp columns match for {len(data)} posts")
+        return True
+    except Exception as e:
+        print(f"[FAIL] Error: {e}")
+        traceback.print_exc()
+        return False
+
+
+def test_phrase_matcher():
+    """Test that PhraseMatcher returns the same first match as regex_partial_match."""
+    print("\n=== Testing Phrase Matcher ===")
+    try:
+        import random
+        from process import PhraseMatcher, regex_partial_match
+
+        rng = random.Random(11)
+        vocab = ['btc', 'eth', 'to the moon', 'new york', 's&p 500', '$spy', 'rate cut', 'fed', 'ai', 'nvda']
+        phrases = [(phrase, f'category{i % 3}') for i, phrase in enumerate(vocab)]
+        words = vocab + ['the', 'is', 'BTC', 'Eth!', 'NEW York', '.', 'Fed,', 'bitcoin', 'airdrop']
+        rows = [' '.join(rng.choice(words) for _ in range(rng.randint(1, 20))) for _ in range(1000)]
+
+        matcher = PhraseMatcher(phrases)
+        mismatches = [row for row in rows if matcher.match(row) != regex_partial_match(row, phrases)]
+        if mismatches:
+            print(f"[FAIL] {len(mismatches)} rows differ, e.g. {mismatches[0]!r}")
+            return False
+        print(f"[OK] PhraseMatcher matches regex_partial_match on {len(rows)} rows")
+        return True
+    except Exception as e:
+        print(f"[FAIL] Error: {e}")
+        traceback.print_exc()
+        return False
+
+
+def test_batched_scoring():
+    """Test PhraseMatcher.match_many first-match and top-k modes."""
+    print("\n=== Testing Batched Scoring ===")
+    try:
+        from fuzzywuzzy import fuzz
+        from process import PhraseMatcher, regex_partial_match
+
+        phrases = [('btc', 'crypto'), ('to the moon', 'crypto'), ('rate cut', 'macro'), ('fed', 'macro')]
+        rows = ['fed rate cut soon', 'btc to the moon', 'nothing here', None, 'BTC and the Fed']
+
+        # With fuzzywuzzy as the batch scorer, first-match mode must equal the per-row reference
+        matcher = PhraseMatcher(phrases, batch_scorer=lambda texts, choices: [fuzz.partial_ratio(t, c) for t, c in zip(texts, choices)])
+        expected = [regex_partial_match(row, phrases) if row else (None, None, None) for row in rows]
+        if matcher.match_many(rows) != expected:
+            print("[FAIL] First-match results differ from regex_partial_match")
+            return False
+
+        top = PhraseMatcher(phrases).match_many(rows, top_k=2)
+        scores = [[int(score) for score in row[2].split('|')] for row in top if row[2]]
+        if top[2] != (None, None, None) or any(row != sorted(row, reverse=True) or len(row) > 2 for row in scores):
+            print(f"[FAIL] Unexpected top-k results: {top}")
+            return False
+        print(f"[OK] Batched first-match and top-k results are consistent: {top[0]}")
+        return True
+    except Exception as e:
+        print(f"[FAIL] Error: {e}")
+        traceback.print_exc()
+        return False
+
+
+def test_scorer_agreement():
+    """Test that match and match_many agree for both scorers, and chunk workers score on one thread."""
+    print("\n=== Testing Scorer Agreement ===")
+    try:
+        import random
+        import pandas as pd
+        import process
+        from process import PhraseMatcher, score_pairs, map_chunks
+
+        rng = random.Random(7)
+        vocab = ['btc', 'eth', 'to the moon', 'new york', 'rate cut', 'fed', 'nvda', 'bitcoin etf']
+        phrases = [(phrase, f'category{i % 3}') for i, phrase in enumerate(vocab)]
+        words = vocab + ['the', 'is', 'BTC', 'Fed,', 'bitcoin', 'moonshot', 'cut', 'rates', 'york']
+        rows = [' '.join(rng.choice(words) for _ in range(rng.randint(1, 12))) for _ in range(500)]
+
+        for fast in (False, True):
+            matcher = PhraseMatcher(phrases, batch_scorer=lambda texts, choices: score_pairs(texts, choices, fast=fast))
+            if [matcher.match(row) for row in rows] != matcher.match_many(rows):
+                print(f"[FAIL] match and match_many disagree with fast={fast}")
+                return False
+
+        workers = map_chunks(lambda chunk: [process.scorer_workers], pd.DataFrame({'row': range(4)}), workers=2)
+        if any(value != [1] for value in workers) or process.scorer_workers != -1:
+            print(f"[FAIL] Chunk workers scored with {workers} threads, handler with {process.scorer_workers}")
+            return False
+        print(f"[OK] match and match_many agree on {len(rows)} rows with both scorers; default is {process.scorer_name}")
+        return True
+    except Exception as e:
+        print(f"[FAIL] Error: {e}")
+        traceback.print_exc()
+        return False
+
+
+def test_fast_normalizer():
+    """Test normalize_text_fast against normalize_text on a golden corpus of 4chan-style comments."""
+    print("\n=== Testing Fast Normalizer ===")
+    try:
+        from utils import normalize_text, normalize_text_fast
+
+        corpus = [
+            '<a href="#p123456" class="quotelink">&gt;&gt;123456</a><br>Based and redpilled',
+            '<span class="quote">&gt;be me</span><br><span class="quote">&gt;buy high</span><br>sell low',
+            'Check https://www.example.com/path?q=1 and www.test.org/x',
+            '<b>Bold</b> <i>italic</i> <s>spoiler</s><wbr>text',
+            'AT&amp;T stock &quot;to the moon&quot; isn&#039;t it',
+            '[[File:chart.png|thumb|200x100px|right|caption]] thumb|300x200px|right|chart',
+            'caf\u00e9 na\u00efve \u2019quotes\u2019',
+            'line one\n\nline two\n\n\nline three\nend',
+            '<pre class="prettyprint">  code  </pre> after',
+            '>>987654321 >>>/biz/123 quoted',
+            # Outside the fast path: unknown tags, comments, bare entities and stray '<'
+            '<div>block</div> x<!-- c -->y AT&T &foo; &nbsp;z 1 < 2',
+            '', '   ', None, 42,
+        ]
+        for text in corpus:
+            expected, actual = normalize_text(text), normalize_text_fast(text)
+            if expected != actual:
+                print(f"[FAIL] Mismatch for {text!r}: {expected!r} != {actual!r}")
+                return False
+        print(f"[OK] Fast normalizer matches normalize_text on {len(corpus)} samples")
+        return True
+    except Exception as e:
+        print(f"[FAIL] Error: {e}")
+        traceback.print_exc()
+        return False
+
+
+def test_chunked_workers():
+    """Test that map_chunks runs chunks in worker processes and returns them in row order."""
+    print("\n=== Testing Chunked Workers ===")
+    try:
+        import pandas as pd
+        from process import map_chunks
+
+        data = pd.DataFrame({'value': range(1003)})
+        chunks = map_chunks(lambda chunk: chunk.assign(pid=os.getpid()), data, workers=4)
+        combined = pd.concat(chunks)
+        if combined['value'].tolist() != list(range(1003)):
+            print("[FAIL] Chunks were not reassembled in row order")
+            return False
+        print(f"[OK] {len(chunks)} chunks reassembled in order from {combined['pid'].nunique()} process(es)")
+        return True
+    except Exception as e:
+        print(f"[FAIL] Error: {e}")
+        traceback.print_exc()
+        return False
+
+
+def test_text_stats():
+    """Test that both text statistics paths match the per-row RegexpTokenizer counts."""
+    print("\n=== Testing Text Stats ===")
+    try:
+        import pandas as pd
+        from nltk.tokenize import RegexpTokenizer
+        from utils import text_stats, text_stats_vectorized
+
+        stop = frozenset(['the', 'is', 'a', 'to', 'don', 't', 'it'])
+        texts = pd.Series(["the price is going to the moon", "don't  it's $3.50\nok", "", " ", "no stopwords here"],
+                          index=[3, 3, 1, 0, 2])
+        tokenizer = RegexpTokenizer(r'\w+|\$[\d\.]+|\S+')
+        expected = [(len(t.split(" ")), len(t), sum(w in stop for w in tokenizer.tokenize(t))) for t in texts]
+        row_stats = [text_stats(t, stop) for t in texts]
+        vectorized_stats = list(zip(*(column.tolist() for column in text_stats_vectorized(texts, stop))))
+        if row_stats != expected or vectorized_stats != expected:
+            print(f"[FAIL] Expected {expected}, got {row_stats} and {vectorized_stats}")
+            return False
+        print(f"[OK] Row and vectorized text stats match: {expected[0]}")
+        return True
+    except Exception as e:
+        print(f"[FAIL] Error: {e}")
+        traceback.print_exc()
+        return False
+
+
+def test_text_cache():
+    """Test that the text cache returns stored results for unchanged posts and misses edited ones."""
+    print("\n=== Testing Text Cache ===")
+    try:
+        import pandas as pd
+        from process import TextCache, text_cache_fingerprint, key_phrases
+        from utils import string_to_bool
+
+        data = pd.DataFrame({'thread_id': [1, 2, 3], 'posted_comment': ['btc to the moon', '<br>', 'nothing']})
+        transformed = data.iloc[[0, 2]].assign(text_clean=['btc to the moon', 'nothing'], matches=['btc', None],
+                                               category=['crypto', None], similarity=[100, None])
+        cache = TextCache(text_cache_fingerprint(key_phrases))
+        cache.add(data, transformed)
+
+        edited = data.assign(posted_comment=['btc to the moon', '<br>', 'edited'])
+        hits, misses = cache.lookup(edited)
+        if hits['thread_id'].tolist() != [1] or misses['thread_id'].tolist() != [3]:
+            print(f"[FAIL] Unexpected hits {hits['thread_id'].tolist()} / misses {misses['thread_id'].tolist()}")
+            return False
+        if hits[['matches', 'category', 'similarity']].iloc[0].tolist() != ['btc', 'crypto', 100]:
+            print(f"[FAIL] Cached values not restored: {hits.iloc[0].to_dict()}")
+            return False
+
+        import process
+        fingerprint = text_cache_fingerprint(key_phrases)
+        saved = process.general.get('fast_normalizer', 'True')
+        process.general['fast_normalizer'] = str(not string_to_bool(saved))
+        try:
+            flipped = text_cache_fingerprint(key_phrases)
+        finally:
+            process.general['fast_normalizer'] = saved
+        if flipped == fingerprint:
+            print("[FAIL] Changing fast_normalizer kept the text cache fingerprint")
+            return False
+        print(f"[OK] Text cache report: {cache.report()}")
+        return True
+    except Exception as e:
+        print(f"[FAIL] Error: {e}")
+        traceback.print_exc()
+        return False
+
+
+def test_seen_index():
+    """Test that the on-disk dedup index flags only first occurrences across batches."""
+    print("\n=== Testing Seen Index ===")
+    try:
+        from process import SeenIndex
+
+        seen = SeenIndex()
+        try:
+            first = seen.add_new(['1', '2', '2'], ['a', 'a', 'a']).tolist()
+            second = seen.add_new(['1', '1', '3'], ['a', 'b', 'a']).tolist()
+        finally:
+            seen.close()
+        if first != [True, True, False] or second != [False, True, True]:
+            print(f"[FAIL] Unexpected flags: {first}, {second}")
+            return False
+        print("[OK] Seen index dedups within and across batches")
+        return True
+    except Exception as e:
+        print(f"[FAIL] Error: {e}")
+        traceback.print_exc()
+        return False
+
+
+def test_chunked_process():
+    """
+    Test that chunked mode skips an unreadable raw file and processes a reply-only one, and that a
+    transform or write error fails the board instead of skipping the file.
+    """
+    print("\n=== Testing Chunked Process ===")
+    try:
+        import pandas as pd
+        import process
+
+        posted = pd.Timestamp.now().floor('s') - pd.Timedelta(hours=1)
+        replies = pd.DataFrame({'no': [2001, 2002], 'posted_date_time': [posted, posted],
+                                'date': [posted.strftime('%m/%d/%y')] * 2, 'time': ['12:00:00'] * 2,
+                                'com': ['btc to the moon', 'fed rate cut soon']})
+        s3 = FakeS3()
+        prefix = f"{process.raw_prefix}/pol_{process.padding_data}"
+        s3.put_object(Bucket='bucket', Key=f'{prefix}_2026-01-15 00:00:00.csv', Body=replies.to_csv(index=False))
+        s3.put_object(Bucket='bucket', Key=f'{prefix}_2026-01-15 01:00:00.parquet', Body=b'not parquet')
+        stats = process.process_board_chunked(s3, 'pol')
+        manifest = json.loads(s3.objects[process.manifest_key('pol')]['Body'])
+        if stats['status'] != 'processed' or stats['rows'] != 2 or list(manifest['files']) != [f'{prefix}_2026-01-15 00:00:00.csv']:
+            print(f"[FAIL] Unexpected stats {stats} or manifest {list(manifest['files'])}")
+            return False
+
+        from pyarrow import ArrowInvalid
+        def failing_transform(data, key_phrases):
+            raise ArrowInvalid('write failed')
+        s3 = FakeS3()
+        s3.put_object(Bucket='bucket', Key=f'{prefix}_2026-01-15 00:00:00.csv', Body=replies.to_csv(index=False))
+        saved = process.transform_text
+        process.transform_text = failing_transform
+        try:
+            process.process_board_chunked(s3, 'pol')
+            print("[FAIL] A transform error was treated as an unreadable file")
+            return False
+        except ArrowInvalid:
+            pass
+        finally:
+            process.transform_text = saved
+        print(f"[OK] Processed {stats['rows']} reply rows, skipped the unreadable file and raised the transform error")
+        return True
+    except Exception as e:
+        print(f"[FAIL] Error: {e}")
+        traceback.print_exc()
+        return False
+
+
+def test_compact_schema():
+    """Test that raw files are read with the compact dtypes and only the columns a board uses."""
+    print("\n=== Testing Compact Schema ===")
+    try:
+        import io
+        from process import read_csv_compact, apply_schema, raw_usecols
+
+        raw = ("no,now,com,posted_date_time,collected_date_time,date,country,flag_name,replies,tim\n"
+               "101,01/15/26(Thu)10:00:00,hello,2026-01-15 10:00:00,2026-01-15 10:05:00,01/15/26,US,United States,3,1736950000\n"
+               "102,01/15/26(Thu)10:01:00,world,2026-01-15 10:01:00,2026-01-15 10:05:00,01/15/26,US,United States,,1736950060\n")
+        data = apply_schema(read_csv_compact(io.StringIO(raw), raw_usecols('pol')))
+        expected = {'no': 'uint32', 'country': 'category', 'flag_name': 'category', 'replies': 'UInt32',
+                    'posted_date_time': 'datetime64[ns]', 'collected_date_time': 'datetime64[ns]'}
+        actual = {column: str(data[column].dtype) for column in expected}
+        if actual != expected or 'tim' in data.columns or 'now' in data.columns:
+            print(f"[FAIL] Unexpected columns or dtypes: {dict(data.dtypes.astype(str))}")
+            return False
+        print(f"[OK] Compact schema applied to {list(data.columns)}")
+        return True
+    except Exception as e:
+        print(f"[FAIL] Error: {e}")
+        traceback.print_exc()
+        return False
+
+
+def test_parquet_batches():
+    """
+    Test that ParquetBatchWriter output reads back with every batch and is detected as Parquet, and
+    that a streamed raw file starting with a reply-only batch still takes an OP's subject, both when
+    gathered and when processed in chunked mode.
+    """
+    print("\n=== Testing Parquet Batches ===")
+    try:
+        import io
+        import time
+        import pandas as pd
+        import gather
+        import process
+        from utils import ParquetBatchWriter, is_parquet
+
+        buffer = io.BytesIO()
+        writer = ParquetBatchWriter(buffer, row_group_size=3)
+        writer.write(pd.DataFrame({'no': [1, 2], 'country': [None, None], 'flag': pd.Categorical(['a', 'b'])}))
+        writer.write(pd.DataFrame({'no': [3, 4], 'country': ['US', None], 'flag': ['c', 'a']}))
+        writer.close()
+        data = pd.read_parquet(io.BytesIO(buffer.getvalue()))
+        if data['no'].tolist() != [1, 2, 3, 4] or data['country'].tolist() != [None, None, 'US', None]:
+            print(f"[FAIL] Unexpected rows: {data.to_dict('list')}")
+            return False
+        if not is_parquet('raw/x.csv', buffer.getvalue()) or is_parquet('raw/x.csv', b'no,com'):
+            print("[FAIL] Parquet detection by magic bytes failed")
+            return False
+
+        s3 = FakeS3()
+        posted = int(time.time()) - 3600
+        batches = [[{'no': 2, 'time': posted, 'com': 'first reply'}],
+                   [{'no': 3, 'time': posted + 1, 'sub': 'Thread subject', 'com': 'new thread', 'filename': 'a', 'replies': 4}]]
+        saved = gather.output_format, process.output_format, process.output_extension
+        gather.output_format = process.output_format = process.output_extension = 'parquet'
+        try:
+            rows = gather.write_raw_stream(s3, 'pol', iter(batches), '2026-01-15 00:00:00')
+            raw_key, = s3.objects
+            stats = process.process_board_chunked(s3, 'pol')
+        finally:
+            gather.output_format, process.output_format, process.output_extension = saved
+        raw = pd.read_parquet(io.BytesIO(s3.objects[raw_key]['Body']))
+        if rows != 2 or raw['sub'].tolist() != [None, 'Thread subject'] or raw['replies'].tolist()[1] != 4:
+            print(f"[FAIL] Streamed {rows} rows: {raw.to_dict('list')}")
+            return False
+        processed = pd.read_parquet(io.BytesIO(s3.objects[stats.get('output_key', '')]['Body']))
+        if stats['rows'] != 2 or 'Thread subject' not in processed['thread_header'].tolist():
+            print(f"[FAIL] Chunked process returned {stats}")
+            return False
+        print(f"[OK] {writer.rows} rows written in batches and read back; a reply-only first batch kept the OP subject")
+        return True
+    except Exception as e:
+        print(f"[FAIL] Error: {e}")
+        traceback.print_exc()
+        return False
+
+
+def test_partition_layout():
+    """Test that rows map to date partitions by posted_date_time, with missing times in the default partition."""
+    print("\n=== Testing Partition Layout ===")
+    try:
+        import pandas as pd
+        from process import partition_days, partition_key, null_partition
+
+        data = pd.DataFrame({'posted_date_time': pd.to_datetime(['2026-01-15 23:59:59', '2026-01-16 00:00:00', None])})
+        days = partition_days(data).tolist()
+        if days != ['2026-01-15', '2026-01-16', null_partition]:
+            print(f"[FAIL] Unexpected partitions: {days}")
+            return False
+        key = partition_key('pol', days[0])
+        if not key.endswith('/board=pol/date=2026-01-15/part-0000.' + key.rsplit('.', 1)[-1]):
+            print(f"[FAIL] Unexpected partition key: {key}")
+            return False
+        print(f"[OK] Partitions {days} -> {key}")
+        return True
+    except Exception as e:
+        print(f"[FAIL] Error: {e}")
+        traceback.print_exc()
+        return False
+
+
+def test_refresh_batches():
+    """Test that refresh deletes expired keys in DeleteObjects batches and copies every object once."""
+    print("\n=== Testing Refresh Batches ===")
+    try:
+        from refresh import copy_page, delete_keys, delete_batch_size
+
+        class Client:
+            def __init__(self):
+                self.copied, self.batches = [], []
+            def copy_object(self, Bucket, CopySource, Key):
+                self.copied.append(Key)
+            def delete_objects(self, Bucket, Delete):
+                self.batches.append(len(Delete['Objects']))
+                return {}
+
+        class Context:
+            def get_remaining_time_in_millis(self):
+                return 900000
+
+        client = Client()
+        stats = {'copied': 0, 'copied_bytes': 0, 'copy_seconds': 0.0, 'deleted': 0, 'delete_seconds': 0.0}
+        objects = [{'Key': f'data/{i}.csv', 'LastModified': None, 'Size': 10} for i in range(50)]
+        keys = [f'data/old{i}.csv' for i in range(delete_batch_size + 5)]
+        if not copy_page(client, Context(), 'src', 'dst', objects, stats) or sorted(client.copied) != sorted(o['Key'] for o in objects):
+            print(f"[FAIL] Copied {len(client.copied)} of {len(objects)} objects")
+            return False
+        if not delete_keys(client, Context(), 'dst', keys, stats) or client.batches != [delete_batch_size, 5]:
+            print(f"[FAIL] Unexpected delete batches: {client.batches}")
+            return False
+        print(f"[OK] Copied {stats['copied']} objects, deleted {stats['deleted']} keys in {len(client.batches)} requests")
+        return True
+    except Exception as e:
+        print(f"[FAIL] Error: {e}")
+        traceback.print_exc()
+        return False
+
+
+def test_refresh_plan():
+    """
+    Test that the refresh diff copies only missing or changed objects and deletes only expired ones,
+    keeping an old destination copy whose source was re-put inside the window unchanged.
+    """
+    print("\n=== Testing Refresh Plan ===")
+    try:
+        from datetime import datetime, timedelta, timezone
+        from refresh import plan_refresh
+
+        now = datetime.now(timezone.utc)
+        threshold = now - timedelta(days=30)
+        source = {
+            'same': {'Key': 'same', 'Size': 10, 'ETag': 'a', 'LastModified': now - timedelta(days=1)},
+            'resized': {'Key': 'resized', 'Size': 12, 'ETag': 'b', 'LastModified': now - timedelta(days=1)},
+            'multipart': {'Key': 'multipart', 'Size': 10, 'ETag': 'c-2', 'LastModified': now - timedelta(days=2)},
+            'missing': {'Key': 'missing', 'Size': 10, 'ETag': 'd', 'LastModified': now - timedelta(days=1)},
+            'old': {'Key': 'old', 'Size': 10, 'ETag': 'e', 'LastModified': now - timedelta(days=40)},
+            'reput': {'Key': 'reput', 'Size': 10, 'ETag': 'h', 'LastModified': now - timedelta(days=1)},
+        }
+        destination = {
+            'same': {'Key': 'same', 'Size': 10, 'ETag': 'a', 'LastModified': now - timedelta(days=1)},
+            'resized': {'Key': 'resized', 'Size': 10, 'ETag': 'b', 'LastModified': now - timedelta(days=1)},
+            'multipart': {'Key': 'multipart', 'Size': 10, 'ETag': 'f', 'LastModified': now - timedelta(days=1)},
+            'expired': {'Key': 'expired', 'Size': 10, 'ETag': 'g', 'LastModified': now - timedelta(days=31)},
+            'reput': {'Key': 'reput', 'Size': 10, 'ETag': 'h', 'LastModified': now - timedelta(days=35)},
+        }
+        plan = plan_refresh(source, destination, threshold)
+        copies = sorted(obj['Key'] for obj in plan['copy'])
+        if copies != ['missing', 'resized'] or plan['delete'] != ['expired'] or plan['in_sync'] != 3:
+            print(f"[FAIL] Unexpected plan: copy {copies}, delete {plan['delete']}, in sync {plan['in_sync']}")
+            return False
+        print(f"[OK] Plan copies {copies}, deletes {plan['delete']}, skips {plan['in_sync']} in sync")
+        return True
+    except Exception as e:
+        print(f"[FAIL] Error: {e}")
+        traceback.print_exc()
+        return False
+
+def test_refresh_fanout():
+    """Test that the configured destinations parse and each lookback window bisects the shared source index."""
+    print("\n=== Testing Refresh Fan-out ===")
+    try:
+        from datetime import datetime, timedelta, timezone
+        from refresh import SourceIndex, refresh_destinations
+
+        destinations = refresh_destinations()
+        if not destinations or not all(isinstance(days, int) for _, days in destinations):
+            print(f"[FAIL] Unexpected destinations: {destinations}")
+            return False
+        now = datetime.now(timezone.utc)
+        index = SourceIndex({f'data/{i}': {'Key': f'data/{i}', 'LastModified': now - timedelta(hours=i)} for i in range(100)})
+        for days in (1, 3, 30):
+            window = index.since(now - timedelta(days=days))
+            expected = [f'data/{i}' for i in range(min(100, days * 24 + 1))]
+            if [obj['Key'] for obj in window] != expected:
+                print(f"[FAIL] Window of {days} days returned {len(window)} objects, expected {len(expected)}")
+                return False
+        print(f"[OK] {len(destinations)} destinations share one source index: {destinations}")
+        return True
+    except Exception as e:
+        print(f"[FAIL] Error: {e}")
+        traceback.print_exc()
+        return False
+
+def test_refresh_checkpoint():
+    """Test that an interrupted refresh resumes from a local checkpoint without repeating copies."""
+    print("\n=== Testing Refresh Checkpoint ===")
+    try:
+        import tempfile
+        import refresh
+
+        class Client:
+            def __init__(self):
+                self.copied = []
+            def copy_object(self, Bucket, CopySource, Key):
+                self.copied.append(Key)
+
+        class Context:
+            def __init__(self, calls):
+                self.calls = calls
+            def get_remaining_time_in_millis(self):
+                self.calls -= 1
+                return 900000 if self.calls > 0 else 0
+
+        client = Client()
+        objects = [{'Key': f'data/{i}.csv', 'Size': 10, 'LastModified': '2026-01-15T00:00:00+00:00', 'Reason': 'missing'}
+                   for i in range(2 * refresh.checkpoint_every + 5)]
+        with tempfile.TemporaryDirectory() as tmp:
+            store = refresh.CheckpointStore(client, backend='local', path=os.path.join(tmp, 'checkpoint.json'))
+            checkpoint = {'progress': {'dst': {'summary': {}, 'copy': objects, 'delete': [], 'copy_cursor': 0, 'delete_cursor': 0}}}
+            first = refresh.run_destination(client, Context(2), 'src', 'dst', checkpoint['progress']['dst'], lambda: store.save(checkpoint))
+            progress = store.load()['progress']['dst']
+            second = refresh.run_destination(client, Context(100), 'src', 'dst', progress)
+        if first['status'] != 'incomplete' or second['status'] != 'complete':
+            print(f"[FAIL] Unexpected statuses: {first['status']}, {second['status']}")
+            return False
+        if sorted(client.copied) != sorted(obj['Key'] for obj in objects):
+            print(f"[FAIL] {len(client.copied)} copies for {len(objects)} planned objects")
+            return False
+
+        # A checkpoint left by the previous scheduled run is still resumed; one older than the max age is not
+        from datetime import datetime, timedelta, timezone
+        def saved(minutes_ago):
+            planned_at = (datetime.now(timezone.utc) - timedelta(minutes=minutes_ago)).isoformat()
+            return {'planned_at': planned_at, 'destinations': [['dst', 1]], 'progress': {'dst': {}}}
+        if not refresh.checkpoint_usable(saved(refresh.schedule_minutes + 5), [('dst', 1)]) \
+                or refresh.checkpoint_usable(saved(refresh.checkpoint_max_age_minutes + 5), [('dst', 1)]):
+            print(f"[FAIL] Checkpoint age limit {refresh.checkpoint_max_age_minutes} min does not fit a "
+                  f"{refresh.schedule_minutes} min schedule")
+            return False
+        print(f"[OK] Stopped after {first['copy_cursor']} copies and resumed the remaining {second['copied']}")
+        return True
+    except Exception as e:
+        print(f"[FAIL] Error: {e}")
+        traceback.print_exc()
+        return False
+
+def test_refresh_listing():
+    """Test that the pruned source listing skips date-first partitions older than the window but keeps flat keys."""
+    print("\n=== Testing Refresh Listing ===")
+    try:
+        from datetime import datetime, timedelta
+        from zoneinfo import ZoneInfo
+        from refresh import list_source
+        from utils import api_timezone
+
+        # Partition dates are New York dates, which differ from the UTC date for part of each day
+        now = datetime.now(ZoneInfo(api_timezone))
+        keys = sorted([f"data/date={(now - timedelta(days=d)).strftime('%Y-%m-%d')}/board=pol/part-0000.csv" for d in range(90)]
+                      + ['data/chanscope_pol_2026-01-01_2026-01-31_processed.csv', 'data/board=biz/date=2025-01-01/part-0000.csv'])
+
+        class Client:
+            def get_paginator(self, name):
+                return self
+            def paginate(self, Bucket, Prefix, StartAfter='', Delimiter=None):
+                page = {'Contents': [], 'CommonPrefixes': []}
+                for key in keys:
+                    if not key.startswith(Prefix) or key <= StartAfter:
+                        continue
+                    rest = key[len(Prefix):]
+                    if Delimiter and Delimiter in rest:
+                        common = {'Prefix': Prefix + rest.split(Delimiter)[0] + Delimiter}
+                        if common not in page['CommonPrefixes']:
+                            page['CommonPrefixes'].append(common)
+                    else:
+                        page['Contents'].append({'Key': key, 'LastModified': now, 'Size': 1})
+                yield page
+
+        listed = sorted(list_source(Client(), 'bucket', 'data', 30))
+        dated = [key for key in listed if key.startswith('data/date=')]
+        if len(dated) != 31 or len(listed) != 33:
+            print(f"[FAIL] Listed {len(dated)} dated and {len(listed) - len(dated)} other keys, expected 31 and 2")
+            return False
+        print(f"[OK] Listed {len(listed)} of {len(keys)} keys for a 30-day window")
+        return True
+    except Exception as e:
+        print(f"[FAIL] Error: {e}")
+        traceback.print_exc()
+        return False
+
+def test_lazy_imports():
+    """Test that importing main and refresh loads no data-processing libraries and parses the config once."""
+    print("\n=== Testing Lazy Imports ===")
+    try:
+        import subprocess
+        probe = ("import sys, main, refresh, utils\n"
+                 "refresh.refresh_destinations(); utils.read_config('general'); utils.read_config('s3')\n"
+                 "print(','.join(m for m in ('pandas', 'numpy', 'bs4', 'nltk', 'fuzzywuzzy') if m in sys.modules))\n"
+                 "print(utils.load_config.cache_info().misses)")
+        output = subprocess.run([sys.executable, '-c', probe], capture_output=True, text=True, check=True).stdout.split('\n')
+        loaded, parses = output[0], int(output[1])
+        if loaded or parses != 1:
+            print(f"[FAIL] Loaded [{loaded}] and parsed config.ini {parses} times")
+            return False
+        print("[OK] main and refresh import without pandas, numpy, bs4, nltk or fuzzywuzzy; config parsed once")
+        return True
+    except Exception as e:
+        print(f"[FAIL] Error: {e}")
+        traceback.print_exc()
+        return False
+
+def test_dry_run():
+    """Test that a dryRun event skips gather and process, which always write."""
+    print("\n=== Testing Dry Run ===")
+    try:
+        import subprocess
+        probe = ("import sys, main\n"
+                 "result = main.lambda_handler({'dryRun': True, 'phases': ['gather', 'process']}, None)\n"
+                 "print(result['gather_result'], result['process_result'], len(result['errors']), 'gather' in sys.modules, 'process' in sys.modules)")
+        output = subprocess.run([sys.executable, '-c', probe], capture_output=True, text=True, check=True).stdout.strip().split('\n')[-1]
+        if output != 'None None 0 False False':
+            print(f"[FAIL] Dry run ran gather or process: {output}")
+            return False
+        print("[OK] Dry run skipped gather and process")
+        return True
+    except Exception as e:
+        print(f"[FAIL] Error: {e}")
+        traceback.print_exc()
+        return False
+
+def test_metrics():
+    """
+    Test that steps record time and counters, worker records merge in, a step on a worker thread
+    counts only that thread's CPU, peak RSS is reported once per invocation rather than per step,
+    and each step emits a valid EMF line.
+    """
+    print("\n=== Testing Metrics ===")
+    try:
+        import metrics
+
+        metrics.reset()
+        with metrics.step('process'):
+            with metrics.step('process.clean') as step:
+                step.add('rows_in', 10)
+                step.add('rows_out', 8)
+            metrics.add_active('s3_calls', 1)
+        metrics.merge({'process.clean': {'calls': 1, 'rows_in': 5}})
+
+        import time
+        def idle_step():
+            with metrics.step('gather.fetch'):
+                time.sleep(0.3)
+        idle = threading.Thread(target=idle_step)
+        idle.start()
+        busy_until = time.perf_counter() + 0.3
+        while time.perf_counter() < busy_until:
+            pass
+        idle.join()
+        summary = metrics.summary()
+        clean = summary.get('process.clean', {})
+        if clean.get('calls') != 2 or clean.get('rows_in') != 15 or clean.get('rows_out') != 8:
+            print(f"[FAIL] Unexpected process.clean record: {clean}")
+            return False
+        if summary['process'].get('s3_calls') != 1 or 's3_calls' in clean:
+            print(f"[FAIL] S3 calls should count only against open steps: {summary}")
+            return False
+        if any('peak_rss_mb' in record for name, record in summary.items() if name != 'invocation') \
+                or summary.get('invocation', {}).get('peak_rss_mb', 0) <= 0:
+            print(f"[FAIL] Peak RSS should be reported once, under invocation: {summary}")
+            return False
+        if summary['gather.fetch']['cpu_ms'] > 100:
+            print(f"[FAIL] A worker-thread step counted other threads' CPU: {summary['gather.fetch']}")
+            return False
+        line = json.loads(metrics.emf_line('process.clean', clean, 0))
+        names = [metric['Name'] for metric in line['_aws']['CloudWatchMetrics'][0]['Metrics']]
+        if line['Phase'] != 'process' or line['Step'] != 'clean' or 'wall_ms' not in names:
+            print(f"[FAIL] Unexpected EMF line: {line}")
+            return False
+        metrics.reset()
+        print(f"[OK] Recorded {sorted(clean)} and emitted EMF metrics {names}")
+        return True
+    except Exception as e:
+        print(f"[FAIL] Error: {e}")
+        traceback.print_exc()
+        return False
+
 def test_gather_handler():
     """Test gather handler (requires AWS credentials and network)."""
     print("\n=== Testing Gather Handler ===")
@@ -256,6 +1434,35 @@ def run_all_tests():
         "Key Phrases": test_key_phrases_loading(),
         "S3 Prefix Consistency": test_s3_prefix_consistency(),
         "NLTK Data": test_nltk_data(),
+        "Concurrent Fetch": test_concurrent_fetch(),
+        "Incremental Gather and Process": test_incremental_gather_process(),
+        "Gather Deadline": test_gather_deadline(),
+        "Conditional Requests": test_conditional_requests(),
+        "Stream Gather": test_stream_gather(),
+        "Token Bucket": test_token_bucket(),
+        "Incremental Merge": test_incremental_merge(),
+        "Parallel Loading": test_parallel_loading(),
+        "Gather Timestamps": test_gather_timestamps(),
+        "Phrase Matcher": test_phrase_matcher(),
+        "Batched Scoring": test_batched_scoring(),
+        "Scorer Agreement": test_scorer_agreement(),
+        "Fast Normalizer": test_fast_normalizer(),
+        "Chunked Workers": test_chunked_workers(),
+        "Text Stats": test_text_stats(),
+        "Text Cache": test_text_cache(),
+        "Seen Index": test_seen_index(),
+        "Chunked Process": test_chunked_process(),
+        "Compact Schema": test_compact_schema(),
+        "Parquet Batches": test_parquet_batches(),
+        "Partition Layout": test_partition_layout(),
+        "Refresh Batches": test_refresh_batches(),
+        "Refresh Plan": test_refresh_plan(),
+        "Refresh Fan-out": test_refresh_fanout(),
+        "Refresh Checkpoint": test_refresh_checkpoint(),
+        "Refresh Listing": test_refresh_listing(),
+        "Lazy Imports": test_lazy_imports(),
+        "Dry Run": test_dry_run(),
+        "Metrics": test_metrics(),
         "Gather Handler": test_gather_handler(),
         "Process Handler": test_process_handler_dry(),
         "Main Handler": test_main_handler(),
@@ -1,31 +1,36 @@
 import os
 import configparser
-import pandas as pd
 import warnings
-from bs4 import BeautifulSoup, MarkupResemblesLocatorWarning
 from unicodedata import normalize
 from urllib.parse import urlparse
-import nltk
+import json
+import io
 
-from nltk.tokenize import RegexpTokenizer
-from nltk.corpus import stopwords
 import re
 import string
+from functools import lru_cache
 
-warnings.filterwarnings("ignore", category=MarkupResemblesLocatorWarning)
-warnings.filterwarnings("ignore", category=UserWarning, module='bs4')
+# pandas, numpy, bs4 and nltk are imported where they are used, so phases that never touch them
+# (e.g. a refresh-only invocation) do not pay for them at cold start
 
 config_path = 'config.ini'
 nltk_data_path = os.getenv('NLTK_DATA', 'nltk_data') 
-if nltk_data_path not in nltk.data.path:
-    nltk.data.path.append(nltk_data_path)
+# posted_date_time, and the date partitions derived from it, are naive wall-clock time in the
+# 4chan API's timezone
+api_timezone = 'America/New_York'
 
-def read_config(section="general", config_path=config_path):
+@lru_cache(maxsize=None)
+def load_config(config_path=config_path):
+    """Parses the configuration file on first use; every read_config call after that reuses it."""
     if not os.path.exists(config_path):
         print(f"Configuration file {config_path} not found.")
         raise FileNotFoundError(f"Configuration file not found: {config_path}")
     config = configparser.ConfigParser()
     config.read(config_path)
+    return config
+
+def read_config(section="general", config_path=config_path):
+    config = load_config(config_path)
     if section not in config.sections():
         print(f"Section '{section}' not found in configuration.")
         raise KeyError(f"Section not found: {section}")
@@ -36,7 +41,6 @@ whitespace_regex = re.compile(r'\s+')
 punctuation_regex = re.compile(f"([{string.punctuation}])")
 non_alphanumeric_regex = re.compile(r'[^a-zA-Z0-9.,!?\' ]')
 punctuation_regex = re.compile(f"([{string.punctuation}])")
-contraction_mapping = pd.read_json('contraction_mapping.json', typ='series').to_dict()
 config_params = read_config(section="general", config_path=config_path)
    
 wiki_markup_regex = re.compile(
@@ -56,6 +60,23 @@ def pad_punctuation(s):
         return whitespace_regex.sub(' ', s).strip()
     return s
     
+@lru_cache(maxsize=None)
+def contraction_map():
+    """contraction_mapping.json as a dict, read on first use."""
+    with open('contraction_mapping.json', 'r') as f:
+        return json.load(f)
+
+@lru_cache(maxsize=None)
+def soup_class():
+    """Imports BeautifulSoup on first use and silences its markup warnings."""
+    from bs4 import BeautifulSoup, MarkupResemblesLocatorWarning
+    warnings.filterwarnings("ignore", category=MarkupResemblesLocatorWarning)
+    warnings.filterwarnings("ignore", category=UserWarning, module='bs4')
+    return BeautifulSoup
+
+def html_soup(text):
+    return soup_class()(text, 'html.parser')
+
 def normalize_text(text):
     if isinstance(text, str):
         try:
@@ -65,7 +86,7 @@ def normalize_text(text):
             text = wiki_markup_regex.sub('', text)  # Remove wiki markup
             text = re.sub(r'\n\n.*?\n\n*?\n', ' ', text)
             text = text.replace('\n', ' ')
-            text = ' '.join(BeautifulSoup(text, 'html.parser').stripped_strings)
+            text = ' '.join(html_soup(text).stripped_strings)
             text = re.sub(r'>>\d+', ' ', text)
             # Revised pattern to remove 'thumb|', 'px', '200px|', 'right|', and similar patterns
             text = re.sub(r'thumb\|\d*x\d*px\|right\|', '', text)
@@ -75,7 +96,7 @@ def normalize_text(text):
             text = re.sub(r'^\s*>+', '', text, flags=re.MULTILINE)
             # Existing normalization steps continued
             if string_to_bool(config_params.get("contraction_mapping", "False")):
-                text = ' '.join(contraction_mapping.get(t, t) for t in text.split())
+                text = ' '.join(contraction_map().get(t, t) for t in text.split())
             if string_to_bool(config_params.get("non_alpha_numeric", "False")):
                 text = non_alphanumeric_regex.sub(' ', text)
             return whitespace_regex.sub(' ', text).strip()
@@ -83,35 +104,133 @@ def normalize_text(text):
             return text
     return text
 
+# Fast-path normalizer for 4chan's small markup vocabulary. Anything outside it falls back to normalize_text.
+markup_tags = ('a', 'b', 'br', 'code', 'em', 'i', 'pre', 's', 'span', 'strong', 'u', 'wbr')
+markup_tag_regex = re.compile(
+    r'</?(?:' + '|'.join(markup_tags) + r')'
+    r'(?:\s+[\w:.-]+(?:\s*=\s*(?:"[^"<>]*"|\'[^\'<>]*\'|[^\s"\'<>=`]+))?)*\s*/?>',
+    re.IGNORECASE
+)
+markup_entities = {'&gt;': '>', '&lt;': '<', '&amp;': '&', '&quot;': '"', '&#039;': "'", '&#39;': "'", '&#x27;': "'"}
+markup_entity_regex = re.compile('|'.join(re.escape(entity) for entity in markup_entities))
+blank_block_regex = re.compile(r'\n\n.*?\n\n*?\n')
+# Quote links ('>>123' -> ' ') and thumb/px wiki remnants in one pass, alternatives in the order normalize_text applies them
+post_markup_regex = re.compile(r'(>>\d+)|thumb\|\d*x\d*px\|right\||thumb\|\d*x\d*px\||thumb\||\d*x\d*px\|')
+leading_quote_regex = re.compile(r'^\s*>+', re.MULTILINE)
+
+def markup_strings(text):
+    """
+    Equivalent of ' '.join(BeautifulSoup(text, 'html.parser').stripped_strings) for text that only
+    uses markup_tags and markup_entities. Returns None for anything else, such as unknown tags,
+    comments, stray '<' or other entities.
+    """
+    strings = []
+    for piece in markup_tag_regex.split(text):
+        if '<' in piece:
+            return None
+        if '&' in piece:
+            decoded, count = markup_entity_regex.subn(lambda m: markup_entities[m.group(0)], piece)
+            if count != piece.count('&'):
+                return None
+            piece = decoded
+        piece = piece.strip()
+        if piece:
+            strings.append(piece)
+    return ' '.join(strings)
+
+def normalize_text_fast(text):
+    """
+    Single-pass version of normalize_text for 4chan comments. Markup is stripped without building
+    a BeautifulSoup tree, and the quote-link and thumb/px substitutions run as one compiled pass.
+    Output matches normalize_text; inputs outside the fast path are handed to it unchanged.
+    """
+    if not isinstance(text, str):
+        return text
+    try:
+        cleaned = url_regex.sub(lambda m: urlparse(m.group(0)).netloc.replace('www.', ''), text)
+    except ValueError:
+        return normalize_text(text)
+    cleaned = normalize('NFKD', cleaned).encode('ascii', 'ignore').decode('utf-8', 'ignore')
+    cleaned = wiki_markup_regex.sub('', cleaned)
+    cleaned = blank_block_regex.sub(' ', cleaned).replace('\n', ' ')
+    cleaned = markup_strings(cleaned)
+    if cleaned is None:
+        return normalize_text(text)
+    cleaned = post_markup_regex.sub(lambda m: ' ' if m.group(1) else '', cleaned)
+    # A removal can splice together a new thumb/px pattern that the sequential passes would also strip
+    if 'thumb|' in cleaned or 'px|' in cleaned:
+        return normalize_text(text)
+    cleaned = leading_quote_regex.sub('', cleaned)
+    if string_to_bool(config_params.get("contraction_mapping", "False")):
+        cleaned = ' '.join(contraction_map().get(t, t) for t in cleaned.split())
+    if string_to_bool(config_params.get("non_alpha_numeric", "False")):
+        cleaned = non_alphanumeric_regex.sub(' ', cleaned)
+    return whitespace_regex.sub(' ', cleaned).strip()
+
+def clean_text(text):
+    """Full cleaning chain applied to each comment: normalize, collapse whitespace, pad punctuation."""
+    fast = string_to_bool(config_params.get("fast_normalizer", "True"))
+    normalizer = normalize_text_fast if fast else normalize_text
+    return pad_punctuation(remove_whitespace(normalizer(text)))
+
 def remove_whitespace(text):
     if isinstance(text, str):
         return " ".join(text.split())
     return text
 
-def supportingcols(data, posted_comment):
-    def count_stopwords(text):
-        stop = stop_words_()
-        tokenizer = RegexpTokenizer(r'\w+|\$[\d\.]+|\S+')
-        word_tokens = tokenizer.tokenize(text)
-        stopwords_x = [w for w in word_tokens if w in stop]
-        return len(stopwords_x)
-
-    text = data.posted_comment
-    text = text.astype(str)
-    wordcount = text.apply(lambda x: len(str(x).split(" ")))
-    char_cnt = text.str.len()
-    stop_words = data.posted_comment.apply(lambda x:count_stopwords(x))
-    data['word_cnt'] = wordcount
+# Same pattern and flags as RegexpTokenizer(r'\w+|\$[\d\.]+|\S+'), compiled once
+stats_token_regex = re.compile(r'\w+|\$[\d\.]+|\S+', re.UNICODE | re.MULTILINE | re.DOTALL)
+
+def text_stats(text, stop):
+    """Returns (word_cnt, char_cnt, stopwords_count) for one comment from a single tokenization."""
+    stopword_count = 0
+    for token in stats_token_regex.findall(text):
+        if token in stop:
+            stopword_count += 1
+    return text.count(" ") + 1, len(text), stopword_count
+
+def text_stats_vectorized(text, stop):
+    """Column-at-a-time version of text_stats using pandas string methods."""
+    text = text.reset_index(drop=True)
+    tokens = text.str.findall(stats_token_regex).explode()
+    stopword_count = tokens.isin(stop).groupby(level=0).sum()
+    return text.str.count(" ") + 1, text.str.len(), stopword_count
+
+def supportingcols(data, posted_comment, vectorized=None):
+    """
+    Adds word_cnt (space-separated pieces), char_cnt and stopwords_count for the comment column.
+    Each comment is tokenized once and checked against the cached stopword set. The vectorized
+    path computes the same columns with pandas string methods.
+    """
+    if vectorized is None:
+        vectorized = string_to_bool(config_params.get("vectorized_text_stats", "False"))
+    stop = stop_word_set()
+    text = data[posted_comment].astype(str)
+    if vectorized:
+        word_cnt, char_cnt, stopword_count = (column.to_numpy(dtype='int64') for column in text_stats_vectorized(text, stop))
+    else:
+        import numpy as np
+        stats = np.array([text_stats(value, stop) for value in text], dtype='int64').reshape(-1, 3)
+        word_cnt, char_cnt, stopword_count = stats[:, 0], stats[:, 1], stats[:, 2]
+    data['word_cnt'] = word_cnt
     data['char_cnt'] = char_cnt
-    data["stopwords_count"] = stop_words
+    data["stopwords_count"] = stopword_count
     return data
 
 def string_to_bool(string_value):
     return string_value.lower() in ['true', '1', 't', 'y', 'yes', 'on']
 
 def stop_words_():
+    import nltk
+    if nltk_data_path not in nltk.data.path:
+        nltk.data.path.append(nltk_data_path)
     return nltk.corpus.stopwords.words('english')
 
+@lru_cache(maxsize=None)
+def stop_word_set():
+    """English stopwords as a frozenset, loaded once per process."""
+    return frozenset(stop_words_())
+
 def remove_stop_(text):
     #stop.extend(pos_list)
     stop = stop_words_()
@@ -122,6 +241,7 @@ def remove_stop_(text):
     return (' '.join(words_kept)).strip()
 
 def get_dateRange(data):
+    import pandas as pd
     data['date'] = pd.to_datetime(data['date'])
     data = data.dropna(subset='date')
     min_date = data.date.min()
@@ -136,6 +256,136 @@ def remove_omit_ids(df, column_name='thread_id', omit_ids=[]):
     filtered_df = df[~df[column_name].isin(omit_set)]
     return filtered_df
 
+def load_json_state(s3_client, bucket, key):
+    """
+    Loads a JSON state object from S3. Returns an empty dict when the object does not exist yet.
+    """
+    try:
+        body = s3_client.get_object(Bucket=bucket, Key=key)['Body'].read()
+    except s3_client.exceptions.NoSuchKey:
+        print(f"No state found at s3://{bucket}/{key}, starting fresh")
+        return {}
+    return json.loads(body)
+
+def save_json_state(s3_client, bucket, key, state):
+    s3_client.put_object(Bucket=bucket, Key=key, Body=json.dumps(state).encode('utf-8'), ContentType='application/json')
+
+class S3MultipartWriter:
+    """
+    Write-only file object backed by an S3 multipart upload. A part is uploaded every time
+    part_size bytes are buffered, so memory use stays bounded no matter how much is written.
+    """
+    min_part_size = 5 * 1024 * 1024
+
+    def __init__(self, s3_client, bucket, key, part_size=8 * 1024 * 1024):
+        self.s3_client = s3_client
+        self.bucket = bucket
+        self.key = key
+        self.part_size = max(part_size, self.min_part_size)
+        self.buffer = io.BytesIO()
+        self.parts = []
+        self.bytes_written = 0
+        self.upload_id = s3_client.create_multipart_upload(Bucket=bucket, Key=key)['UploadId']
+
+    def write(self, data):
+        self.buffer.write(data)
+        self.bytes_written += len(data)
+        if self.buffer.tell() >= self.part_size:
+            self._upload_part()
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def tell(self):
+        return self.bytes_written
+
+    @property
+    def closed(self):
+        return False
+
+    def _upload_part(self):
+        part_number = len(self.parts) + 1
+        response = self.s3_client.upload_part(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id,
+                                              PartNumber=part_number, Body=self.buffer.getvalue())
+        self.parts.append({'ETag': response['ETag'], 'PartNumber': part_number})
+        self.buffer = io.BytesIO()
+
+    def close(self):
+        # The last part may be smaller than the S3 minimum part size
+        if self.buffer.tell() or not self.parts:
+            self._upload_part()
+        self.s3_client.complete_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id,
+                                                 MultipartUpload={'Parts': self.parts})
+
+    def abort(self):
+        self.s3_client.abort_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id)
+
+class ParquetBatchWriter:
+    """
+    Appends DataFrames to a Parquet file. Batches are buffered into row groups of about
+    row_group_size rows, so many small batches do not each become a tiny row group. The schema
+    comes from the first batch, with dictionary (categorical) columns stored as their values.
+    Columns that are all null in the first batch, such as OP-only fields in a batch of replies,
+    carry no type of their own: they take their pandas dtype from `dtypes`, or string when they
+    are not listed there. Later batches are cast to that schema.
+    """
+    def __init__(self, fileobj, compression='zstd', row_group_size=65536, dtypes=None):
+        self.fileobj = fileobj
+        self.compression = compression
+        self.row_group_size = row_group_size
+        self.dtypes = dtypes or {}
+        self.writer = None
+        self.pending = []
+        self.pending_rows = 0
+        self.rows = 0
+
+    def write(self, data):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        table = pa.Table.from_pandas(data, preserve_index=False)
+        if self.writer is None:
+            fields = []
+            for field, column in zip(table.schema, table.columns):
+                if pa.types.is_dictionary(field.type):
+                    field = field.with_type(field.type.value_type)
+                if column.null_count == len(column) and not pa.types.is_temporal(field.type):
+                    field = field.with_type(self._declared_type(field.name))
+                fields.append(field)
+            self.writer = pq.ParquetWriter(self.fileobj, pa.schema(fields), compression=self.compression)
+        self.pending.append(table.cast(self.writer.schema))
+        self.pending_rows += len(data)
+        self.rows += len(data)
+        if self.pending_rows >= self.row_group_size:
+            self._write_row_group()
+
+    def _declared_type(self, column):
+        import pandas as pd
+        import pyarrow as pa
+        if column not in self.dtypes:
+            return pa.string()
+        empty = pd.DataFrame({column: pd.Series(dtype=self.dtypes[column])})
+        arrow_type = pa.Schema.from_pandas(empty, preserve_index=False).field(column).type
+        if pa.types.is_dictionary(arrow_type):
+            arrow_type = arrow_type.value_type
+        return pa.string() if pa.types.is_null(arrow_type) else arrow_type
+
+    def _write_row_group(self):
+        import pyarrow as pa
+        self.writer.write_table(pa.concat_tables(self.pending))
+        self.pending = []
+        self.pending_rows = 0
+
+    def close(self):
+        if self.writer is not None:
+            if self.pending:
+                self._write_row_group()
+            self.writer.close()
+
+def is_parquet(key, head=b''):
+    """True for Parquet objects, detected by the key suffix or the PAR1 magic bytes."""
+    return key.endswith('.parquet') or head[:4] == b'PAR1'
+
 def flatten_key_phrases(key_phrases):
     """
     Flattens the key phrases JSON into a list of tuples containing